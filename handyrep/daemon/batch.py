@@ -0,0 +1,93 @@
+import inspect
+from threading import Thread
+
+import daemon.daemonfunctions as hrdf
+from daemon.invokable import INVOKABLE
+
+# arguments which name the server an operation acts on,
+# used to decide which operations can run in parallel
+SERVER_ARGS = ("servername", "replicaserver", "newmaster", "clonefrom")
+
+def check_operation(operation):
+    # returns the function and arguments for one batch
+    # operation, or an error message
+    if not isinstance(operation, dict) or "function" not in operation:
+        return None, None, "Operation must have a function"
+    func = operation["function"]
+    try:
+        function_reference = INVOKABLE[func]
+    except KeyError:
+        return None, None, "Undefined function " + str(func)
+
+    arguments = operation.get("args") or {}
+    if not isinstance(arguments, dict):
+        return None, None, "args must be a dictionary"
+    # arguments arrive as JSON values, but the invokable
+    # functions expect strings, as from a query string
+    arguments = dict((key, val if isinstance(val, (basestring, list)) else str(val))
+        for key, val in arguments.iteritems())
+
+    if inspect.getargspec(function_reference).keywords is None:
+        diff = set(arguments.keys()).difference(set(inspect.getargspec(function_reference).args))
+        if diff:
+            return None, None, "Undefined argument: " + ", ".join(diff)
+
+    return function_reference, arguments, None
+
+def operation_server(arguments):
+    for arg in SERVER_ARGS:
+        if arguments.get(arg):
+            return arguments[arg]
+    return None
+
+def run_operation(function_reference, arguments):
+    try:
+        result = function_reference(**arguments)
+    except Exception as ex:
+        return { "result" : "FAIL", "details" : "error running operation: %s" % repr(ex) }
+    if isinstance(result, dict) and "result" in result:
+        return result
+    return { "result" : "SUCCESS", "details" : result }
+
+def run_batch(operations, parallel=False, stop_on_error=False, cluster=None):
+    # runs a list of checked operations, each of which is
+    # (index, function_reference, arguments).  server data
+    # is written once at the end rather than after each one.
+    # in parallel mode, operations on different servers run
+    # at the same time, while those on the same server run in
+    # order; if any operation doesn't name a server, the whole
+    # batch runs in order.  the groups share the cluster's
+    # HandyRep, whose status changes and writes are serialized
+    # by its state_lock.  cluster is the cluster the batch is
+    # for, which threads need to be told
+    results = {}
+    servers = [ operation_server(arguments) for index, function_reference, arguments in operations ]
+    if parallel and operations and all(servers):
+        groups = {}
+        for operation, server in zip(operations, servers):
+            groups.setdefault(server, []).append(operation)
+        pending = []
+        threads = [ Thread(target=run_group, args=(group, stop_on_error, results, pending, False, cluster))
+            for group in groups.itervalues() ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if any(pending):
+            hrdf.cur_hr().write_servers()
+    else:
+        run_group(operations, stop_on_error, results, [], True, cluster)
+    return results
+
+def run_group(operations, stop_on_error, results, pending, write=False, cluster=None):
+    # runs operations in order, deferring writes.  if write is
+    # False, notes in pending whether a write is needed instead
+    with hrdf.using_cluster(cluster) as clusterhr:
+        clusterhr.defer_writes()
+        try:
+            for index, function_reference, arguments in operations:
+                results[index] = run_operation(function_reference, arguments)
+                if stop_on_error and results[index]["result"] != "SUCCESS":
+                    break
+        finally:
+            pending.append(clusterhr.end_deferred_writes(write))
@@ -1,16 +1,54 @@
 from handyrep import HandyRep
+from lib.config import ReadConfig
+from lib.error import CustomError
+from lib.metrics import REGISTRY, STARTUP_SECONDS, in_cluster
 import os
 import sys
 import json
 import re
+import glob
+import threading
+import time
+
+# HandyRep instances for the clusters managed by this daemon,
+# by cluster_name.  requests which don't name a cluster go to
+# the default cluster, the first one loaded
+clusters = {}
+default_cluster = None
+# cluster label for each cluster's metrics, None if
+# there's only one cluster
+metrics_labels = {}
+# cluster for the request or periodic task in this thread
+request_cluster = threading.local()
+# epoch time the daemon reached each stage of startup,
+# for get_startup_info and the startup metrics
+startup_times = {}
 
 # startup function
 
-def startup_hr():
+def config_files(hrloc):
+    # the config file location can be a single config file,
+    # a comma-separated list of them, or a directory of
+    # .conf files, one for each cluster
+    if os.path.isdir(hrloc):
+        return sorted(glob.glob(os.path.join(hrloc, "*.conf")))
+    else:
+        return [ conffile.strip() for conffile in hrloc.split(",") if conffile.strip() ]
+
+def config_cluster_name(conffile):
+    # cluster_name from a config file before it's loaded,
+    # so that metrics recorded during startup are labelled
+    try:
+        return ReadConfig(conffile).plainread()["handyrep"]["cluster_name"]
+    except Exception:
+        return None
+
+def startup_hr(staged=False):
+    # if staged, each cluster starts from its servers file,
+    # and finish_startup must be called for each.
     # get handyrep config location.  if not set,
     # default is in the local directory, which is almost never right
     # try argv
-    global hr
     if len(sys.argv) > 1:
         hrloc = sys.argv[1]
     else:
@@ -21,9 +59,83 @@ def startup_hr():
         # need to go to handyrep base directory without relying on CWD
         # since CWD doesn't exist in webserver context
         hrloc = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),"handyrep.conf")
-    hr = HandyRep(hrloc)
+    conffiles = config_files(hrloc)
+    if not conffiles:
+        raise CustomError("STARTUP", "no HandyRep config files found at %s" % hrloc)
+    multi = len(conffiles) > 1
+    for conffile in conffiles:
+        # label metrics by cluster only if there's more than one
+        with in_cluster(config_cluster_name(conffile) if multi else None):
+            add_cluster(HandyRep(conffile, staged), multi)
+    return True
+
+def finish_startup(name):
+    # syncs and verifies one cluster after a staged startup
+    with using_cluster(name) as clusterhr:
+        result = clusterhr.finish_startup()
+        started = startup_times.get("process_started", clusterhr.startup_times["started"])
+        for stage in ("synced", "verified"):
+            if stage in clusterhr.startup_times:
+                STARTUP_SECONDS.set(clusterhr.startup_times[stage] - started, stage=stage)
+    return result
+
+def record_startup(stage, when=None):
+    # records when the daemon reached a stage of startup
+    startup_times[stage] = when or time.time()
+    if "process_started" in startup_times:
+        STARTUP_SECONDS.set(startup_times[stage] - startup_times["process_started"], stage=stage)
     return True
 
+def wait_for_startup():
+    # waits for the current cluster to finish syncing at
+    # startup, up to startup_wait seconds.  returns whether
+    # it has
+    clusterhr = cur_hr()
+    if clusterhr.startup_stage == "failed":
+        return False
+    return clusterhr.synced.wait(clusterhr.conf["handyrep"]["startup_wait"])
+
+def add_cluster(newhr, labelled=False):
+    # registers a HandyRep instance under its cluster_name.
+    # if labelled, its metrics carry a cluster label
+    global default_cluster
+    name = newhr.conf["handyrep"]["cluster_name"]
+    if name in clusters and clusters[name] is not newhr:
+        raise CustomError("STARTUP", "more than one cluster is named %s" % name)
+    metrics_labels[name] = name if labelled else None
+    clusters[name] = newhr
+    if default_cluster is None:
+        default_cluster = name
+    return name
+
+def cur_hr():
+    # the HandyRep instance for the current request
+    return clusters[getattr(request_cluster, "name", None) or default_cluster]
+
+class using_cluster(object):
+    # context manager which directs everything this thread
+    # does to the named cluster, or to the default cluster
+    # if name is None.  raises KeyError for unknown clusters
+    def __init__(self, name):
+        self.name = name or default_cluster
+        if self.name not in clusters:
+            raise KeyError(self.name)
+        self.metrics = in_cluster(metrics_labels[self.name])
+
+    def __enter__(self):
+        self.previous = getattr(request_cluster, "name", None)
+        request_cluster.name = self.name
+        self.metrics.__enter__()
+        return clusters[self.name]
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.metrics.__exit__(exc_type, exc_value, tb)
+        request_cluster.name = self.previous
+        return False
+
+def cluster_names():
+    return sorted(clusters.keys())
+
 # invokable functions
 
 # helper function to interpret string True values
@@ -45,101 +157,114 @@ def is_false(bolval):
         else:
             return False
 
+# helper function for optional max_age arguments, in seconds
+def max_age_seconds(max_age):
+    if max_age is None or max_age == "":
+        return None
+    else:
+        return float(max_age)
+
 def read_log(numlines=20):
     nlines = int(numlines)
-    return hr.read_log(nlines)
+    return cur_hr().read_log(nlines)
 
 def set_verbose(verbose="True"):
     vbs = is_true(verbose)
-    return hr.set_verbose(vbs)
+    return cur_hr().set_verbose(vbs)
 
 def get_setting(category="handyrep", setting=None):
     if not setting:
         return { "result" : "FAIL",
             "details" : "setting name is required" }
     else:
-        return json.dumps(hr.get_setting([category, setting,]))
+        return json.dumps(cur_hr().get_setting([category, setting,]))
 
 def verify_all():
-    return hr.verify_all()
+    return cur_hr().verify_all()
 
 def verify_server(servername):
-    return hr.verify_server(servername)
+    return cur_hr().verify_server(servername)
 
 def reload_conf(config_file=None):
-    return hr.reload_conf(config_file)
+    return cur_hr().reload_conf(config_file)
 
 def get_master_name():
-    return json.dumps(hr.get_master_name())
+    return json.dumps(cur_hr().get_master_name())
 
 def poll(servername=None):
     if not servername:
         return { "result" : "FAIL",
             "details" : "server name required" }
     else:
-        return hr.poll(servername)
+        return cur_hr().poll(servername)
 
 def poll_all():
-    return hr.poll_all()
+    return cur_hr().poll_all()
 
 def poll_master():
-    return hr.poll_master()
+    return cur_hr().poll_master()
 
-def get_status(check_type="cached"):
-    return hr.get_status(check_type)
+def get_status(check_type="cached", max_age=None):
+    return cur_hr().get_status(check_type, max_age_seconds(max_age))
 
-def get_server_info(servername=None, verify="False"):
+def get_server_info(servername=None, verify="False", max_age=None):
     vfy = is_true(verify)
-    return hr.get_server_info(servername, vfy)
+    return cur_hr().get_server_info(servername, vfy, max_age_seconds(max_age))
+
+def get_dashboard(servername=None, max_age=None):
+    return cur_hr().get_dashboard(servername, max_age_seconds(max_age))
+
+def get_master_view(servername=None):
+    return cur_hr().get_master_view(servername)
 
 def get_servers_by_role(serverrole="replica",verify="False"):
     vfy = is_true(verify)
-    return hr.get_servers_by_role(serverrole, vfy)
+    return cur_hr().get_servers_by_role(serverrole, vfy)
 
-def get_cluster_status(verify="False"):
+def get_cluster_status(verify="False", max_age=None):
     vfy = is_true(verify)
-    return hr.get_cluster_status(vfy)
+    return cur_hr().get_cluster_status(vfy, max_age_seconds(max_age))
 
 def restart_master(whichmaster=None):
-    return hr.restart_master(whichmaster)
+    return cur_hr().restart_master(whichmaster)
 
 def manual_failover(newmaster=None, remaster=None):
-    return hr.manual_failover(newmaster, remaster)
+    return cur_hr().manual_failover(newmaster, remaster)
 
 def shutdown(servername=None):
     if not servername:
         return { "result" : "ERROR",
             "details" : "server name is required" }
     else:
-        return hr.shutdown(servername)
+        return cur_hr().shutdown(servername)
 
 def startup(servername=None):
     if not servername:
         return { "result" : "FAIL",
             "details" : "server name is required" }
     else:
-        return hr.startup(servername)
+        return cur_hr().startup(servername)
 
 def restart(servername=None):
     if not servername:
         return { "result" : "FAIL",
             "details" : "server name is required" }
     else:
-        return hr.restart(servername)
+        return cur_hr().restart(servername)
 
 def promote(newmaster):
     if not newmaster:
         return { "result" : "FAIL",
             "details" : "new master name is required" }
     else:
-        return hr.promote(newmaster)
+        return cur_hr().promote(newmaster)
 
 def remaster(replicaserver=None, newmaster=None):
     if not replicaserver:
         return { "result" : "FAIL",
             "details" : "replica name is required" }
     else:
-        return hr.remaster(replicaserver, newmaster)
+        return cur_hr().remaster(replicaserver, newmaster)
 
 # dumb simple string-to-type kwargs converter for add_server and alter_server_def
 # only supports strings, integers and booleans.
@@ -165,7 +290,7 @@ def add_server(servername=None, **kwargs):
             "details" : "server name is required" }
     else:
         margs = map_server_args(kwargs)
-        return hr.add_server(servername, **margs)
+        return cur_hr().add_server(servername, **margs)
 
 def clone(replicaserver=None,reclone="False",clonefrom=None):
     recl = is_true(reclone)
@@ -173,28 +298,28 @@ def clone(replicaserver=None,reclone="False",clonefrom=None):
         return { "result" : "FAIL",
             "details" : "replica name is required" }
     else:
-        return hr.clone(replicaserver, recl, clonefrom)
+        return cur_hr().clone(replicaserver, recl, clonefrom)
 
 def disable(servername):
     if not servername:
         return { "result" : "FAIL",
             "details" : "server name is required" }
     else:
-        return hr.disable(servername)
+        return cur_hr().disable(servername)
 
 def enable(servername):
     if not servername:
         return { "result" : "FAIL",
             "details" : "server name is required" }
     else:
-        return hr.enable(servername)
+        return cur_hr().enable(servername)
 
 def remove(servername):
     if not servername:
         return { "result" : "FAIL",
             "details" : "server name is required" }
     else:
-        return hr.remove(servername)
+        return cur_hr().remove(servername)
 
 def add_server(servername, **serverprops):
     if not servername:
@@ -202,7 +327,7 @@ def add_server(servername, **serverprops):
             "details" : "server name is required" }
     else:
         margs = map_server_args(serverprops)
-        return hr.add_server(servername, **margs)
+        return cur_hr().add_server(servername, **margs)
 
 def alter_server_def(servername, **serverprops):
     if not servername:
@@ -210,34 +335,71 @@ def alter_server_def(servername, **serverprops):
             "details" : "server name is required" }
     else:
         margs = map_server_args(serverprops)
-        return hr.alter_server_def(servername, **margs)
+        return cur_hr().alter_server_def(servername, **margs)
 
 def connection_failover(newmaster=None):
     if not newmaster:
         return { "result" : "FAIL",
             "details" : "new master name required" }
     else:
-        return hr.connection_failover(newmaster)
+        return cur_hr().connection_failover(newmaster)
 
 def connection_proxy_init():
-    return hr.connection_proxy_init()
+    return cur_hr().connection_proxy_init()
 
 def start_archiving():
-    return hr.start_archiving()
+    return cur_hr().start_archiving()
 
 def stop_archiving():
-    return hr.stop_archiving()
+    return cur_hr().stop_archiving()
 
 def cleanup_archive():
-    return hr.cleanup_archive()
+    return cur_hr().cleanup_archive()
+
+def get_archive_status():
+    return cur_hr().get_archive_status()
+
+def get_metrics():
+    # metrics for all clusters, each labelled by cluster
+    # if there's more than one
+    for name in cluster_names():
+        with using_cluster(name) as clusterhr:
+            clusterhr.update_metrics()
+    return REGISTRY.exposition()
+
+def get_startup_info():
+    started = startup_times.get("process_started")
+    return { "daemon" : dict((stage, round(stagetime - started, 3))
+            for stage, stagetime in startup_times.iteritems() if started and stage != "process_started"),
+        "clusters" : dict((name, clusters[name].get_startup_info()) for name in cluster_names()) }
+
+def get_clusters():
+    return dict((name, { "default" : name == default_cluster,
+        "status" : clusters[name].status["status"],
+        "status_message" : clusters[name].status["status_message"] })
+        for name in cluster_names())
+
+def get_traces(limit=20, name=None):
+    return cur_hr().get_traces(int(limit), name)
+
+def get_failover_history(limit=None):
+    if limit:
+        limit = int(limit)
+    return cur_hr().get_failover_history(limit)
+
+def get_changes(since=0, timeout=0):
+    return cur_hr().get_changes(int(since), float(timeout))
 
 # periodic
 
 def failover_check(pollno=None):
-    return hr.failover_check_cycle(pollno)
+    return cur_hr().failover_check_cycle(pollno)
+
+def archive_check(pollno=None):
+    return cur_hr().archive_check_cycle(pollno)
 
 
 # authentication
 
 def authenticate(username, userpass, funcname):
-    return hr.authenticate_bool(username, userpass, funcname)
+    return cur_hr().authenticate_bool(username, userpass, funcname)
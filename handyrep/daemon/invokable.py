@@ -30,17 +30,23 @@ def poll_all():
 def poll_master():
     return hrdf.poll_master()
 
-def get_status(check_type="cached"):
-    return hrdf.get_status(check_type)
+def get_status(check_type="cached", max_age=None):
+    return hrdf.get_status(check_type, max_age)
 
-def get_server_info(servername=None, verify="False"):
-    return hrdf.get_server_info(servername, verify)
+def get_server_info(servername=None, verify="False", max_age=None):
+    return hrdf.get_server_info(servername, verify, max_age)
+
+def get_dashboard(servername=None, max_age=None):
+    return hrdf.get_dashboard(servername, max_age)
+
+def get_master_view(servername=None):
+    return hrdf.get_master_view(servername)
 
 def get_servers_by_role(serverrole="replica",verify="False"):
     return hrdf.get_servers_by_role(serverrole, verify)
 
-def get_cluster_status(verify="False"):
-    return hrdf.get_cluster_status(verify)
+def get_cluster_status(verify="False", max_age=None):
+    return hrdf.get_cluster_status(verify, max_age)
 
 def restart_master(whichmaster=None):
     return hrdf.restart_master(whichmaster)
@@ -96,6 +102,24 @@ def stop_archiving():
 def cleanup_archive():
     return hrdf.cleanup_archive()
 
+def get_archive_status():
+    return hrdf.get_archive_status()
+
+def get_traces(limit=20, name=None):
+    return hrdf.get_traces(limit, name)
+
+def get_failover_history(limit=None):
+    return hrdf.get_failover_history(limit)
+
+def get_changes(since=0, timeout=0):
+    return hrdf.get_changes(since, timeout)
+
+def get_clusters():
+    return hrdf.get_clusters()
+
+def get_startup_info():
+    return hrdf.get_startup_info()
+
 INVOKABLE = {
     "read_log" : read_log,
     "get_setting" : get_setting,
@@ -110,6 +134,8 @@ INVOKABLE = {
     "get_status" : get_status,
     "get_server_info" : get_server_info,
     "get_servers_by_role" : get_servers_by_role,
+    "get_dashboard" : get_dashboard,
+    "get_master_view" : get_master_view,
     "get_cluster_status" : get_cluster_status,
     "restart_master" : restart_master,
     "manual_failover" : manual_failover,
@@ -129,6 +155,20 @@ INVOKABLE = {
     "connection_proxy_init" : connection_proxy_init,
     "start_archiving" : start_archiving,
     "stop_archiving" : stop_archiving,
-    "cleanup_archive" : cleanup_archive
+    "cleanup_archive" : cleanup_archive,
+    "get_archive_status" : get_archive_status,
+    "get_traces" : get_traces,
+    "get_failover_history" : get_failover_history,
+    "get_changes" : get_changes,
+    "get_clusters" : get_clusters,
+    "get_startup_info" : get_startup_info
 }
 
+# functions which can answer from the state loaded from the
+# servers file while a cluster is still syncing at startup.
+# everything else waits for the sync to finish
+CACHED_OK = set([ "read_log", "get_setting", "set_verbose", "get_master_name",
+    "get_status", "get_server_info", "get_servers_by_role", "get_dashboard",
+    "get_master_view", "get_cluster_status", "get_archive_status", "get_traces",
+    "get_failover_history", "get_changes", "get_clusters", "get_startup_info" ])
+
@@ -1,4 +1,5 @@
 import daemon.daemonfunctions as hrdf
+from lib.misc_utils import exstr
 
 def failover_check(poll_cycle):
     if poll_cycle is None:
@@ -18,6 +19,18 @@ def failover_check(poll_cycle):
 
     return pollresult
 
+def archive_check(poll_cycle):
+    # archive polling and cleanup run in their own thread
+    # so they can't delay failover_check
+    # errors go to the cluster's log and alerts, as other
+    # archive check failures do
+    try:
+        return hrdf.archive_check(poll_cycle)
+    except Exception as e:
+        hrdf.cur_hr().log("ARCHIVE", "archive check encountered error: %s" % exstr(e), True, "WARNING")
+        return 60, poll_cycle
+
 PERIODIC = {
     'failover_check': failover_check,
+    'archive_check': archive_check,
 }
@@ -0,0 +1,104 @@
+import heapq
+import os
+from threading import Thread, Condition, Lock
+import time
+
+import daemon.daemonfunctions as hrdf
+from daemon.periodic import PERIODIC
+
+# most threads shared by all clusters for running periodic
+# functions, unless set by HANDYREP_SCHEDULER_THREADS
+DEFAULT_THREADS = 8
+
+# periodic functions which get a thread of their own for
+# each cluster, rather than using the shared threads, so
+# that they never wait behind another cluster's jobs
+OWN_LANE = ("failover_check",)
+
+class JobQueue(object):
+    # jobs waiting to run, in order of when they are due,
+    # and the threads which run them
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        # heap of (due time, sequence, func_name, cluster, argument)
+        self.queue = []
+        self.seq = 0
+        self.ready = Condition()
+
+    def push(self, due, func_name, cluster, argument):
+        with self.ready:
+            self.seq += 1
+            heapq.heappush(self.queue, (due, self.seq, func_name, cluster, argument))
+            self.ready.notify()
+
+    def start(self, threads):
+        for i in range(threads):
+            t = Thread(target=self.work)
+            t.daemon = True
+            t.start()
+
+    def next_job(self):
+        with self.ready:
+            while True:
+                now = time.time()
+                if self.queue and self.queue[0][0] <= now:
+                    return heapq.heappop(self.queue)
+                if self.queue:
+                    self.ready.wait(self.queue[0][0] - now)
+                else:
+                    self.ready.wait(60)
+
+    def work(self):
+        while True:
+            due, seq, func_name, cluster, argument = self.next_job()
+            with hrdf.using_cluster(cluster):
+                result = PERIODIC[func_name](argument)
+
+            if result is None or type(result) is not tuple or len(result) != 2:
+                print func_name, "for", cluster, "exiting with return", result
+                continue
+
+            self.scheduler.add(func_name, cluster, result[1], time.time() + max(int(result[0]), 0))
+
+class Scheduler(object):
+    # runs each periodic function for each cluster, on the
+    # schedule the function returns.  the functions in OWN_LANE
+    # run in a thread per cluster; all other functions share a
+    # pool of threads.  jobs in the shared pool can delay each
+    # other, across clusters, when they are all busy, so they
+    # must not block for long: archive_check returns at once
+    # and leaves the archive work to its own thread
+
+    def __init__(self, threads=None):
+        self.threads = threads or int(os.getenv("HANDYREP_SCHEDULER_THREADS", 0)) or None
+        self.shared = JobQueue(self)
+        # JobQueue for each (func_name, cluster) in OWN_LANE
+        self.lanes = {}
+        self.lanes_lock = Lock()
+
+    def add(self, func_name, cluster, argument=None, due=None):
+        self.job_queue(func_name, cluster).push(due or time.time(), func_name, cluster, argument)
+
+    def job_queue(self, func_name, cluster):
+        # the queue for a job, starting the thread
+        # for its lane the first time it's needed
+        if func_name not in OWN_LANE:
+            return self.shared
+        with self.lanes_lock:
+            if (func_name, cluster) not in self.lanes:
+                lane = JobQueue(self)
+                lane.start(1)
+                self.lanes[(func_name, cluster)] = lane
+            return self.lanes[(func_name, cluster)]
+
+    def start(self, jobs=None):
+        # starts the shared threads.  jobs is how many jobs
+        # there will be in the shared pool, if they haven't
+        # all been added yet
+        self.shared.start(min(self.threads or DEFAULT_THREADS, max(jobs or len(self.shared.queue), 1)))
+
+def shared_jobs(clusters):
+    # how many jobs will use the shared threads
+    # when running the periodic functions of clusters
+    return clusters * len([ func_name for func_name in PERIODIC.keys() if func_name not in OWN_LANE ])
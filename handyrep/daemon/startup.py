@@ -2,5 +2,7 @@ import daemon.daemonfunctions as hrdf
 
 def startup():
     print "startup was run"
-    hrdf.startup_hr()
+    # clusters start from their saved state, and
+    # hdaemon.start finishes their startup in the background
+    hrdf.startup_hr(True)
     return True
\ No newline at end of file
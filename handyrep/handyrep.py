@@ -1,25 +1,68 @@
-from fabric.api import execute, sudo, run, env, task, local, settings
-from fabric.network import disconnect_all
-from fabric.contrib.files import upload_template
+from lib.lazyimport import lazy_module
 from lib.config import ReadConfig
 from lib.error import CustomError
 from lib.dbfunctions import get_one_val, get_one_row, execute_it
 import json
+import hashlib
 from datetime import datetime, timedelta
 import logging
 import time
 import importlib
 from plugins.failplugin import failplugin
 from lib.misc_utils import ts_string, string_ts, now_string, succeeded, failed, return_dict, exstr, get_nested_val, notnone, notfalse, lock_fabric, fabric_unlock_all
+from lib.tracing import trace_methods, untraced, operation
+from lib.timeline import FailoverTimeline
+from lib.singleflight import SingleFlight
+from lib.changefeed import ChangeFeed
+from lib.serverfile import ServerFile
+from lib.sshcommand import ssh_command, SSH_FAILED
+from lib.hashring import HashRing
+from lib.failuredetector import FailureDetector
+import lib.tracing as tracing
+from lib.metrics import REGISTRY, PROBE_SECONDS, FAILOVER_CHECK_SECONDS, WRITE_SERVERS_SECONDS, WRITE_SERVERS_TOTAL, SSH_SECONDS, DB_CONNECT_SECONDS, REPLICATION_LAG, FAILURE_SUSPICION, SERVER_STATUS, CLUSTER_STATUS, STATUS_TRANSITIONS, result_label, timed_plugin, with_cluster
 import psycopg2
 import psycopg2.extensions
 import os
 import sys
-
+import threading
+import socket
+import base64
+import urllib
+import urllib2
+
+# fabric is slow to import, and isn't needed until
+# the first ssh command, so is imported then
+fabric_api = lazy_module("fabric.api")
+fabric_network = lazy_module("fabric.network")
+fabric_files = lazy_module("fabric.contrib.files")
+
+# server fields which change with each check rather than with
+# configuration.  these are saved in the status row on every
+# write, not with the server settings
+SERVER_STATUS_FIELDS = ["status", "status_no", "status_ts", "status_message",
+    "lag", "load_stats", "clone_progress"]
+
+# times write_server_data merges its changes into newer state
+# written by another HandyRep and retries, before giving up
+WRITE_CONFLICT_RETRIES = 3
+
+# seconds before retrying a failed startup sync, doubling
+# after each failure up to STARTUP_RETRY_MAX
+STARTUP_RETRY_MIN = 5
+STARTUP_RETRY_MAX = 300
+
+# all public methods are traced, except for those
+# marked untraced.  the traces of those marked operation
+# are kept apart from API calls
+@trace_methods
 class HandyRep(object):
 
-    def __init__(self,config_file='handyrep.conf'):
-        # read and validate the config file
+    def __init__(self,config_file='handyrep.conf', staged=False):
+        # read and validate the config file.  if staged, loads
+        # the last saved state from servers.save without
+        # contacting any servers, and finish_startup must be
+        # called to sync with the database
+        starttime = time.time()
         config = ReadConfig(config_file)
         # get the absolute location of -validate.conf
         # in order to support web services execution
@@ -37,6 +80,20 @@ class HandyRep(object):
           opts['filename'] = self.conf["handyrep"]["log_file"]
         try:
             logging.basicConfig(**opts)
+            # HandyRep's own log messages go to this cluster's log,
+            # even when hdaemon manages several clusters.  plugins
+            # log to the first one configured
+            self.logger = logging.getLogger("handyrep.%s" % self.conf["handyrep"]["cluster_name"])
+            for oldhandler in list(self.logger.handlers):
+                self.logger.removeHandler(oldhandler)
+                oldhandler.close()
+            if "stream" in opts:
+                handler = logging.StreamHandler(opts["stream"])
+            else:
+                handler = logging.FileHandler(opts["filename"])
+            handler.setFormatter(logging.Formatter(opts["format"], opts["datefmt"]))
+            self.logger.addHandler(handler)
+            self.logger.propagate = False
         except Exception as ex:
             raise CustomError("STARTUP","unable to open designated log file: %s" % exstr(ex))
         # initialize log stack
@@ -48,15 +105,84 @@ class HandyRep(object):
         self.log_stack = [initmsg,]
         self.servers = {}
         self.tabname = """ "%s"."%s" """ % (self.conf["handyrep"]["handyrep_schema"],self.conf["handyrep"]["handyrep_table"],)
+        # frequently updated status row, and status history
+        self.status_tabname = """ "%s"."%s_status" """ % (self.conf["handyrep"]["handyrep_schema"],self.conf["handyrep"]["handyrep_table"],)
+        self.history_tabname = """ "%s"."%s_history" """ % (self.conf["handyrep"]["handyrep_schema"],self.conf["handyrep"]["handyrep_table"],)
+        # HandyRep nodes and their poll results, for sharded polling
+        self.nodes_tabname = """ "%s"."%s_nodes" """ % (self.conf["handyrep"]["handyrep_schema"],self.conf["handyrep"]["handyrep_table"],)
+        self.probes_tabname = """ "%s"."%s_probes" """ % (self.conf["handyrep"]["handyrep_schema"],self.conf["handyrep"]["handyrep_table"],)
         self.status = { "status": "unknown",
             "status_no" : 0,
             "pid" : os.getpid(),
             "status_message" : "status not checked yet",
             "status_ts" : '1970-01-01 00:00:00' }
-        self.sync_config(True)
+        self.archive_status = { "status" : "unknown",
+            "running" : False,
+            "started" : None,
+            "finished" : None,
+            "duration" : None,
+            "poll" : None,
+            "cleanup" : None,
+            "status_message" : "archive not checked yet" }
+        self.archive_thread = None
+        self.archive_started = None
+        self.failover_history = []
+        self.master_down_since = None
+        self.db_checked = False
+        # when each server was last polled and verified,
+        # as epoch times, for status freshness
+        self.status_checked = {}
+        # poll history of each server, for failure detection
+        self.detectors = {}
+        self.status_refresh = SingleFlight()
+        # status changes, for get_changes and /events
+        self.changes = ChangeFeed()
+        # per-thread deferral of write_servers, for batches
+        self.write_deferral = threading.local()
+        # held while changing statuses, adding or removing servers
+        # and writing server data, since the periodic checks, API
+        # requests and parallel batches share this object
+        self.state_lock = threading.RLock()
+        self.serverfile = None
+        # digest of the config, server settings and failovers
+        # last written to the handyrep table, and status changes
+        # waiting to be written to the history table
+        self.db_config_digest = None
+        self.status_history = []
+        self.history_partitioned = False
+        self.history_partitions = set()
+        # version of the shared state in the database which
+        # this node last wrote or read, for compare-and-swap writes
+        # and for keeping standby nodes up to date
+        self.db_version = None
+        self.db_config_version = None
+        # servers and status as they were in the database at
+        # db_version, so that after a write conflict this node's
+        # own changes can be told apart and merged into the newer state
+        self.db_base = None
+        self.node_name = "%s:%d" % (socket.gethostname(), os.getpid(),)
+        # replicas assigned to each node, for sharded polling
+        self.shard_assignment = {}
+        # epoch time each stage of startup was reached, and
+        # whether the startup sync is done; until it is,
+        # write_servers does nothing.  startup_error is why the
+        # last attempt to sync failed, if it did
+        self.startup_times = { "started" : starttime }
+        self.startup_stage = "started"
+        self.startup_error = None
+        self.startup_failures = 0
+        self.synced = threading.Event()
+        self.configure_tracing()
+        if staged:
+            self.load_cached_state()
+        else:
+            self.synced.set()
+            self.sync_config(True)
+            self.startup_stage_done("synced")
         # return a handyrep object
         return None
 
+    @untraced
     def log(self, category, message, iserror=False, alert_type=None):
         logmsg = json.dumps({ "ts" : ts_string(datetime.now()),
             "category" : category,
@@ -64,10 +190,10 @@ class HandyRep(object):
             "iserror" : iserror,
             "alert" : alert_type})
         if iserror:
-            logging.error(logmsg)
+            self.logger.error(logmsg)
         else:
             if self.conf["handyrep"]["log_verbose"]:
-                logging.info(logmsg)
+                self.logger.info(logmsg)
             
         if alert_type:
             self.push_alert(alert_type, category, message)
@@ -76,6 +202,7 @@ class HandyRep(object):
         
         return True
 
+    @untraced
     def push_log_stack(self, logmsg):
         # pushes recent log items onto a stack of 100 messages
         # so that the user can get the log in json format.
@@ -86,6 +213,7 @@ class HandyRep(object):
         self.log_stack.append(logmsg)
         return True
 
+    @untraced
     def return_log(self, success, details, extra = {}):
         if not success:
             self.log("HANDYREP",details, True)
@@ -93,6 +221,7 @@ class HandyRep(object):
             self.log("HANDYREP",details)
         return return_dict(success, details, extra)
 
+    @untraced
     def read_log(self, numlines=20):
         # reads the last N lines of the log
         # reads from the stack if less than 100 lines; otherwise reads
@@ -112,6 +241,7 @@ class HandyRep(object):
             lines = lines[-numlines:]    # Get last 10 lines
         return list(reversed(lines))
 
+    @untraced
     def get_setting(self, setting_name):
         if type(setting_name) is list:
             # prevent getting passwords this way
@@ -123,6 +253,7 @@ class HandyRep(object):
             # if category not supplied, then use "handyrep"
             return get_nested_val(self.conf, "handyrep", "setting_name")
 
+    @untraced
     def set_verbose(self, verbose=True):
         self.conf["handyrep"]["log_verbose"] = verbose
         return verbose
@@ -134,6 +265,7 @@ class HandyRep(object):
         else:
             return return_dict(True,"push alerts are disabled in config")
 
+    @untraced
     def status_no(self, status):
         statdict = { "unknown" : 0,
                     "healthy" : 1,
@@ -143,6 +275,7 @@ class HandyRep(object):
                     "down" : 5 }
         return statdict[status]
 
+    @untraced
     def is_server_failure(self, oldstatus, newstatus):
         # tests old against new status to see if a
         # server has failed
@@ -154,6 +287,7 @@ class HandyRep(object):
                     "down" : [] }
         return newstatus in statdict[oldstatus]
 
+    @untraced
     def is_server_recovery(self, oldstatus, newstatus):
         # tests old against new status to see if a server has
         # recovered
@@ -165,6 +299,7 @@ class HandyRep(object):
                     "down" : ["healthy","lagged","warning",] }
         return newstatus in statdict[oldstatus]
 
+    @untraced
     def clusterstatus(self):
         # compute the cluster status based on
         # the status of the individual servers
@@ -217,70 +352,124 @@ class HandyRep(object):
                     "status_message" : "" }
         
 
+    @untraced
     def status_update(self, servername, newstatus, newmessage=None):
         # function for updating server statuses
         # returns nothing, because we're not going to check it
         # check if server status has changed.
         # if not, update timestamp and exit
-        servconf = self.servers[servername]
-        if servconf["status"] == newstatus:
-            servconf["status_ts"] = now_string()
-            return
-        # if status has changed, log the vector and quantity of change
-        newstatno = self.status_no(newstatus)
-        self.log(servername, "server status changed from %s to %s" % (servconf["status"],newstatus,))
-        if newstatno > servconf["status"]:
-            if self.is_server_recovery(servconf["status"],newstatus):
-                # if it's a recovery, then let's log it
-                self.log("RECOVERY", "server %s has recovered" % servername)
-        else:
-            if self.is_server_failure(servconf["status"],newstatus):
-                self.log("FAILURE", "server %s has failed, details: %s" % (servername, newmessage,), True, "WARNING")
-
-        # then update status for this server
-        servconf.update({ "status" : newstatus,
-                        "status_no": newstatno,
-                        "status_ts" : now_string(),
-                        "status_message" : newmessage })
-                        
-        # compute status for the whole cluster
-        clusterstatus = self.status
-        newcluster = self.clusterstatus()
-        # has cluster status changed?
-        # if so, figure out vector and quantity of change
-        if clusterstatus["status_no"] < newcluster["status_no"]:
-            # we've had a failure, push it
-            if newcluster["status"] == "warning":
-                self.log("STATUS_WARNING", "replication cluster is not fully operational, see logs for details", True, "WARNING")
+        with self.state_lock:
+            servconf = self.servers[servername]
+            if servconf["status"] == newstatus:
+                servconf["status_ts"] = now_string()
+                return
+            # if status has changed, log the vector and quantity of change
+            newstatno = self.status_no(newstatus)
+            STATUS_TRANSITIONS.inc(server=servername, from_status=servconf["status"], to_status=newstatus)
+            self.log(servername, "server status changed from %s to %s" % (servconf["status"],newstatus,))
+            if newstatno > servconf["status"]:
+                if self.is_server_recovery(servconf["status"],newstatus):
+                    # if it's a recovery, then let's log it
+                    self.log("RECOVERY", "server %s has recovered" % servername)
             else:
-                self.log("CLUSTER_DOWN", "database replication cluster is DOWN", True, "CRITICAL")
-        elif clusterstatus["status_no"] > newcluster["status_no"]:
-            self.log("RECOVERY", "database replication cluster has recovered to status %s" % newcluster["status"])
-            
-        self.status = newcluster
-        self.write_servers()
-        return
+                if self.is_server_failure(servconf["status"],newstatus):
+                    self.log("FAILURE", "server %s has failed, details: %s" % (servername, newmessage,), True, "WARNING")
+
+            # then update status for this server
+            servconf.update({ "status" : newstatus,
+                            "status_no": newstatno,
+                            "status_ts" : now_string(),
+                            "status_message" : newmessage })
+            self.publish_server_change(servername)
+            self.record_status_history(servername, servconf)
+                        
+            # compute status for the whole cluster
+            clusterstatus = self.status
+            newcluster = self.clusterstatus()
+            # has cluster status changed?
+            # if so, figure out vector and quantity of change
+            if clusterstatus["status_no"] < newcluster["status_no"]:
+                # we've had a failure, push it
+                if newcluster["status"] == "warning":
+                    self.log("STATUS_WARNING", "replication cluster is not fully operational, see logs for details", True, "WARNING")
+                else:
+                    self.log("CLUSTER_DOWN", "database replication cluster is DOWN", True, "CRITICAL")
+            elif clusterstatus["status_no"] > newcluster["status_no"]:
+                self.log("RECOVERY", "database replication cluster has recovered to status %s" % newcluster["status"])
+
+            if clusterstatus["status"] != newcluster["status"]:
+                STATUS_TRANSITIONS.inc(server="cluster", from_status=clusterstatus["status"], to_status=newcluster["status"])
+            self.status = newcluster
+            if clusterstatus["status"] != newcluster["status"] or clusterstatus["status_message"] != newcluster["status_message"]:
+                self.publish_cluster_change()
+            self.write_servers()
+            return
 
+    @untraced
     def no_master_status(self):
         # called when we suddenly find that there's no enabled master
         # available
-        self.status.update({ "status" : "down",
-                    "status_no" : 5,
-                    "status_message" : "no configured and enabled master found",
-                    "status_ts" : now_string()})
-        self.log("CONFIG","No configured and enabled master found", True, "WARNING")
-        return
+        with self.state_lock:
+            if self.status["status"] != "down":
+                STATUS_TRANSITIONS.inc(server="cluster", from_status=self.status["status"], to_status="down")
+            self.status.update({ "status" : "down",
+                        "status_no" : 5,
+                        "status_message" : "no configured and enabled master found",
+                        "status_ts" : now_string()})
+            self.publish_cluster_change()
+            self.log("CONFIG","No configured and enabled master found", True, "WARNING")
+            return
 
+    @untraced
     def cluster_status_update(self, newstatus, newstatus_message=""):
         # called during certain operations
         # such as failover in order to change
-        self.log("STATUS", "cluster status changed to %s: %s", newstatus, newstatus_message)
-        self.status.update({ "status" : newstatus,
-            "status_no" : self.status_no(newstatus),
-            "status_message" : newstatus_message,
-            "status_ts" : now_string() })
-        # don't return anything, we don't check it
-        return
+        with self.state_lock:
+            self.log("STATUS", "cluster status changed to %s: %s" % (newstatus, newstatus_message,))
+            if self.status["status"] != newstatus:
+                STATUS_TRANSITIONS.inc(server="cluster", from_status=self.status["status"], to_status=newstatus)
+            self.status.update({ "status" : newstatus,
+                "status_no" : self.status_no(newstatus),
+                "status_message" : newstatus_message,
+                "status_ts" : now_string() })
+            self.publish_cluster_change()
+            # don't return anything, we don't check it
+            return
+
+    @untraced
+    def publish_server_change(self, servername):
+        # sends a server's new status to the change feed
+        servconf = self.servers[servername]
+        return self.changes.publish("server", servername,
+            dict((k,v) for k,v in servconf.iteritems() if k in ["status","status_no","status_message","status_ts","role","enabled"]))
+
+    @untraced
+    def publish_cluster_change(self):
+        self.record_status_history("cluster", self.status)
+        return self.changes.publish("cluster", "cluster", dict(self.status))
+
+    @untraced
+    def record_status_history(self, servername, statusdict):
+        # queues a status change for the history table.  they are
+        # inserted together at the next write_servers.  if the
+        # database can't be reached for a long time, the oldest
+        # are dropped
+        self.status_history.append((statusdict["status_ts"], servername, statusdict["status"],
+            statusdict["status_no"], statusdict.get("status_message")))
+        if len(self.status_history) > 10000:
+            del self.status_history[0:len(self.status_history) - 10000]
+        return True
+
+    @untraced
+    def get_changes(self, since=0, timeout=0):
+        # returns status changes after sequence number since,
+        # waiting up to timeout seconds for one if there are none.
+        # if reset is True, changes have been missed, and the client
+        # should get the full status again before continuing
+        if timeout > 0:
+            return self.changes.wait(since, min(timeout, 300))
+        else:
+            return self.changes.since(since)
 
     def check_hr_master(self):
         # check plugin method to see
@@ -305,34 +494,49 @@ class HandyRep(object):
             # success otherwise
         return allgood
 
-    def read_serverfile(self):
-        try:
-            servfile = open(self.conf["handyrep"]["server_file"],'r')
-        except:
-            return None
+    @untraced
+    def get_serverfile(self):
+        # the servers.save store, recreated if the
+        # configuration for it has changed
+        path = self.conf["handyrep"]["server_file"]
+        generations = max(self.conf["handyrep"]["server_file_generations"], 1)
+        if not self.serverfile or self.serverfile.path != path or self.serverfile.generations != generations:
+            self.serverfile = ServerFile(path, generations)
+        return self.serverfile
 
-        try:
-            serverdata = json.load(servfile)
-        except:
-            return None
-        else:
-            servfile.close()
-            return serverdata
+    def read_serverfile(self):
+        # returns the newest intact generation of the
+        # servers file, or None if there isn't one
+        serverdata, generation = self.get_serverfile().read()
+        if generation:
+            self.log("FILEERROR","Servers file %s is missing or damaged, using generation %d" % (self.conf["handyrep"]["server_file"], generation,), True)
+        return serverdata
 
     def failwait(self):
         time.sleep(self.conf["failover"]["fail_retry_interval"])
         return
 
+    @untraced
+    def has_table(self, cur, tablename):
+        # checks pg_class rather than pg_stat_user_tables,
+        # which doesn't list partitioned tables
+        return get_one_val(cur, """SELECT count(*) FROM
+            pg_class JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+            WHERE relname = %s and nspname = %s""",[tablename, self.conf["handyrep"]["handyrep_schema"],])
+
     def init_handyrep_db(self):
         # initialize the handrep schema
         # per settings
+        # the handyrep table holds the configuration, server
+        # settings and failover history, and is only updated when
+        # they change.  the _status table holds a single small row
+        # with the cluster and server statuses, which is updated on
+        # every write, and _history has one row per status change
         htable = self.conf["handyrep"]["handyrep_table"]
         hschema = self.conf["handyrep"]["handyrep_schema"]
         mconn = self.master_connection()
         mcur = mconn.cursor()
-        has_tab = get_one_val(mcur, """SELECT count(*) FROM
-            pg_stat_user_tables
-            WHERE relname = %s and schemaname = %s""",[htable, hschema,])
+        has_tab = self.has_table(mcur, htable)
         if not has_tab:
             self.log('DATABASE','No handyrep table found, creating one')
             # need schema test here for 9.2:
@@ -340,8 +544,45 @@ class HandyRep(object):
             if not has_schema:
                 execute_it(mcur, """CREATE SCHEMA "%s" """ % hschema, [])
 
-            execute_it(mcur, """CREATE TABLE %s ( updated timestamptz, config JSON, servers JSON, status JSON, last_ip inet, last_sync timestamptz )""" % self.tabname, [])
-            execute_it(mcur, "INSERT INTO" + self.tabname + " VALUES ( %s, %s, %s, %s, inet_client_addr(), now() )""",(self.status["status_ts"], json.dumps(self.conf), json.dumps(self.servers),json.dumps(self.status),))
+            execute_it(mcur, """CREATE TABLE %s ( updated timestamptz, config JSON, servers JSON, status JSON, last_ip inet, last_sync timestamptz, failovers JSON )""" % self.tabname, [])
+            execute_it(mcur, "INSERT INTO" + self.tabname + " VALUES ( %s, %s, %s, %s, inet_client_addr(), now(), %s )""",(self.status["status_ts"], json.dumps(self.conf), json.dumps(self.servers),json.dumps(self.status),json.dumps(self.failover_history),))
+        else:
+            # tables created by older versions don't have
+            # the failover history column
+            has_failovers = get_one_val(mcur, """SELECT count(*) FROM information_schema.columns
+                WHERE table_schema = %s AND table_name = %s
+                AND column_name = 'failovers'""",[hschema, htable,])
+            if not has_failovers:
+                self.log('DATABASE','Adding failovers column to handyrep table')
+                execute_it(mcur, """ALTER TABLE %s ADD COLUMN failovers JSON""" % self.tabname, [])
+
+        if not self.has_table(mcur, htable + "_status"):
+            self.log('DATABASE','Creating handyrep status table')
+            execute_it(mcur, """CREATE TABLE %s ( updated timestamptz, version bigint NOT NULL DEFAULT 0, config_version bigint NOT NULL DEFAULT 0, status JSON, server_status JSON, writer text, last_ip inet, last_sync timestamptz )""" % self.status_tabname, [])
+
+        # the history table is partitioned by month
+        # on versions which support declarative partitioning
+        self.history_partitioned = get_one_val(mcur, """SELECT current_setting('server_version_num')::int >= 100000""")
+        if not self.has_table(mcur, htable + "_history"):
+            self.log('DATABASE','Creating handyrep status history table')
+            histcols = "( ts timestamptz NOT NULL, server text NOT NULL, status text, status_no int, status_message text )"
+            if self.history_partitioned:
+                execute_it(mcur, """CREATE TABLE %s %s PARTITION BY RANGE ( ts )""" % (self.history_tabname, histcols,), [])
+            else:
+                execute_it(mcur, """CREATE TABLE %s %s""" % (self.history_tabname, histcols,), [])
+                execute_it(mcur, """CREATE INDEX ON %s ( ts )""" % self.history_tabname, [])
+        else:
+            self.history_partitioned = get_one_val(mcur, """SELECT count(*) FROM pg_partitioned_table
+                WHERE partrelid = %s::regclass""", [self.history_tabname.strip(),]) if self.history_partitioned else False
+        self.history_partitions = set()
+
+        if self.conf["handyrep"]["sharded_polling"]:
+            if not self.has_table(mcur, htable + "_nodes"):
+                self.log('DATABASE','Creating handyrep nodes table')
+                execute_it(mcur, """CREATE TABLE %s ( node_name text PRIMARY KEY, is_leader boolean, servers JSON, last_seen timestamptz )""" % self.nodes_tabname, [])
+            if not self.has_table(mcur, htable + "_probes"):
+                self.log('DATABASE','Creating handyrep probes table')
+                execute_it(mcur, """CREATE TABLE %s ( server text PRIMARY KEY, node_name text, result text, details text, probed timestamptz )""" % self.probes_tabname, [])
 
         # done
         mconn.commit()
@@ -393,14 +634,25 @@ class HandyRep(object):
             try:
                 sconn = self.best_connection()
                 scur = sconn.cursor()
-                dbconf = get_one_row(scur,"""SELECT updated, config, servers, status FROM %s """ % self.tabname)
+                dbconf = self.read_handyrep_db(scur)
             except:
                 dbconf = None
                 
             if dbconf:
+                # remember the database version, so that our
+                # writes don't overwrite anyone else's
+                self.db_version, self.db_config_version = dbconf[4], dbconf[5]
+                self.db_base = self.state_snapshot(dbconf[2], dbconf[3])
                 # we have both, check which one is more recent
+                # by version if both have one, otherwise by timestamp
                 if serverdata:
-                    if servfiledate > dbconf[0]:
+                    filever = serverdata.get("version")
+                    if filever is not None and dbconf[4] is not None:
+                        if filever >= dbconf[4]:
+                            use_conf = "file"
+                        else:
+                            use_conf = "db"
+                    elif servfiledate > dbconf[0]:
                         use_conf = "file"
                     elif servfiledate < dbconf[0]:
                         use_conf = "db"
@@ -426,6 +678,7 @@ class HandyRep(object):
             self.servers = serverdata["servers"]
             # set self.status from the file
             self.status = serverdata["status"]
+            self.failover_history = serverdata.get("failovers") or []
             
         elif use_conf == "db":
             self.log("HANDYREP","database table config is latest, using")
@@ -433,6 +686,10 @@ class HandyRep(object):
             self.servers = dbconf[2]
             # set self.status to status field
             self.status = dbconf[3]
+            try:
+                self.failover_history = get_one_val(scur, """SELECT failovers FROM %s """ % self.tabname) or []
+            except:
+                sconn.rollback()
 
         # update the pid
         self.status["pid"] = os.getpid()
@@ -443,6 +700,143 @@ class HandyRep(object):
         # we don't check it
         return
  
+    def load_cached_state(self):
+        # first stage of a staged startup: loads servers and
+        # status from servers.save, or from the config file if
+        # there isn't one, without connecting to anything, so
+        # that the API can answer straight away
+        serverdata = None
+        if not self.conf["handyrep"]["override_server_file"]:
+            serverdata = self.read_serverfile()
+        if serverdata:
+            self.check_pid(serverdata)
+            self.servers = serverdata["servers"]
+            self.status = serverdata["status"]
+            self.failover_history = serverdata.get("failovers") or []
+        else:
+            for server in self.conf["servers"].keys():
+                self.servers[server] = self.merge_server_settings(server)
+            self.status.update(self.clusterstatus())
+        self.status["pid"] = os.getpid()
+        self.log("STARTUP", "Loaded saved state of %d servers, syncing in the background" % len(self.servers))
+        self.startup_stage_done("cached")
+        return True
+
+    def finish_startup(self):
+        # second stage of a staged startup: the full sync
+        # of sync_config, then verification of every server.
+        # runs in the background while the API answers from
+        # the cached state.  if the sync fails it is retried,
+        # backing off, until it succeeds, so this only returns
+        # once the cluster is synced
+        retry = STARTUP_RETRY_MIN
+        while True:
+            try:
+                self.sync_config(False)
+                break
+            except Exception as ex:
+                self.startup_failures += 1
+                self.startup_error = exstr(ex)
+                self.startup_stage_done("failed")
+                # alert on the first failure only, rather than every retry
+                self.log("STARTUP", "Unable to sync configuration at startup, retrying in %d seconds: %s" % (retry, self.startup_error,),
+                    True, "CRITICAL" if self.startup_failures == 1 else None)
+            time.sleep(retry)
+            retry = min(retry * 2, STARTUP_RETRY_MAX)
+
+        if self.startup_failures:
+            self.log("STARTUP", "Configuration synced after %d failed attempts" % self.startup_failures)
+        self.startup_error = None
+        self.synced.set()
+        self.write_servers()
+        self.startup_stage_done("synced")
+        self.verify_all()
+        self.startup_stage_done("verified")
+        return return_dict(True, "startup complete in %.3f seconds" % (time.time() - self.startup_times["started"],))
+
+    def startup_stage_done(self, stage):
+        self.startup_times[stage] = time.time()
+        self.startup_stage = stage
+        return True
+
+    @untraced
+    def get_startup_info(self):
+        # the current stage of startup, and the seconds
+        # after starting that each stage was reached
+        started = self.startup_times["started"]
+        return { "stage" : self.startup_stage,
+            "synced" : self.synced.is_set(),
+            "error" : self.startup_error,
+            "failed_attempts" : self.startup_failures,
+            "started" : ts_string(datetime.fromtimestamp(started)),
+            "stages" : dict((stage, round(stagetime - started, 3))
+                for stage, stagetime in self.startup_times.iteritems() if stage != "started") }
+
+    @untraced
+    def read_handyrep_db(self, scur):
+        # reads the handyrep table, updated with the latest
+        # statuses from the status table if it has them.
+        # returns updated, config, servers and status
+        dbconf = get_one_row(scur,"""SELECT updated, config, servers, status FROM %s """ % self.tabname)
+        if not dbconf:
+            return None
+        updated, dbconfig, servers, status = dbconf
+        version, config_version = None, None
+        if self.has_table(scur, self.conf["handyrep"]["handyrep_table"] + "_status"):
+            hot = get_one_row(scur,"""SELECT updated, status, server_status, version, config_version FROM %s """ % self.status_tabname)
+            if hot:
+                version, config_version = hot[3], hot[4]
+            if hot and hot[0] and (not updated or hot[0] >= updated):
+                updated, status = hot[0], hot[1]
+                for servname, servstatus in (hot[2] or {}).iteritems():
+                    if servname in servers:
+                        servers[servname].update(servstatus)
+        return (updated, dbconfig, servers, status, version, config_version,)
+
+    def refresh_from_db(self, scur=None, force=False):
+        # brings this node's state up to date with the database,
+        # reading only the small status row unless the server
+        # settings have changed.  used by standby HandyReps, so
+        # that they are ready to take over, and after a write
+        # conflict.  does nothing if the version is unchanged
+        sconn = None
+        if not scur:
+            try:
+                sconn = self.best_connection()
+                scur = sconn.cursor()
+            except Exception as ex:
+                return return_dict(False, "unable to connect to read HandyRep state: %s" % exstr(ex))
+        try:
+            hot = get_one_row(scur, """SELECT version, config_version, status, server_status FROM %s
+                WHERE version > %%s """ % self.status_tabname, [-1 if force or self.db_version is None else self.db_version,])
+            if not hot:
+                return return_dict(True, "state is up to date at version %s" % self.db_version)
+            if hot[1] != self.db_config_version:
+                main = get_one_row(scur, """SELECT servers, failovers FROM %s """ % self.tabname)
+                if main:
+                    self.servers = main[0]
+                    self.failover_history = main[1] or []
+                    self.db_config_digest = None
+            self.apply_server_status(hot[3])
+            if hot[2]:
+                self.status = hot[2]
+                self.status["pid"] = os.getpid()
+            self.db_version, self.db_config_version = hot[0], hot[1]
+            self.db_base = self.state_snapshot(self.servers, self.status)
+        finally:
+            if sconn:
+                sconn.close()
+        # keep servers.save current too, so that a restart
+        # doesn't need a full resync
+        try:
+            self.get_serverfile().write({ "servers" : self.servers,
+                "status" : self.status,
+                "failovers" : self.failover_history,
+                "version" : self.db_version })
+        except Exception as ex:
+            self.log("FILEERROR","Unable to sync configuration to servers file: %s" % exstr(ex), True)
+        return return_dict(True, "state updated to version %s" % self.db_version)
+
     def reload_conf(self, config_file=None):
         self.log("HANDYREP","reloading configuration file")
 
@@ -454,26 +848,77 @@ class HandyRep(object):
             self.conf = config.read(validconf)
         except:
             return return_dict(False, 'configuration file could not be loaded, see logs')
-        
+
+        self.configure_tracing()
         return return_dict(True, 'configuration file reloaded')
 
+    @untraced
+    def configure_tracing(self):
+        tracing.configure(self.conf["handyrep"]["trace_history"],
+            self.conf["handyrep"]["trace_otlp_endpoint"],
+            "handyrep-%s" % self.conf["handyrep"]["cluster_name"])
+        return True
+
     def write_servers(self):
+        # write server data to all locations,
+        # recording how long it takes
+        # if this thread is deferring writes, just note
+        # that a write is needed
+        if getattr(self.write_deferral, "depth", 0):
+            self.write_deferral.pending = True
+            return True
+        # during a staged startup, finish_startup writes once
+        # it has synced, so that state loaded from servers.save
+        # can't overwrite newer state in the database
+        if not self.synced.is_set():
+            return True
+        with self.state_lock:
+            with WRITE_SERVERS_SECONDS.time() as timer:
+                written = self.write_server_data()
+                timer.labels["result"] = "success" if written else "fail"
+        WRITE_SERVERS_TOTAL.inc(result=timer.labels["result"])
+        return written
+
+    @untraced
+    def defer_writes(self):
+        # saves up write_servers calls made by this thread
+        # until end_deferred_writes, so that a batch of
+        # operations saves server data only once
+        self.write_deferral.depth = getattr(self.write_deferral, "depth", 0) + 1
+        if self.write_deferral.depth == 1:
+            self.write_deferral.pending = False
+        return True
+
+    @untraced
+    def end_deferred_writes(self, write=True):
+        # ends deferral.  if any writes were deferred, does
+        # one write now, unless write is False, in which case
+        # the caller is responsible for writing.
+        # returns whether a write was needed
+        self.write_deferral.depth = max(getattr(self.write_deferral, "depth", 0) - 1, 0)
+        if self.write_deferral.depth:
+            return False
+        pending = getattr(self.write_deferral, "pending", False)
+        self.write_deferral.pending = False
+        if pending and write:
+            self.write_servers()
+        return pending
+
+    @untraced
+    def write_server_data(self):
     # write server data to all locations
         self.log("CONFIG","writing server config to file and database")
-        # write server data to file
+        # write server data to file.  this is skipped
+        # if nothing has changed since the last write
         try:
-            servfile = open(self.conf["handyrep"]["server_file"],"w")
             servout = { "servers" : self.servers,
-                        "status": self.status }
-            json.dump(servout, servfile)
-        except:
-            self.log("FILEERROR","Unable to sync configuration to servers file due to permissions or configuration error", True)
+                        "status": self.status,
+                        "failovers" : self.failover_history,
+                        "version" : self.db_version }
+            self.get_serverfile().write(servout)
+        except Exception as ex:
+            self.log("FILEERROR","Unable to sync configuration to servers file due to permissions or configuration error: %s" % exstr(ex), True)
             return False
-        finally:
-            try:
-                servfile.close()
-            except:
-                pass
         # if possible, update the table via the master:
         if self.get_master_name():
             try:
@@ -484,26 +929,221 @@ class HandyRep(object):
                 sconn = None
 
             if sconn:
-                dbconf = get_one_row(scur,"""SELECT * FROM %s """ % self.tabname)
-                if dbconf:
+                # make sure the table is up to date the first
+                # time we write to it
+                if not self.db_checked:
                     try:
-                        scur.execute("UPDATE " + self.tabname + """ SET updated = %s,
-                        config = %s, servers = %s, status = %s,
-                        last_ip = inet_client_addr(), last_sync = now()""",(self.status["status_ts"], json.dumps(self.conf), json.dumps(self.servers),json.dumps(self.status),))
+                        self.db_checked = self.init_handyrep_db()
+                    except Exception as ex:
+                        self.log("DBCONN","Unable to check HandyRep table: %s" % exstr(ex), True)
+                conflicts = 0
+                while True:
+                    try:
+                        flushed = self.write_handyrep_tables(scur)
+                        sconn.commit()
+                        break
+                    except CustomError as e:
+                        if e.errortype != "CONFLICT":
+                            raise
+                        # another HandyRep has written newer state.
+                        # merge our changes into it and try again,
+                        # rather than overwriting it or dropping them
+                        sconn.rollback()
+                        conflicts += 1
+                        if conflicts > WRITE_CONFLICT_RETRIES:
+                            sconn.close()
+                            self.log("CONFLICT","%s; unable to save HandyRep state after %d conflicting writes.  Local changes are kept, and will be saved by the next write" % (e.message, conflicts,), True)
+                            return False
+                        self.log("CONFLICT","%s; merging local changes into it" % e.message, True, "WARNING")
+                        try:
+                            merged = self.merge_conflicting_state(scur)
+                        except Exception as ex:
+                            merged = return_dict(False, exstr(ex))
+                        if failed(merged):
+                            sconn.rollback()
+                            sconn.close()
+                            self.log("CONFLICT","Unable to merge local changes into newer HandyRep state, local changes are not saved to the database: %s" % merged["details"], True)
+                            return False
                     except Exception as e:
                             # something else is wrong, abort
                         sconn.close()
+                        self.db_config_digest = None
                         self.log("DBCONN","Unable to write HandyRep table to database for unknown reasons, please fix: %s" % exstr(e), True)
                         return False
-                else:
-                    self.init_handyrep_db()
-                sconn.commit()
+                # these status changes are saved now
+                del self.status_history[0:flushed]
                 sconn.close()
                 return True
         else:
             self.log("CONFIG","Unable to save config, status to database since there is no configured master", True, "WARNING")
             return False
 
+    @untraced
+    def state_snapshot(self, servers, status):
+        # a copy of servers and status which later
+        # changes to them won't affect
+        return json.loads(json.dumps({ "servers" : servers, "status" : status }))
+
+    @untraced
+    def merge_changed_fields(self, current, local, base):
+        # copies the fields which this node changed from base
+        # to local into current.  where the other node changed
+        # a status field too, the later status_ts wins
+        laterlocal = local.get("status_ts") >= current.get("status_ts")
+        for key, val in local.iteritems():
+            if val == base.get(key):
+                continue
+            if key in SERVER_STATUS_FIELDS and current.get(key) != base.get(key) and not laterlocal:
+                continue
+            current[key] = val
+        return True
+
+    def merge_conflicting_state(self, scur):
+        # after a write conflict, reloads the newer state from the
+        # database, and reapplies this node's own changes to it:
+        # the servers and fields which differ from db_base, and
+        # failovers which aren't in the newer history
+        if self.db_base is None:
+            return return_dict(False, "this node has no database state to compare its changes with")
+        base = self.db_base
+        local = self.state_snapshot(self.servers, self.status)
+        localfailovers = list(self.failover_history)
+        refreshed = self.refresh_from_db(scur, True)
+        if failed(refreshed):
+            return refreshed
+
+        merged = []
+        for servname, servdeets in local["servers"].iteritems():
+            if servname not in base["servers"]:
+                # added by this node
+                self.servers[servname] = servdeets
+                merged.append(servname)
+            elif servname in self.servers and servdeets != base["servers"][servname]:
+                self.merge_changed_fields(self.servers[servname], servdeets, base["servers"][servname])
+                merged.append(servname)
+        for servname in base["servers"].keys():
+            if servname not in local["servers"] and servname in self.servers:
+                # removed by this node
+                del self.servers[servname]
+                merged.append(servname)
+        if local["status"] != base["status"]:
+            self.merge_changed_fields(self.status, local["status"], base["status"] or {})
+        self.status["pid"] = os.getpid()
+        for failover in localfailovers:
+            if failover not in self.failover_history:
+                self.failover_history.append(failover)
+
+        self.db_config_digest = None
+        return return_dict(True, "merged changes to servers: %s" % ", ".join(sorted(merged)))
+
+    @untraced
+    def server_status_fields(self):
+        # just the status fields of each server
+        return dict((servname, dict((k,v) for k,v in servdeets.iteritems() if k in SERVER_STATUS_FIELDS))
+            for servname, servdeets in self.servers.iteritems())
+
+    @untraced
+    def apply_server_status(self, server_status):
+        # updates servers with status fields from the status row
+        for servname, servstatus in (server_status or {}).iteritems():
+            if servname in self.servers:
+                self.servers[servname].update(servstatus)
+        return True
+
+    @untraced
+    def write_handyrep_tables(self, scur):
+        # writes status to the small status row on every call,
+        # and the configuration, server settings and failover history
+        # only if they've changed since the last write.
+        # then adds any new status changes to the history.
+        # the status row carries a version, and is only updated if
+        # it still has the version this node last saw, so that two
+        # HandyReps can't overwrite each other's changes; if it has
+        # changed, raises a CONFLICT error.
+        # returns the number of history rows written.
+        # raises on errors; the caller commits
+        server_status = self.server_status_fields()
+        settings = dict((servname, dict((k,v) for k,v in servdeets.iteritems() if k not in SERVER_STATUS_FIELDS))
+            for servname, servdeets in self.servers.iteritems())
+        digest = hashlib.sha1(json.dumps([self.conf, settings, self.failover_history], sort_keys=True)).hexdigest()
+        config_changed = digest != self.db_config_digest
+
+        statusupdate = "UPDATE " + self.status_tabname + """ SET updated = %s,
+            version = version + 1, config_version = config_version + %s,
+            status = %s, server_status = %s, writer = %s,
+            last_ip = inet_client_addr(), last_sync = now()"""
+        statusparams = [self.status["status_ts"], 1 if config_changed else 0, json.dumps(self.status), json.dumps(server_status), self.node_name]
+        if self.db_version is None:
+            scur.execute(statusupdate + " RETURNING version, config_version", statusparams)
+        else:
+            scur.execute(statusupdate + " WHERE version = %s RETURNING version, config_version", statusparams + [self.db_version,])
+        versions = scur.fetchone()
+        if not versions:
+            current = get_one_row(scur, """SELECT version, writer FROM %s """ % self.status_tabname)
+            if current:
+                raise CustomError("CONFLICT", "HandyRep state was changed by %s (version %s, expected %s)" % (current[1], current[0], self.db_version,))
+            scur.execute("INSERT INTO " + self.status_tabname + """ ( updated, version, config_version, status, server_status, writer, last_ip, last_sync )
+                VALUES ( %s, 1, 1, %s, %s, %s, inet_client_addr(), now() ) RETURNING version, config_version""",(self.status["status_ts"], json.dumps(self.status), json.dumps(server_status), self.node_name,))
+            versions = scur.fetchone()
+            config_changed = True
+
+        if config_changed:
+            scur.execute("UPDATE " + self.tabname + """ SET updated = %s,
+                config = %s, servers = %s, status = %s, failovers = %s,
+                last_ip = inet_client_addr(), last_sync = now()""",(self.status["status_ts"], json.dumps(self.conf), json.dumps(self.servers),json.dumps(self.status),json.dumps(self.failover_history),))
+            if scur.rowcount == 0:
+                scur.execute("INSERT INTO" + self.tabname + " VALUES ( %s, %s, %s, %s, inet_client_addr(), now(), %s )""",(self.status["status_ts"], json.dumps(self.conf), json.dumps(self.servers),json.dumps(self.status),json.dumps(self.failover_history),))
+            self.db_config_digest = digest
+
+        self.db_version, self.db_config_version = versions
+        self.db_base = self.state_snapshot(self.servers, self.status)
+        return self.flush_status_history(scur)
+
+    @untraced
+    def flush_status_history(self, scur):
+        # inserts all queued status changes in one statement
+        changes = self.status_history[:]
+        if not changes:
+            return 0
+        if self.history_partitioned:
+            for month in set([ change[0][0:7] for change in changes ]):
+                self.ensure_history_partition(scur, month)
+        values = ", ".join([ "( %s, %s, %s, %s, %s )" ] * len(changes))
+        params = [ val for change in changes for val in change ]
+        scur.execute("INSERT INTO " + self.history_tabname + """ ( ts, server, status, status_no, status_message )
+            VALUES """ + values, params)
+        return len(changes)
+
+    @untraced
+    def ensure_history_partition(self, scur, month):
+        # creates the history partition for a month, given as
+        # YYYY-MM, and drops partitions older than
+        # status_history_months
+        if month in self.history_partitions:
+            return False
+        start = datetime.strptime(month, "%Y-%m")
+        end = (start + timedelta(days=32)).replace(day=1)
+        partname = """ "%s"."%s_history_%s" """ % (self.conf["handyrep"]["handyrep_schema"], self.conf["handyrep"]["handyrep_table"], start.strftime("%Y%m"),)
+        scur.execute("""CREATE TABLE IF NOT EXISTS %s PARTITION OF %s
+            FOR VALUES FROM ( '%s' ) TO ( '%s' )""" % (partname, self.history_tabname, start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"),))
+        self.history_partitions.add(month)
+
+        keep = self.conf["handyrep"]["status_history_months"]
+        if keep:
+            scur.execute("""SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = %s::regclass""", [self.history_tabname.strip(),])
+            oldest = start
+            for i in range(keep - 1):
+                oldest = (oldest - timedelta(days=1)).replace(day=1)
+            for (relname,) in scur.fetchall():
+                suffix = relname[-6:]
+                if suffix.isdigit() and suffix < oldest.strftime("%Y%m"):
+                    self.log('DATABASE','Dropping status history partition %s' % relname)
+                    scur.execute("""DROP TABLE "%s"."%s" """ % (self.conf["handyrep"]["handyrep_schema"], relname,))
+        return True
+
+    @untraced
     def get_master_name(self):
         for servname, servdata in self.servers.iteritems():
             if servdata["role"] == "master" and servdata["enabled"]:
@@ -524,16 +1164,24 @@ class HandyRep(object):
         else:
             return return_dict(False, "no polling defined server role %s" % servrole)
 
-    def poll_master(self):
+    def poll_master(self, check=None):
         # check master using poll method
-        self.log("HANDYREP","polling master")
-        poll = self.get_plugin(self.conf["failover"]["poll_method"])
+        # if check is given, it's the result of a poll
+        # already made, which is recorded instead
         master =self.get_master_name()
         if master:
-            check = poll.run(master)
+            if check is None:
+                self.log("HANDYREP","polling master")
+                poll = self.get_plugin(self.conf["failover"]["poll_method"])
+                check = self.timed_probe(master, self.conf["failover"]["poll_method"], poll.run, master)
             if failed(check):
+                # remember when the master first stopped responding,
+                # for the failover timeline
+                if not self.master_down_since:
+                    self.master_down_since = time.time()
                 self.status_update(master, "down", "master does not respond to polling")
             else:
+                self.master_down_since = None
                 # if master was down, recover it
                 # but don't eliminate warnings
                 if self.servers[master]["status_no"] in [0,4,5,] :
@@ -546,13 +1194,19 @@ class HandyRep(object):
             self.no_master_status()
             return return_dict( False, "No configured master found, poll failed" )
 
-    def poll_server(self, replicaserver):
+    def poll_server(self, replicaserver, check=None):
         # check replica using poll method
-        self.log("HANDYREP","polling server %s" % replicaserver)
+        # if check is given, it's the result of a poll already
+        # made, perhaps by another HandyRep node, which is
+        # recorded instead
         if not replicaserver in self.servers:
             return return_dict( False, "Requested server not configured" )
-        poll = self.get_plugin(self.conf["failover"]["poll_method"])
-        check = poll.run(replicaserver)
+        if check is None:
+            self.log("HANDYREP","polling server %s" % replicaserver)
+            poll = self.get_plugin(self.conf["failover"]["poll_method"])
+            check = self.timed_probe(replicaserver, self.conf["failover"]["poll_method"], poll.run, replicaserver)
+        else:
+            self.status_checked.setdefault(replicaserver, {})["poll"] = time.time()
         if succeeded(check):
             # if responding, improve the status if it's 
             if self.servers[replicaserver]["status"] in ["unknown","down","unavailable"]:
@@ -574,17 +1228,25 @@ class HandyRep(object):
         rep_count = 0
         ret = return_dict(False, "no servers to poll", {"failover_ok" : False })
         ret["servers"] = {}
+        # with sharded polling, replicas polled by other
+        # HandyRep nodes don't need polling again
+        if self.conf["handyrep"]["sharded_polling"]:
+            shard_results = self.collect_shard_results()
+        else:
+            shard_results = {}
+        prefetched = self.poll_many([ servname for servname, servdeets in self.servers.iteritems()
+            if servdeets["enabled"] and servdeets["role"] in ["master", "replica",] and servname not in shard_results ])
         for servname, servdeets in self.servers.iteritems():
             if servdeets["enabled"]:
                 if servdeets["role"] == "master":
                     master_count += 1
-                    pollrep = self.poll_master()
+                    pollrep = self.poll_master(prefetched.get(self.get_master_name()))
                     ret["servers"].update(pollrep)
                     if succeeded(pollrep):
                         ret.update(return_dict(True, "master is working"))
                     ret["servers"][servname] = pollrep
                 elif servdeets["role"] == "replica":
-                    pollrep = self.poll_server(servname)
+                    pollrep = self.poll_server(servname, shard_results.get(servname) or prefetched.get(servname))
                     if succeeded(pollrep):
                         rep_count += 1
                         ret["failover_ok"] = True
@@ -612,6 +1274,114 @@ class HandyRep(object):
         self.log("POLL", "Polling all servers: end")
         return ret
 
+    def poll_many(self, servernames):
+        # if the poll method can poll many servers at once, polls
+        # them all together rather than one at a time, recording
+        # each result.  returns the results by server, or nothing
+        # if the poll method can't do this
+        poll = self.get_plugin(self.conf["failover"]["poll_method"])
+        if not servernames or not hasattr(poll, "run_many"):
+            return {}
+        self.log("HANDYREP","polling %d servers" % len(servernames))
+        starttime = time.time()
+        results = poll.run_many(servernames)
+        duration = time.time() - starttime
+        for servname, check in results.iteritems():
+            self.record_probe(servname, self.conf["failover"]["poll_method"], check, check.get("latency", duration))
+        return results
+
+    def collect_shard_results(self):
+        # for the HandyRep master, with sharded polling.
+        # records this node as alive, shares out the replicas
+        # among the live nodes by consistent hashing, and returns
+        # the recent poll results reported by the other nodes, by
+        # server.  the master server is always polled by this node,
+        # and so is any replica without a recent result, so a node
+        # which stops reporting doesn't leave its servers unpolled
+        try:
+            sconn = self.master_connection()
+        except Exception as ex:
+            self.log("SHARD","Unable to connect to share out polling, polling all servers: %s" % exstr(ex), True)
+            return {}
+
+        results = {}
+        maxage = self.conf["failover"]["poll_interval"] * 2
+        try:
+            scur = sconn.cursor()
+            self.shard_heartbeat(scur, True)
+            timeout = "%d seconds" % self.conf["handyrep"]["node_timeout"]
+            scur.execute("""DELETE FROM %s WHERE last_seen < now() - %%s::interval""" % self.nodes_tabname, [timeout,])
+            scur.execute("""SELECT node_name FROM %s""" % self.nodes_tabname)
+            ring = HashRing([ row[0] for row in scur.fetchall() ])
+            replicas = [ servname for servname, servdeets in self.servers.iteritems()
+                if servdeets["enabled"] and servdeets["role"] == "replica" ]
+            self.shard_assignment = ring.assign(replicas)
+            for node, servnames in self.shard_assignment.iteritems():
+                scur.execute("""UPDATE %s SET servers = %%s WHERE node_name = %%s""" % self.nodes_tabname,
+                    [json.dumps(sorted(servnames)), node,])
+            scur.execute("""SELECT server, node_name, result, details,
+                extract(epoch FROM now() - probed) FROM %s""" % self.probes_tabname)
+            for servname, node, result, details, age in scur.fetchall():
+                if node != self.node_name and age <= maxage:
+                    results[servname] = { "result" : result, "details" : details, "node" : node }
+            sconn.commit()
+        except Exception as ex:
+            self.log("SHARD","Unable to share out polling, polling all servers: %s" % exstr(ex), True)
+            results = {}
+        finally:
+            sconn.close()
+
+        return results
+
+    def poll_shard(self):
+        # for HandyReps which are not the master, with sharded
+        # polling.  records this node as alive, then polls the
+        # replicas the master has assigned to it and reports
+        # the results for the master to use
+        try:
+            sconn = self.master_connection()
+        except Exception as ex:
+            return return_dict(False, "unable to connect to report polling: %s" % exstr(ex))
+
+        try:
+            scur = sconn.cursor()
+            servnames = [ servname for servname in self.shard_heartbeat(scur, False) if servname in self.servers ]
+            sconn.commit()
+            poll = self.get_plugin(self.conf["failover"]["poll_method"])
+            results = {}
+            for servname in servnames:
+                results[servname] = self.timed_probe(servname, self.conf["failover"]["poll_method"], poll.run, servname)
+            if results:
+                scur.execute("""DELETE FROM %s WHERE server = ANY(%%s)""" % self.probes_tabname, [servnames,])
+                values = []
+                params = []
+                for servname, check in results.iteritems():
+                    values.append("( %s, %s, %s, %s, now() )")
+                    params.extend([servname, self.node_name, check["result"], check["details"],])
+                scur.execute("""INSERT INTO %s ( server, node_name, result, details, probed ) VALUES """ % self.probes_tabname
+                    + ", ".join(values), params)
+                sconn.commit()
+        except Exception as ex:
+            self.log("SHARD","Unable to report polling results: %s" % exstr(ex), True)
+            return return_dict(False, "unable to report polling results")
+        finally:
+            sconn.close()
+
+        return return_dict(True, "polled %d assigned servers" % len(results), { "servers" : results })
+
+    @untraced
+    def shard_heartbeat(self, scur, is_leader):
+        # marks this node as alive in the nodes table, and
+        # returns the servers assigned to it
+        scur.execute("""UPDATE %s SET last_seen = now(), is_leader = %%s
+            WHERE node_name = %%s RETURNING servers""" % self.nodes_tabname, [is_leader, self.node_name,])
+        row = scur.fetchone()
+        if row:
+            return row[0] or []
+        scur.execute("""INSERT INTO %s ( node_name, is_leader, servers, last_seen )
+            VALUES ( %%s, %%s, %%s, now() )""" % self.nodes_tabname, [self.node_name, is_leader, "[]",])
+        return []
+
     def poll_proxies(self, proxyserver=None):
         # polls all the connection proxies
         if self.conf["failover"]["poll_connection_proxy"] and self.conf["failover"]["connection_failover_method"]:
@@ -725,6 +1495,8 @@ class HandyRep(object):
         # check that it's in replication
             rcur = rconn.cursor()
             isrep = self.is_replica(rcur)
+            if isrep:
+                self.update_load_stats(replicaserver, rcur)
             rconn.close()
             if not isrep:
                 self.status_update(replicaserver, "warning", "replica is running but is not in replication")
@@ -758,13 +1530,38 @@ class HandyRep(object):
             return return_dict(False, "replica is not in replication")
         # check replica lag
         if repinfo["lag"] > self.servers[replicaserver]["lag_limit"]:
-            self.status_update(replicaserver, "lagged", "lagging %d %s" % repinfo["lag"], repinfo["lag_unit"])
+            self.status_update(replicaserver, "lagged", "lagging %d %s" % (repinfo["lag"], repinfo.get("lag_unit", "units"),))
             return return_dict(True, "replica is lagged but running")
         else:
         # otherwise, return success
             self.status_update(replicaserver, "healthy", "replica is all good")
             return return_dict(True, "replica OK")
 
+    def update_load_stats(self, servername, cur):
+        # caches connection count and read I/O for a server
+        # so that we can pick lightly loaded clone sources
+        # without querying every server at clone time
+        # sum() of a bigint is numeric, which psycopg2 returns
+        # as a Decimal, and Decimals can't be saved as JSON
+        loadrow = get_one_row(cur, """SELECT ( SELECT count(*) FROM pg_stat_activity ),
+            ( SELECT sum(blks_read)::bigint FROM pg_stat_database )""")
+        if not loadrow:
+            return
+        blksread = int(loadrow[1]) if loadrow[1] is not None else None
+        now = datetime.now()
+        oldstats = self.servers[servername].get("load_stats")
+        readrate = 0
+        if oldstats and oldstats["blks_read"] is not None and blksread is not None:
+            oldts = string_ts(oldstats["stats_ts"])
+            if oldts and now > oldts:
+                readrate = max(float(blksread - oldstats["blks_read"]), 0) / (now - oldts).total_seconds()
+
+        self.servers[servername]["load_stats"] = { "connections" : int(loadrow[0]),
+            "blks_read" : blksread,
+            "blks_read_rate" : readrate,
+            "stats_ts" : ts_string(now) }
+        return
+
     def verify_server(self, servername):
         if not self.servers[servername]["enabled"]:
             # disabled servers always return success
@@ -773,14 +1570,123 @@ class HandyRep(object):
 
         servrole = self.servers[servername]["role"]
         if servrole == "master":
-            return self.verify_master()
+            return self.timed_probe(servername, "verify", self.verify_master)
         elif servrole == "replica":
-            return self.verify_replica(servername)
+            return self.timed_probe(servername, "verify", self.verify_replica, servername)
         elif servrole in ["pgbouncer", "proxy",]:
             return self.poll_proxies(servername)
         else:
             return return_dict(False, "no polling defined server role %s" % servrole)
 
+    @untraced
+    def timed_probe(self, servername, method, probe, *args):
+        # runs a poll or verify function, recording its latency
+        # per server and method
+        return self.run_probe(servername, method, probe, args, True)
+
+    @untraced
+    def run_probe(self, servername, method, probe, args, own_check):
+        # as timed_probe.  if not own_check, the probe is one made
+        # for another HandyRep, and only its latency is recorded
+        starttime = time.time()
+        try:
+            check = probe(*args)
+        except Exception:
+            PROBE_SECONDS.observe(time.time() - starttime, server=servername or "none", method=method, result="error")
+            raise
+        self.record_probe(servername, method, check, time.time() - starttime, own_check)
+        return check
+
+    @untraced
+    def record_probe(self, servername, method, check, duration, own_check=True):
+        # records the result and latency of a poll or verify,
+        # whether run by timed_probe or as part of a group.
+        # only this node's own checks of its servers are samples
+        # for the failure detector and count as status checks;
+        # polls made for another HandyRep, by get_master_view,
+        # would otherwise skew both
+        PROBE_SECONDS.observe(duration, server=servername or "none", method=method, result=result_label(check))
+        if not own_check:
+            return
+        if servername and method == self.conf["failover"]["poll_method"]:
+            self.detector(servername).record(succeeded(check), duration)
+        # record when the server's status was last checked
+        # a verify counts as a poll as well
+        checked = self.status_checked.setdefault(servername, {})
+        checked["poll"] = time.time()
+        if method == "verify":
+            checked["verify"] = checked["poll"]
+
+    @untraced
+    def detector(self, servername):
+        if servername not in self.detectors:
+            self.detectors[servername] = FailureDetector(self.conf["failover"]["detector_window"])
+        return self.detectors[servername]
+
+    @untraced
+    def suspicion(self, servername):
+        # how suspicious the latest poll of the server was, as phi
+        # see lib/failuredetector.py
+        if servername in self.detectors:
+            return self.detectors[servername].suspicion()
+        return 0.0
+
+    @untraced
+    def next_poll_interval(self):
+        # seconds until the next failover check.  with the failure
+        # detector, this is shortened while the master is under
+        # suspicion, so that a failure is confirmed or cleared sooner
+        interval = self.conf["failover"]["poll_interval"]
+        if self.conf["failover"]["failure_detector"]:
+            phi = self.suspicion(self.get_master_name())
+            if phi > 1:
+                interval = max(int(interval / phi), min(self.conf["failover"]["min_poll_interval"], interval))
+        return interval
+
+    @untraced
+    def status_age(self, check_type="poll", servername=None):
+        # seconds since the server was last polled or verified
+        # for all servers, the age of the least recently checked
+        # enabled master or replica, since other roles such as
+        # proxies and archive servers aren't polled.  None if
+        # never checked
+        if servername:
+            servnames = [servername,]
+        else:
+            servnames = [ servname for servname, servdeets in self.servers.iteritems()
+                if servdeets["enabled"] and servdeets["role"] in ("master", "replica",) ]
+        now = time.time()
+        oldest = 0
+        for servname in servnames:
+            checked = self.status_checked.get(servname, {}).get(check_type)
+            if checked is None:
+                return None
+            oldest = max(oldest, now - checked)
+        return oldest
+
+    def refresh_status(self, check_type="verify", servername=None, max_age=None):
+        # polls or verifies servers, unless their status has been
+        # checked within the last max_age seconds.  concurrent
+        # callers share a single refresh rather than each
+        # checking the servers again
+        if max_age is not None:
+            age = self.status_age(check_type, servername)
+            if age is not None and age <= max_age:
+                return return_dict(True, "status is %.1f seconds old" % age)
+
+        if servername:
+            if check_type == "verify":
+                refresh = self.verify_server
+            else:
+                refresh = self.poll_server
+            return self.status_refresh.do((check_type, servername), refresh, servername)
+        else:
+            if check_type == "verify":
+                refresh = self.verify_all
+            else:
+                refresh = self.poll_all
+            return self.status_refresh.do((check_type, None), refresh)
+
     def verify_all(self):
         # verify all servers, preparatory to listing
         # information
@@ -796,8 +1702,8 @@ class HandyRep(object):
         #we need to verify the master first, so that
         #we don't mistakenly decide that the replicas
         #are disabled
-        mcheck = self.verify_master()
         mserver = self.get_master_name()
+        mcheck = self.timed_probe(mserver, "verify", self.verify_master)
         if succeeded(mcheck):
             vertest.update({ "result" : "SUCCESS",
                 "details" : "master check passed",
@@ -814,7 +1720,7 @@ class HandyRep(object):
                 if servdetail["role"] == "master":
                     master_count += 1
                 elif servdetail["role"] == "replica":
-                    vertest["servers"][server] = self.verify_replica(server)
+                    vertest["servers"][server] = self.timed_probe(server, "verify", self.verify_replica, server)
                     if succeeded(vertest["servers"][server]):
                         rep_count += 1
 
@@ -835,13 +1741,8 @@ class HandyRep(object):
         # result of the poll, it's just so we update statuses
         self.poll_proxies()
 
-        # do some archive housekeeping if we're archiving
-        if self.conf["archive"]["archiving"]:
-            # invoke the poll method of the archive script, just
-            # in case anything is required
-            self.poll_archiving()
-            # do archive deletion cleanup, if required
-            self.cleanup_archive()
+        # archive housekeeping is done separately, by
+        # archive_check_cycle, so that it can't hold up failover
 
         self.write_servers()
         self.log("VERIFY", "Verifying all servers: end")
@@ -886,16 +1787,19 @@ class HandyRep(object):
         # that's presumed to be part of the replica selection
         return return_dict(True, "replica OK")
 
+    @untraced
     def is_master(self, servername):
         if self.servers[servername]["role"] == 'master' and self.servers[servername]["enabled"]:
             return True
         else:
             return False
 
+    @untraced
     def is_available(self, servername):
         return ( self.servers[servername]["enabled"] and self.servers[servername]["status_no"] < 4 )
             
 
+    @operation
     def failover_check(self, verify=False):
         # core function of handyrep
         # periodic check of the master
@@ -909,6 +1813,10 @@ class HandyRep(object):
             # we're not the master, return success
             # and don't do anything
                 self.log("CHECK", "server is not HR master")
+                # stay up to date, so that we can take over quickly
+                self.refresh_from_db()
+                if self.conf["handyrep"]["sharded_polling"]:
+                    self.poll_shard()
                 return return_dict(True, "this server is not the Handyrep master, skipping")
         else:
             # we errored abort
@@ -920,8 +1828,17 @@ class HandyRep(object):
         if not verify:
             vercheck = self.poll_all()
             # if the master poll failed, verify the master
-            if failed(vercheck):
-                mcheck = self.verify_master()
+            # with the failure detector, only once the failed
+            # polls are suspicious enough; until then, poll again
+            # sooner
+            master = self.get_master_name()
+            if failed(vercheck) and self.conf["failover"]["failure_detector"] and master \
+                and self.detector(master).last_ok is False \
+                and self.suspicion(master) < self.conf["failover"]["suspicion_threshold"]:
+                self.log("CHECK", "master poll failed, suspicion %.2f is below threshold %.2f" % (self.suspicion(master), self.conf["failover"]["suspicion_threshold"],), True)
+                vercheck.update(return_dict(True, "master poll failed, not yet suspicious enough to verify"))
+            elif failed(vercheck):
+                mcheck = self.timed_probe(master, "verify", self.verify_master)
                 if succeeded(mcheck):
                     vercheck.update(return_dict(True, "master poll failed, but master is running"))
         else:
@@ -939,6 +1856,14 @@ class HandyRep(object):
             # otherwise, check if autofailover is configured
             # and if it's OK to failover
             if self.conf["failover"]["auto_failover"] and vercheck["failover_ok"]:
+                # make sure that it's not just us who can't
+                # reach the master
+                if self.conf["failover"]["failure_quorum"]:
+                    quorum = self.master_quorum()
+                    if failed(quorum):
+                        self.log("CHECK", "Master not responding, but no quorum for failover: %s" % quorum["details"], True, "WARNING")
+                        return self.failover_check_return(return_dict(False, "master not responding, no quorum for failover"))
+                    self.log("CHECK", "Quorum for failover: %s" % quorum["details"], True)
                 failit = self.auto_failover()
                 if succeeded(failit):
                     return self.failover_check_return(return_dict(True, "failed over to new master"))
@@ -951,6 +1876,114 @@ class HandyRep(object):
         else:
             return self.failover_check_return(vercheck)
 
+    def master_quorum(self):
+        # asks other vantage points whether they can reach the
+        # master before failing over: replicas, by whether their
+        # WAL receiver is still streaming; other HandyRep servers,
+        # through their get_master_view; and connection proxies,
+        # by querying through them.  each one which answers votes
+        # the master up or down, and any which can't be asked don't
+        # vote.  succeeds if at least failure_quorum vote down and
+        # more vote down than up
+        master = self.get_master_name()
+        sources = self.conf["failover"]["quorum_sources"] or []
+        checks = []
+        for servname, servdeets in self.servers.iteritems():
+            if not servdeets["enabled"]:
+                continue
+            if "replicas" in sources and servdeets["role"] == "replica" and servdeets["status_no"] < 4:
+                checks.append(("replica", servname, self.replica_sees_master))
+            elif "proxies" in sources and servdeets["role"] in ["pgbouncer", "proxy",] and servdeets["status_no"] < 3:
+                checks.append(("proxy", servname, self.proxy_sees_master))
+        if "handyreps" in sources:
+            for peer in self.conf["failover"]["quorum_peers"] or []:
+                checks.append(("handyrep", peer, self.peer_sees_master))
+
+        # ask them all at once, and don't wait
+        # for any which take too long
+        votes = {}
+        threads = [ threading.Thread(target=with_cluster(self.quorum_vote), args=(votes, kind, name, check, master))
+            for kind, name, check in checks ]
+        deadline = time.time() + self.conf["failover"]["quorum_timeout"]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+        votes = dict(votes)
+
+        down = len([ vote for vote in votes.itervalues() if vote is False ])
+        up = len([ vote for vote in votes.itervalues() if vote is True ])
+        needed = self.conf["failover"]["failure_quorum"]
+        details = "%d vantage points report the master down and %d up, of %d asked; %d needed" % (down, up, len(checks), needed,)
+        return return_dict(down >= needed and down > up, details, { "votes" : votes })
+
+    @untraced
+    def quorum_vote(self, votes, kind, name, check, master):
+        try:
+            vote = check(name, master)
+        except Exception as ex:
+            self.log("QUORUM", "Unable to ask %s %s about the master: %s" % (kind, name, exstr(ex),))
+            vote = None
+        votes["%s:%s" % (kind, name,)] = vote
+
+    def replica_sees_master(self, replicaserver, master):
+        # True if the replica is streaming from the master,
+        # False if not, and None if we can't tell, including
+        # on versions before 9.6, which don't have pg_stat_wal_receiver
+        try:
+            rconn = self.connection(replicaserver)
+        except Exception:
+            return None
+        try:
+            rcur = rconn.cursor()
+            rcur.execute("SELECT status FROM pg_stat_wal_receiver")
+            receiver = rcur.fetchone()
+        except Exception:
+            return None
+        finally:
+            rconn.close()
+        return bool(receiver) and receiver[0] == "streaming"
+
+    def proxy_sees_master(self, proxyserver, master):
+        # a query through the proxy reaches the master
+        try:
+            pconn = self.connection(proxyserver)
+        except Exception:
+            return False
+        try:
+            pcur = pconn.cursor()
+            pcur.execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+        finally:
+            pconn.close()
+
+    def peer_sees_master(self, peer, master):
+        # asks another HandyRep server whether it can reach
+        # the master, using the read-only password
+        url = "%s/get_master_view?%s" % (peer.rstrip("/"), urllib.urlencode({ "servername" : master }),)
+        req = urllib2.Request(url)
+        req.add_header("Authorization", "Basic %s" % base64.b64encode("handyrep:%s" % (self.conf["passwords"]["read_password"] or "",)))
+        view = json.load(urllib2.urlopen(req, timeout=self.conf["failover"]["quorum_timeout"]))
+        if view.get("result") != "SUCCESS":
+            return None
+        return view["reachable"]
+
+    def get_master_view(self, servername=None):
+        # whether this HandyRep server can reach the master, for
+        # other HandyRep servers deciding whether to fail over.
+        # polls without changing the master's status
+        if not servername:
+            servername = self.get_master_name()
+        if servername not in self.servers:
+            return return_dict(False, "server %s is not configured" % servername)
+        poll = self.get_plugin(self.conf["failover"]["poll_method"])
+        check = self.run_probe(servername, self.conf["failover"]["poll_method"], poll.run, (servername,), False)
+        return return_dict(True, check["details"], { "servername" : servername, "reachable" : succeeded(check) })
+
+    @untraced
     def failover_check_return(self, vercheck):
         self.write_servers()
         if failed(vercheck):
@@ -961,6 +1994,7 @@ class HandyRep(object):
         self.log("CHECK", "Failover check: end")
         return vercheck
 
+    @operation
     def failover_check_cycle(self, poll_num):
         # same as failover check, only desinged to work with
         # hdaemons periodic in order to return the cycle information
@@ -971,7 +2005,9 @@ class HandyRep(object):
         else:
             verifyit = False
         # do a failover check:
-        fcheck = self.failover_check(verifyit)
+        with FAILOVER_CHECK_SECONDS.time(verify=str(verifyit).lower()) as timer:
+            fcheck = self.failover_check(verifyit)
+            timer.labels["result"] = result_label(fcheck)
         if succeeded(fcheck):
             # on success, increment the poll cycle
             poll_next = poll_num + 1
@@ -981,7 +2017,7 @@ class HandyRep(object):
             # on fail, do a full verify next time
             poll_next = 1
         # sleep for poll interval seconds
-        return self.conf["failover"]["poll_interval"], poll_next
+        return self.next_poll_interval(), poll_next
 
     def pg_service_status(self, servername):
         # check the service status on the master
@@ -1013,26 +2049,37 @@ class HandyRep(object):
         self.status_update(master, "down", "unable to restart master")
         return self.return_log(False, "unable to restart master")
 
+    @operation
     def auto_failover(self):
         oldmaster = self.get_master_name()
         oldstatus = self.status["status"]
+        # the master stopped taking writes when it first
+        # failed polling, not when we noticed
+        timeline = FailoverTimeline("auto", oldmaster, self.master_down_since)
         self.cluster_status_update("warning","failing over")
         # poll replicas for new master
         # according to selection_method
-        replicas = self.select_new_master()
+        with timeline.phase("selection") as phase:
+            replicas = phase.done(self.select_new_master())
+            phase.servers = list(replicas or [])
         if not replicas:
             # no valid masters found, abort
             self.cluster_status_update(oldstatus,"No viable replicas found, aborting failover")
             self.log("FAILOVER","Unable to fail over, no viable replicas", True, "CRITICAL")
-            return return_dict(False, "Unable to fail over, no viable replicas")
+            return self.failover_return(timeline, return_dict(False, "Unable to fail over, no viable replicas"))
             
         # find out if we're remastering
         remaster = self.conf["failover"]["remaster"]
         # attempt STONITH
-        if failed(self.shutdown_old_master(oldmaster)):
+        timeline.writes_stopped()
+        with timeline.phase("shutdown_old_master", oldmaster) as phase:
+            shutdown = phase.done(self.shutdown_old_master(oldmaster))
+        if failed(shutdown):
             # if failed, try to rewrite connections instead:
                 if self.conf["failover"]["connection_failover"]:
-                    if succeeded(self.connection_failover(replicas[0])):
+                    with timeline.phase("connection_failover", replicas[0]) as phase:
+                        confailed = phase.done(self.connection_failover(replicas[0]))
+                    if succeeded(confailed):
                         self.status_update(oldmaster, "unavailable", "old master did not shut down, changed connection config")
                     # and we can continue
                     else:
@@ -1040,52 +2087,64 @@ class HandyRep(object):
                         self.connection_failover(oldmaster)
                         self.log("FAILOVER", "Could not shut down old master, aborting failover", True, "CRITICAL")
                         self.cluster_status_update(oldstatus, "Failover aborted: Unable to shut down old master")
-                        return return_dict(False, "Failover aborted, shutdown failed")
+                        return self.failover_return(timeline, return_dict(False, "Failover aborted, shutdown failed"))
                 else:
                     self.log("FAILOVER", "Could not shut down old master, aborting failover", True, "CRITICAL")
                     self.cluster_status_update(oldstatus, "Failover aborted: Unable to shut down old master")
-                    return return_dict(False, "Failover aborted, shutdown failed")
+                    return self.failover_return(timeline, return_dict(False, "Failover aborted, shutdown failed"))
 
         # attempt replica promotion
         for replica in replicas:
-            if succeeded(self.check_replica(replica)):
-                if succeeded(self.promote(replica)):
+            with timeline.phase("check_replica", replica) as phase:
+                repcheck = phase.done(self.check_replica(replica))
+            if succeeded(repcheck):
+                with timeline.phase("promote", replica) as phase:
+                    promoted = phase.done(self.promote(replica))
+                if succeeded(promoted):
                     # if remastering, attempt to remaster
                     if remaster:
                         for servername, servinfo in self.servers.iteritems():
                             if servinfo["role"] == "replica" and servinfo["enabled"]:
                                 # don't check result, we do that in
                                 # the remaster procedure
-                                self.remaster(servername, newmaster)
+                                with timeline.phase("remaster", servername, replica) as phase:
+                                    phase.done(self.remaster(servername, replica))
                     # fail over connections:
-                    if succeeded(self.connection_failover(replica)):
+                    with timeline.phase("connection_failover", replica) as phase:
+                        confailed = phase.done(self.connection_failover(replica))
+                    if succeeded(confailed):
+                        timeline.writes_resumed()
                         # update statuses
                         self.status = self.clusterstatus()
-                        self.write_servers()
                         # run post-failover scripts
                         # we don't fail back if they fail, though
-                        if failed(self.extra_failover_commands(replica)):
+                        with timeline.phase("extra_failover_commands", replica) as phase:
+                            extras = phase.done(self.extra_failover_commands(replica))
+                        if failed(extras):
                             self.cluster_status_update("warning","postfailover commands failed")
-                            return return_dict(True, "Failed over, but postfailover scripts did not succeed")
+                            return self.failover_return(timeline, return_dict(True, "Failed over, but postfailover scripts did not succeed"), replica)
                             
-                        return return_dict(True, "Failover to %s succeeded" % replica)
+                        return self.failover_return(timeline, return_dict(True, "Failover to %s succeeded" % replica), replica)
                     else:
                         # augh.  promotion succeeded but we can't fail over
                         # the connections.  abort
                         self.log("FAILOVER","Promoted new master but unable to fail over connections", True, "CRITICAL")
                         self.cluster_status_update("down","Promoted new master but unable to fail over connections")
-                        return return_dict(False, "Promoted new master but unable to fail over connections")
+                        return self.failover_return(timeline, return_dict(False, "Promoted new master but unable to fail over connections"), replica)
 
         # if we've gotten to this point, then we've failed at promoting
         # any replicas, time to panic
-        if succeeded(self.restart_master(oldmaster)):
+        with timeline.phase("restart_old_master", oldmaster) as phase:
+            restarted = phase.done(self.restart_master(oldmaster))
+        if succeeded(restarted):
             self.status_update(oldmaster, "warning", "attempted failover and did not succeed, please check servers")
         else:
             self.status_update(oldmaster, "down","Unable to promote any replicas")
             
         self.log("FAILOVER","Unable to promote any replicas",True, "CRITICAL")
-        return return_dict(False, "Unable to promote any replicas")
+        return self.failover_return(timeline, return_dict(False, "Unable to promote any replicas"))
 
+    @operation
     def manual_failover(self, newmaster=None, remaster=None):
         # attempt failover to a replica when requested
         # by user.  this is a bit different from auto-failover
@@ -1094,75 +2153,122 @@ class HandyRep(object):
         # get master name
         oldmaster = self.get_master_name()
         oldstatus = self.servers[oldmaster]["status"]
+        timeline = FailoverTimeline("manual", oldmaster)
         self.status_update(oldmaster, "warning", "currently failing over")
         if not newmaster:
             # returns a list of potential new masters
             # this step should check all of them
-            replicas = self.select_new_master()
+            with timeline.phase("selection") as phase:
+                replicas = phase.done(self.select_new_master())
+                phase.servers = list(replicas or [])
             if not replicas:
                 # no valid masters found, abort
                 self.log("FAILOVER","No viable new masters found", True, "CRITICAL")
                 self.status_update(oldmaster, oldstatus, "No viable replicas found, aborting failover and reverting")
-                return return_dict(False, "No viable replicas found, aborting failover and reverting")
+                return self.failover_return(timeline, return_dict(False, "No viable replicas found, aborting failover and reverting"))
         else:
-            if self.check_replica(newmaster):
+            with timeline.phase("check_replica", newmaster) as phase:
+                repcheck = phase.done(self.check_replica(newmaster))
+            if succeeded(repcheck):
                 replicas = [newmaster,]
             else:
                 self.log("FAILOVER","New master not operating", True, "CRITICAL")
                 self.status_update(oldmaster, oldstatus, "New master not viable, aborting failover and reverting")
-                return return_dict(False, "New master not viable, aborting failover and reverting")
+                return self.failover_return(timeline, return_dict(False, "New master not viable, aborting failover and reverting"))
         # if remaster not set, get from settings
         if not remaster:
             remaster = self.conf["failover"]["remaster"]
         # attempt STONITH
-        if failed(self.shutdown_old_master(oldmaster)):
+        timeline.writes_stopped()
+        with timeline.phase("shutdown_old_master", oldmaster) as phase:
+            shutdown = phase.done(self.shutdown_old_master(oldmaster))
+        if failed(shutdown):
             # we can't shut down the old master, reset and abort
-            if succeeded(self.restart_master()):
+            with timeline.phase("restart_old_master", oldmaster) as phase:
+                restarted = phase.done(self.restart_master())
+            if succeeded(restarted):
+                timeline.writes_resumed()
                 self.log("FAILOVER","Unable to shut down old master, aborting and rolling back", True, "WARNING")
-                return return_dict(False, "Unable to shut down old master, aborting and rolling back")
+                return self.failover_return(timeline, return_dict(False, "Unable to shut down old master, aborting and rolling back"))
             else:
                 self.log("FAILOVER","Unable to shut down or restart master", True, "CRITICAL")
-                return return_dict(False, "Unable to shut down or restart old master")
+                return self.failover_return(timeline, return_dict(False, "Unable to shut down or restart old master"))
         # attempt replica promotion
         for replica in replicas:
-            if succeeded(self.check_replica(replica)):
-                if succeeded(self.promote(replica)):
+            with timeline.phase("check_replica", replica) as phase:
+                repcheck = phase.done(self.check_replica(replica))
+            if succeeded(repcheck):
+                with timeline.phase("promote", replica) as phase:
+                    promoted = phase.done(self.promote(replica))
+                if succeeded(promoted):
                     # if remastering, attempt to remaster
                     if remaster:
                         for servername, servinfo in self.servers.iteritems():
                             if servinfo["role"] == "replica" and servinfo["enabled"]:
                                 # don't check result, we do that in
                                 # the remaster procedure
-                                self.remaster(servname, newmaster)
+                                with timeline.phase("remaster", servername, replica) as phase:
+                                    phase.done(self.remaster(servername, replica))
                     # fail over connections:
-                    if succeeded(self.connection_failover(newmaster)):
+                    with timeline.phase("connection_failover", replica) as phase:
+                        confailed = phase.done(self.connection_failover(replica))
+                    if succeeded(confailed):
+                        timeline.writes_resumed()
                         # run post-failover scripts
                         # we don't fail back if they fail, though
-                        if failed(self.extra_failover_commands(newmaster)):
+                        with timeline.phase("extra_failover_commands", replica) as phase:
+                            extras = phase.done(self.extra_failover_commands(replica))
+                        if failed(extras):
                             self.cluster_status_update("warning","postfailover commands failed")
                             self.log("FAILOVER", "Failed over, but postfailover scripts did not succeed", True)
-                            return return_dict(True, "Failed over, but postfailover scripts did not succeed")
+                            return self.failover_return(timeline, return_dict(True, "Failed over, but postfailover scripts did not succeed"), replica)
                         else:
-                            self.log("FAILOVER","Failover to %s completed" % newmaster, True)
+                            self.log("FAILOVER","Failover to %s completed" % replica, True)
                             self.servers[oldmaster]["enabled"] = False
                             self.status = self.clusterstatus()
-                            return return_dict(True, "Failover completed")
+                            return self.failover_return(timeline, return_dict(True, "Failover completed"), replica)
                     else:
                         # augh.  promotion succeeded but we can't fail over
                         # the connections.  abort
                         self.log("FAILOVER","Promoted new master but unable to fail over connections", True, "CRITICAL")
                         self.cluster_status_update("down","Promoted new master but unable to fail over connections")
-                        return return_dict(False, "Failed over master but unable to fail over connections")
+                        return self.failover_return(timeline, return_dict(False, "Failed over master but unable to fail over connections"), replica)
 
         # if we've gotten to this point, then we've failed at promoting
         # any replicas -- reset an abort
-        if succeeded(self.restart_master(oldmaster)):
+        with timeline.phase("restart_old_master", oldmaster) as phase:
+            restarted = phase.done(self.restart_master(oldmaster))
+        if succeeded(restarted):
+            timeline.writes_resumed()
             self.log("FAILOVER", "attempted failover and did not succeed, please check servers", True, "CRITICAL")
             self.status_update(oldmaster, "warning", "attempted failover and did not succeed, please check servers")
         else:
             self.log("FAILOVER", "Unable to promote any replicas, cluster is down", True, "CRITICAL")
             self.status_update(oldmaster, "down","Unable to promote any replicas")
-        return return_dict(False, "Unable to promote any replicas")
+        return self.failover_return(timeline, return_dict(False, "Unable to promote any replicas"))
+
+    @untraced
+    def failover_return(self, timeline, failresult, newmaster=None):
+        # closes the failover timeline, adds it to the
+        # failover history, and saves everything
+        record = timeline.finish(failresult, newmaster)
+        self.failover_history.append(record)
+        del self.failover_history[:-self.conf["failover"]["failover_history_size"]]
+        if record["write_downtime"] is not None:
+            self.log("FAILOVER", "failover finished in %.1f seconds, writes were unavailable for %.1f seconds" % (record["duration"], record["write_downtime"],))
+        else:
+            self.log("FAILOVER", "failover finished in %.1f seconds" % record["duration"])
+        self.write_servers()
+        failresult["timeline"] = record
+        return failresult
+
+    @untraced
+    def get_failover_history(self, limit=None):
+        # returns the recorded failover timelines, newest first
+        history = list(reversed(self.failover_history))
+        if limit:
+            history = history[:limit]
+        return history
 
     def shutdown_old_master(self, oldmaster):
         # test if we can ssh to master and run shutdown
@@ -1277,6 +2383,7 @@ class HandyRep(object):
             return self.return_log(False, "server %s does not start" % servername )
 
 
+    @untraced
     def get_replicas_by_status(self, repstatus):
         reps = []
         for rep, repdetail in self.servers.iteritems():
@@ -1321,6 +2428,7 @@ class HandyRep(object):
         return return_dict(False, "promotion failed")
             
 
+    @untraced
     def get_replica_list(self):
         reps = []
         reps.append(self.get_replicas_by_status("healthy"))
@@ -1363,7 +2471,8 @@ class HandyRep(object):
         serverprops["enabled"] = False
         # so that we can clone it up later
         # add rest of settings
-        self.servers[servername] = self.merge_server_settings(servername, serverprops)
+        with self.state_lock:
+            self.servers[servername] = self.merge_server_settings(servername, serverprops)
         # save everything
         self.write_servers()
         return return_dict(True, "new server saved")
@@ -1377,7 +2486,7 @@ class HandyRep(object):
             else:
                 return return_dict(False, "you may not clone from a server which is non-operational")
         else:
-            clomaster = self.get_master_name()
+            clomaster = self.select_clone_source(replicaserver)
         # abort if this is the master
         if replicaserver == self.get_master_name():
             return return_dict(False, "You may not clone over the master")
@@ -1417,6 +2526,19 @@ class HandyRep(object):
             self.log("CLONE","Cloning %s failed" % replicaserver, True)
             return return_dict(False, "cloning failed, could not start replica")
 
+    def select_clone_source(self, replicaserver):
+        # pick the server to clone from using clone_source_method
+        # falls back to the master if the method isn't configured
+        # or doesn't find a suitable replica
+        if self.conf["handyrep"]["clone_source_method"]:
+            selection = self.get_plugin(self.conf["handyrep"]["clone_source_method"])
+            sources = selection.run(replicaserver)
+            if sources and type(sources) is list:
+                self.log("CLONE","cloning %s from replica %s" % (replicaserver, sources[0],))
+                return sources[0]
+
+        return self.get_master_name()
+
     def disable(self, servername):
         # shutdown replica.  Don't check result, we don't really care
         self.shutdown(servername)
@@ -1445,37 +2567,43 @@ class HandyRep(object):
         if self.servers[servername]["enabled"]:
             return return_dict(False, "You many not remove a currently enabled server from configuration.")
         else:
-            self.servers.pop(servername, None)
+            with self.state_lock:
+                self.servers.pop(servername, None)
             self.write_servers()
             return self.return_log(True, "Server %s removed from configuration" % servername)
 
-    def get_status(self, check_type="cached"):
+    def get_status(self, check_type="cached", max_age=None):
         # returns status of all server resources
-        if check_type == "poll":
-            self.poll_all()
-        elif check_type == "verify":
-            self.verify_all()
+        # if max_age is given, only polls or verifies if the
+        # cached status is older than max_age seconds.
+        # cached with a max_age polls if needed
+        if check_type in ["poll", "verify"]:
+            self.refresh_status(check_type, None, max_age)
+        elif max_age is not None:
+            self.refresh_status("poll", None, max_age)
 
         servall = {}
         for servname, servdeets in self.servers.iteritems():
             servin = dict((k,v) for k,v in servdeets.iteritems() if k in ["hostname","status","status_no","status_message","enabled","status_ts", "role"])
+            servin["status_age"] = self.status_age("poll", servname)
             servall[servname] = servin
 
         return { "cluster" : self.status,
-            "servers" : servall }
+            "servers" : servall,
+            "startup" : self.get_startup_info() }
 
     def postfailover_scripts(self, newmaster):
         pscripts = self.conf["extra_failover_commands"]
 
-    def get_server_info(self, servername=None, verify=False):
+    def get_server_info(self, servername=None, verify=False, max_age=None):
         # returns config of all servers
-        # if sync:
-        if verify:
+        # if sync, or if the cached data is older
+        # than max_age seconds:
+        if verify or max_age is not None:
             # verify_servers
-            if servername:
-                self.verify_server(servername)
-            else:
-                self.verify_all()
+            if servername and servername not in self.servers:
+                return return_dict(False, "server %s is not configured" % servername)
+            self.refresh_status("verify", servername, None if verify else max_age)
         if servername:
             # otherwise return just the one
             serv = { servername : self.servers[servername] }
@@ -1484,6 +2612,20 @@ class HandyRep(object):
             # if all, return all servers
             return self.servers
 
+    def get_dashboard(self, servername=None, max_age=None):
+        # everything a status page needs in one call:
+        # the status of all servers, full details of one
+        # server or all servers, and the master's name
+        status = self.get_status("cached", max_age)
+        if servername and servername not in self.servers:
+            servinfo = {}
+        else:
+            servinfo = self.get_server_info(servername)
+        return { "status" : status,
+            "servers" : servinfo,
+            "master" : self.get_master_name(),
+            "changes_seq" : self.changes.latest() }
+
     def get_servers_by_role(self, serverrole, verify=True):
         # roles: master, replica
         # if sync:
@@ -1506,11 +2648,16 @@ class HandyRep(object):
 
             return reps
 
-    def get_cluster_status(self, verify=False):
-        if verify:
-            self.verify_all()
-        return self.status
+    def get_cluster_status(self, verify=False, max_age=None):
+        # verifies first if asked to, or if the
+        # cached status is older than max_age seconds
+        if verify or max_age is not None:
+            self.refresh_status("verify", None, None if verify else max_age)
+        clusterstat = dict(self.status)
+        clusterstat["status_age"] = self.status_age("verify")
+        return clusterstat
 
+    @untraced
     def merge_server_settings(self, servername, newdict=None):
         # does 3-way merge of server settings:
         # server_defaults, saved server settings
@@ -1536,6 +2683,7 @@ class HandyRep(object):
         return statusdef
                     
 
+    @untraced
     def validate_server_settings(self, servername, serverdict=None):
         # check all settings or prospective settings
         # for a server.  in the process, merge changed
@@ -1633,15 +2781,15 @@ class HandyRep(object):
         
         # set up fabric
         lock_fabric(True)
-        env.key_filename = self.servers[replicaserver]["ssh_key"]
-        env.user = self.servers[replicaserver]["ssh_user"]
-        env.disable_known_hosts = True
-        env.host_string = self.servers[replicaserver]["hostname"]
+        fabric_api.env.key_filename = self.servers[replicaserver]["ssh_key"]
+        fabric_api.env.user = self.servers[replicaserver]["ssh_user"]
+        fabric_api.env.disable_known_hosts = True
+        fabric_api.env.host_string = self.servers[replicaserver]["hostname"]
         # push the config
         try:
-            upload_template( rectemp, servconf["replica_conf"], use_jinja=True, context=recparam, template_dir=self.conf["handyrep"]["templates_dir"], use_sudo=True)
-            sudo( "chown %s %s" % (self.conf["handyrep"]["postgres_superuser"], servconf["replica_conf"] ), quiet=True)
-            sudo( "chmod 700 %s" % (servconf["replica_conf"] ), quiet=True)
+            fabric_files.upload_template( rectemp, servconf["replica_conf"], use_jinja=True, context=recparam, template_dir=self.conf["handyrep"]["templates_dir"], use_sudo=True)
+            fabric_api.sudo( "chown %s %s" % (self.conf["handyrep"]["postgres_superuser"], servconf["replica_conf"] ), quiet=True)
+            fabric_api.sudo( "chmod 700 %s" % (servconf["replica_conf"] ), quiet=True)
             
         except Exception as ex:
             self.disconnect_and_unlock()
@@ -1781,6 +2929,116 @@ class HandyRep(object):
         else:
             return return_dict(True, "archive cleanup is disabled")
 
+    def archive_housekeeping(self):
+        # polls the archive method and runs archive cleanup,
+        # recording the results in archive_status.
+        # run by archive_check in its own thread so that
+        # slow deletions or an unreachable archive server
+        # never hold up failover checks
+        starttime = time.time()
+        self.archive_status.update({ "running" : True,
+            "started" : now_string(),
+            "status_message" : "archive check running" })
+        try:
+            archpoll = self.poll_archiving()
+            archclean = self.cleanup_archive()
+        except Exception as ex:
+            archpoll = archclean = return_dict(False, "archive check encountered error: %s" % exstr(ex))
+
+        if succeeded(archpoll) and succeeded(archclean):
+            archstat = "healthy"
+        else:
+            archstat = "warning"
+            self.log("ARCHIVE", "archive check failed: %s / %s" % (archpoll["details"], archclean["details"],), True)
+
+        self.archive_status.update({ "status" : archstat,
+            "running" : False,
+            "finished" : now_string(),
+            "duration" : round(time.time() - starttime, 3),
+            "poll" : archpoll,
+            "cleanup" : archclean,
+            "status_message" : archclean["details"] })
+        return True
+
+    def archive_check(self):
+        # periodic archive polling and cleanup
+        # starts the housekeeping thread and returns at once,
+        # reporting the result of the previous housekeeping run.
+        # skips the check if the last one is still running, with
+        # a warning once it has run for more than archive_timeout
+        if not self.conf["archive"]["archiving"]:
+            return return_dict(True, "archiving is disabled")
+
+        # only the HR master does archive housekeeping
+        hrmaster = self.check_hr_master()
+        if failed(hrmaster):
+            return return_dict(False, "hr master check errored, skipping archive check")
+        if not hrmaster["is_master"]:
+            return return_dict(True, "this server is not the Handyrep master, skipping")
+
+        if self.archive_thread and self.archive_thread.is_alive():
+            running = time.time() - self.archive_started
+            if running > self.conf["archive"]["archive_timeout"]:
+                self.archive_status.update({ "status" : "warning",
+                    "status_message" : "archive check exceeded timeout of %d seconds" % self.conf["archive"]["archive_timeout"] })
+                self.log("ARCHIVE", "%s, running since %s" % (self.archive_status["status_message"], self.archive_status["started"],), True)
+                return return_dict(False, self.archive_status["status_message"])
+            self.log("ARCHIVE", "previous archive check still running since %s, skipping" % self.archive_status["started"])
+            return return_dict(True, "previous archive check still running")
+
+        # report the last completed run before starting the next
+        lastcheck = return_dict(self.archive_status["status"] in ("healthy", "unknown",), self.archive_status["status_message"])
+        self.archive_started = time.time()
+        self.archive_thread = threading.Thread(target=with_cluster(self.archive_housekeeping))
+        self.archive_thread.daemon = True
+        self.archive_thread.start()
+        return lastcheck
+
+    @operation
+    def archive_check_cycle(self, poll_num):
+        # version of archive_check for hdaemon's periodic,
+        # which expects the sleep interval and the next argument
+        self.archive_check()
+        return self.conf["archive"]["archive_poll_interval"], poll_num
+
+    @untraced
+    def get_archive_status(self):
+        return self.archive_status
+
+    @untraced
+    def get_metrics(self):
+        # returns all metrics in Prometheus text format
+        # gauges for current state are refreshed from
+        # the servers dictionary first
+        self.update_metrics()
+        return REGISTRY.exposition()
+
+    @untraced
+    def update_metrics(self):
+        # refreshes the gauges for this cluster
+        SERVER_STATUS.clear()
+        REPLICATION_LAG.clear()
+        FAILURE_SUSPICION.clear()
+        for servname, servdeets in self.servers.iteritems():
+            SERVER_STATUS.set(servdeets["status_no"], server=servname, role=servdeets["role"])
+            if servdeets["role"] == "replica" and servdeets.get("lag") is not None:
+                try:
+                    REPLICATION_LAG.set(float(servdeets["lag"]), server=servname)
+                except (TypeError, ValueError):
+                    pass
+        for servname, detector in self.detectors.items():
+            FAILURE_SUSPICION.set(detector.suspicion(), server=servname)
+        CLUSTER_STATUS.set(self.status["status_no"])
+        return True
+
+    @untraced
+    def get_traces(self, limit=20, name=None):
+        # returns recent traces, newest first.  name
+        # can be used to pick out one kind of operation,
+        # e.g. HandyRep.failover_check_cycle
+        return tracing.get_traces(limit, name)
+
+    @untraced
     def get_plugin(self, pluginname):
         # call method from the plugins class
         # if this errors, we return a class
@@ -1792,7 +3050,7 @@ class HandyRep(object):
         except:
             getinstance = failplugin(pluginname)
 
-        return getinstance
+        return timed_plugin(getinstance, pluginname)
 
     def connection(self, servername, autocommit=False):
         connect_string = "dbname=%s host=%s port=%s user=%s application_name=handyrep " % (self.conf["handyrep"]["handyrep_db"], self.servers[servername]["hostname"], self.servers[servername]["port"], self.conf["handyrep"]["handyrep_user"],)
@@ -1801,7 +3059,9 @@ class HandyRep(object):
                 connect_string += " password=%s " % self.conf["passwords"]["handyrep_db_pass"]
 
         try:
-            conn = psycopg2.connect( connect_string )
+            with DB_CONNECT_SECONDS.time(server=servername) as timer:
+                conn = psycopg2.connect( connect_string )
+                timer.labels["result"] = "success"
         except:
             self.log("DBCONN","ERROR: Unable to connect to Postgres using the connections string %s" % connect_string)
             raise CustomError("DBCONN","ERROR: Unable to connect to Postgres using the connections string %s" % connect_string)
@@ -1857,6 +3117,7 @@ class HandyRep(object):
 
         return conn
 
+    @untraced
     def is_replica(self, rcur):
         try:
             reptest = get_one_val(rcur,"SELECT pg_is_in_recovery();")
@@ -1904,39 +3165,25 @@ class HandyRep(object):
         raise CustomError('DBCONN',"FATAL: no accessible database servers in current server list.  Update the configuration manually and try again.")
 
     def test_ssh(self, servername):
-        try:
-            lock_fabric()
-            env.key_filename = self.servers[servername]["ssh_key"]
-            env.user = self.servers[servername]["ssh_user"]
-            env.disable_known_hosts = True
-            env.host_string = self.servers[servername]["hostname"]
-            command = self.conf["handyrep"]["test_ssh_command"]
-            testit = run(command, quiet=True, warn_only=True)
-        except:
-            return False
-
-        result = testit.succeeded
-        self.disconnect_and_unlock()
-        return result
+        # runs over the ssh client rather than fabric, so that
+        # failure checks are never queued behind a long command
+        serv = self.servers[servername]
+        command = self.conf["handyrep"]["test_ssh_command"]
+        with SSH_SECONDS.time(server=servername, user=serv["ssh_user"]) as timer:
+            return_code, output = ssh_command(serv["hostname"], serv["ssh_user"], serv["ssh_key"], command)
+            timer.labels["result"] = "success" if return_code == 0 else "fail"
+        return return_code == 0
 
     def test_ssh_newhost(self, hostname, ssh_key, ssh_user ):
-        try:
-            lock_fabric()
-            env.key_filename = ssh_key
-            env.user = ssh_user
-            env.disable_known_hosts = True
-            env.host_string = hostname
-            command = self.conf["handyrep"]["test_ssh_command"]
-            testit = run(command, warn_only=True, quiet=True)
-        except Exception as ex:
-            self.log("SSH","Unable to ssh to host %s" % hostname,True)
-            #print exstr(ex)
-            return False
-
-        result = testit.succeeded
-        self.disconnect_and_unlock()
-        return result
-
+        command = self.conf["handyrep"]["test_ssh_command"]
+        with SSH_SECONDS.time(server=hostname, user=ssh_user) as timer:
+            return_code, output = ssh_command(hostname, ssh_user, ssh_key, command)
+            timer.labels["result"] = "success" if return_code == 0 else "fail"
+        if return_code == SSH_FAILED:
+            self.log("SSH","Unable to ssh to host %s: %s" % (hostname, output,),True)
+        return return_code == 0
+
+    @untraced
     def authenticate(self, username, userpass, funcname=""):
         # simple authentication function which
         # authenticates the user against the passwords
@@ -1947,11 +3194,13 @@ class HandyRep(object):
         authed = authit.run(username, userpass, funcname)
         return authed
 
+    @untraced
     def authenticate_bool(self, username, userpass, funcname):
         # simple boolean response to the above for the web daemon
         return succeeded(self.authenticate(username, userpass, funcname))
 
+    @untraced
     def disconnect_and_unlock(self):
-        disconnect_all()
+        fabric_network.disconnect_all()
         lock_fabric(False)
         return True
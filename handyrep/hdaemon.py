@@ -1,17 +1,23 @@
-import inspect
-from threading import Thread
 import time
+# when the daemon started, for the time to the first request
+process_started = time.time()
+
+import inspect
+from threading import Thread, Lock
 import json
 import sys
 
 from flask import Flask, request, jsonify, Response
 
 import daemon.config as config
+import daemon.daemonfunctions as hrdf
 
-from daemon.invokable import INVOKABLE
+from daemon.invokable import INVOKABLE, CACHED_OK
 from daemon.periodic import PERIODIC
+from daemon.scheduler import Scheduler, shared_jobs
 from daemon.startup import startup
 from daemon.auth import authenticate, REALM
+from daemon.batch import check_operation, run_batch
 
 #
 
@@ -20,16 +26,44 @@ from daemon.auth import authenticate, REALM
 # Make stdout unbuffered by redirecting stdout to stderr :-)
 sys.stdout = sys.stderr
 app = Flask(__name__)
+scheduler = None
+start_lock = Lock()
 
 #
 
+# every route is also available under /<cluster>/, for
+# daemons managing several clusters.  without a cluster
+# name, requests go to the default cluster
+
+def known_cluster(cluster):
+    return not cluster or cluster in hrdf.clusters
+
+def unknown_cluster(cluster):
+    return jsonify({ 'Error' : 'Undefined cluster ' + cluster })
+
+def still_starting():
+    return jsonify({ 'Error' : 'Cluster has not finished starting up, see get_startup_info' })
+
+@app.before_request
+def note_first_request():
+    if "first_request" not in hrdf.startup_times:
+        hrdf.record_startup("first_request")
+
 @app.route("/<func>")
-def invoke(func):
+@app.route("/<cluster>/<func>")
+def invoke(func, cluster=None):
     try:
         function_reference = INVOKABLE[func]
     except KeyError:
         return jsonify({ 'Error' : 'Undefined function ' + func }) 
-        
+
+    if not known_cluster(cluster):
+        return unknown_cluster(cluster)
+    with hrdf.using_cluster(cluster):
+        return invoke_function(func, function_reference)
+
+def invoke_function(func, function_reference):
+
     arguments = {}
         
     for key in request.args.keys():
@@ -51,6 +85,9 @@ def invoke(func):
     if not authenticate(func, arguments, function_reference, request):
         return Response("Could not authenticate", 401,
             {'WWW-Authenticate': 'Basic realm="%s"' % REALM})
+
+    if func not in CACHED_OK and not hrdf.wait_for_startup():
+        return still_starting()
     
     result = function_reference(**arguments)
     
@@ -58,40 +95,160 @@ def invoke(func):
         result = json.dumps(result)
         
     return Response(result, mimetype='application/json')
-    
 
+@app.route("/metrics")
+def metrics():
+    # Prometheus scrape endpoint, for all clusters.
+    # Authenticated like the other functions, as
+    # get_metrics on the default cluster
+    if not authenticate("metrics", {}, hrdf.get_metrics, request):
+        return Response("Could not authenticate", 401,
+            {'WWW-Authenticate': 'Basic realm="%s"' % REALM})
+
+    return Response(hrdf.get_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route("/events")
+@app.route("/<cluster>/events")
+def events(cluster=None):
+    # server-sent events stream of status changes.
+    # starts with a snapshot of the full status, unless the
+    # client is reconnecting with Last-Event-ID, then sends
+    # each change as it happens.  Authenticated as get_changes
+    if not known_cluster(cluster):
+        return unknown_cluster(cluster)
+    with hrdf.using_cluster(cluster):
+        authed = authenticate("events", {}, hrdf.get_changes, request)
+    if not authed:
+        return Response("Could not authenticate", 401,
+            {'WWW-Authenticate': 'Basic realm="%s"' % REALM})
 
-def run_periodic(func):
+    since = request.headers.get("Last-Event-ID", request.args.get("since"))
+
+    def stream(since):
+        # runs after the request has returned, so
+        # picks its cluster again
+        with hrdf.using_cluster(cluster):
+            for message in cluster_stream(since):
+                yield message
+
+    def cluster_stream(since):
+        if since is None:
+            since = hrdf.cur_hr().changes.latest()
+            yield sse_message("snapshot", since, hrdf.get_status())
+        else:
+            since = int(since)
+        while True:
+            changes = hrdf.get_changes(since, 15)
+            if changes["reset"]:
+                since = changes["seq"]
+                yield sse_message("snapshot", since, hrdf.get_status())
+            elif changes["changes"]:
+                for change in changes["changes"]:
+                    since = change["seq"]
+                    yield sse_message("change", since, change)
+            else:
+                # keepalive, so that proxies don't close the connection
+                yield ": keepalive\n\n"
+
+    return Response(stream(since), mimetype='text/event-stream',
+        headers={ 'Cache-Control' : 'no-cache', 'X-Accel-Buffering' : 'no' })
+
+@app.route("/batch", methods=["POST"])
+@app.route("/<cluster>/batch", methods=["POST"])
+def batch(cluster=None):
+    # runs a list of operations in one request.  the body is JSON:
+    # { "operations" : [ { "function" : name, "args" : { ... } }, ... ],
+    #   "parallel" : false, "stop_on_error" : false }
+    # each distinct function is authenticated once, and server
+    # data is saved once at the end
+    if not known_cluster(cluster):
+        return unknown_cluster(cluster)
+    with hrdf.using_cluster(cluster):
+        return run_batch_request(cluster)
+
+def run_batch_request(cluster):
+    # parsed here rather than with request.get_json, which
+    # needs a newer flask than requirements.txt allows
     try:
-        function_reference = PERIODIC[func]
-    except KeyError:
-        return  
-    
-    argument = None
-    result = None
-    
-    while(True):
-        result = function_reference(argument)
+        body = json.loads(request.data)
+    except ValueError:
+        body = None
+    if not isinstance(body, dict) or not isinstance(body.get("operations"), list):
+        return jsonify({ 'Error' : 'Request body must be JSON with a list of operations' })
 
-        if result is None or type(result) is not tuple or len(result) != 2:
-            break
-        
-        sleep_period = int(result[0])
-        
-        if sleep_period > 0:
-            time.sleep(sleep_period)
-        
-        argument = result[1]
+    results = [ None ] * len(body["operations"])
+    operations = []
+    authed = {}
+    for index, operation in enumerate(body["operations"]):
+        function_reference, arguments, error = check_operation(operation)
+        if error:
+            results[index] = { "result" : "FAIL", "details" : error }
+            continue
+        func = operation["function"]
+        if func not in authed:
+            authed[func] = authenticate(func, arguments, function_reference, request)
+        if not authed[func]:
+            return Response("Could not authenticate", 401,
+                {'WWW-Authenticate': 'Basic realm="%s"' % REALM})
+        operations.append((index, function_reference, arguments))
+
+    if body.get("stop_on_error") and any(results):
+        # don't run anything if some operations are invalid
+        operations = []
+
+    if set(authed.keys()) - CACHED_OK and not hrdf.wait_for_startup():
+        return still_starting()
+
+    ran = run_batch(operations, bool(body.get("parallel")), bool(body.get("stop_on_error")), cluster)
+    for index in range(len(results)):
+        if index in ran:
+            results[index] = ran[index]
+        elif results[index] is None:
+            results[index] = { "result" : "FAIL", "details" : "not run because an earlier operation failed" }
+
+    succeeded = all([ res["result"] == "SUCCESS" for res in results ])
+    return Response(json.dumps({ "result" : "SUCCESS" if succeeded else "FAIL",
+        "details" : "%d of %d operations succeeded" % (len([ res for res in results if res["result"] == "SUCCESS" ]), len(results),),
+        "results" : results }), mimetype='application/json')
+
+def sse_message(event, seq, data):
+    return "id: %d\nevent: %s\ndata: %s\n\n" % (seq, event, json.dumps(data),)
+    
 
-    print func, "exiting with return", result
 
 def start():
-    startup()
+    # loads the clusters from their saved state, so that the
+    # API can answer, then syncs each cluster with its database
+    # in the background, retrying until it succeeds, and starts
+    # its periodic functions once it has.  does this once however
+    # many times it's called
+    global scheduler
+    with start_lock:
+        if scheduler:
+            return
+        hrdf.record_startup("process_started", process_started)
+        startup()
+        hrdf.record_startup("api_ready")
+        scheduler = Scheduler()
+        scheduler.start(shared_jobs(len(hrdf.cluster_names())))
+        for cluster in hrdf.cluster_names():
+            t = Thread(target=finish_startup, args=(cluster,))
+            t.daemon = True
+            t.start()
 
+def finish_startup(cluster):
+    try:
+        result = hrdf.finish_startup(cluster)
+    except Exception as e:
+        result = { "result" : "FAIL",
+            "details" : "startup encountered error: %s" % repr(e) }
+    print cluster, "startup finished with", result
+    # finish_startup only returns once the cluster has synced,
+    # so run the checks even if verifying the servers failed
     for func_name in PERIODIC.keys():
-        t = Thread(target=run_periodic, args=(func_name,) )
-        t.daemon = True
-        t.start()
+        scheduler.add(func_name, cluster)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0")
+    start()
+    # threaded, so that /events streams don't block other requests
+    app.run(host="0.0.0.0", threaded=True)
@@ -0,0 +1,64 @@
+# this module contains the status change feed
+# each change to a server or cluster status is published
+# with a sequence number, so that clients can follow changes
+# by long-polling or server-sent events instead of
+# repeatedly fetching the full status
+# none of these functions expect access to the dictionaries
+
+from collections import deque
+import threading
+import time
+
+class ChangeFeed(object):
+
+    def __init__(self, history=1000):
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.changes = deque(maxlen=history)
+
+    def publish(self, kind, name, delta):
+        # records one change and wakes up any waiting clients
+        # kind is "server" or "cluster"; delta holds the
+        # changed status fields
+        with self.cond:
+            self.seq += 1
+            self.changes.append({ "seq" : self.seq,
+                "ts" : time.time(),
+                "kind" : kind,
+                "name" : name,
+                "delta" : delta })
+            self.cond.notify_all()
+            return self.seq
+
+    def since(self, seq):
+        # changes after seq, and whether any were
+        # dropped from the history, in which case the
+        # client needs to fetch the full status again
+        with self.cond:
+            return self.changes_after(seq)
+
+    def changes_after(self, seq):
+        found = [ change for change in self.changes if change["seq"] > seq ]
+        if self.changes:
+            reset = seq < self.changes[0]["seq"] - 1
+        else:
+            reset = seq < self.seq
+        return { "seq" : self.seq,
+            "reset" : reset or seq > self.seq,
+            "changes" : found }
+
+    def wait(self, seq, timeout):
+        # like since(), but waits up to timeout seconds
+        # for a change if there are none yet
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.seq == seq:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return self.changes_after(seq)
+
+    def latest(self):
+        with self.cond:
+            return self.seq
@@ -0,0 +1,94 @@
+# this module contains the failure detector used for polling.
+# for each server it keeps a history of poll results and of the
+# latency of successful polls, and turns each new poll into a
+# suspicion level, in the style of the phi accrual detector:
+# phi is -log10 of the probability of seeing results at least
+# this bad from a healthy server, so phi 1 is a 1 in 10 event,
+# phi 3 a 1 in 1000 event, and so on.
+#   a successful poll scores by how far out in the tail of the
+#   server's usual latency it is
+#   each failed poll adds -log10 of the chance of a failure, from
+#   the server's own failure rate, so failures accrue, and count
+#   for more on a server which rarely fails than on a flaky one
+# none of these functions expect access to the dictionaries
+
+from collections import deque
+import math
+
+MAX_PHI = 16.0
+
+# prior for the failure rate, as if the detector had already
+# seen PRIOR_POLLS polls with one failure, so that a new
+# detector isn't fooled by its first few results
+PRIOR_POLLS = 100
+
+# fewest latencies needed to judge whether a poll was slow
+MIN_SAMPLES = 5
+
+def phi_of(probability):
+    if probability <= 0:
+        return MAX_PHI
+    return min(-math.log10(probability), MAX_PHI)
+
+def tail_probability(value, mean, stddev):
+    # chance that a normally distributed value is at least this big
+    return 0.5 * math.erfc((value - mean) / (stddev * math.sqrt(2)))
+
+class FailureDetector(object):
+
+    def __init__(self, window=1000, min_stddev=0.001):
+        self.results = deque(maxlen=window)
+        self.latencies = deque(maxlen=window)
+        self.min_stddev = min_stddev
+        self.failed_phi = 0.0
+        self.last_phi = 0.0
+        self.last_ok = None
+
+    def failure_probability(self):
+        failures = len([ result for result in self.results if not result ])
+        return (failures + 1.0) / (len(self.results) + PRIOR_POLLS)
+
+    def latency_stats(self):
+        count = len(self.latencies)
+        mean = sum(self.latencies) / count
+        variance = sum((latency - mean) ** 2 for latency in self.latencies) / count
+        # don't let a very steady history make tiny
+        # variations look alarming
+        return mean, max(math.sqrt(variance), mean * 0.1, self.min_stddev)
+
+    def latency_phi(self, latency):
+        if len(self.latencies) < MIN_SAMPLES:
+            return 0.0
+        mean, stddev = self.latency_stats()
+        if latency <= mean:
+            return 0.0
+        return phi_of(tail_probability(latency, mean, stddev))
+
+    def record(self, ok, latency):
+        # records one poll and returns the suspicion level after it
+        if ok:
+            phi = self.latency_phi(latency)
+            self.latencies.append(latency)
+            self.failed_phi = 0.0
+        else:
+            self.failed_phi = min(self.failed_phi + phi_of(self.failure_probability()), MAX_PHI)
+            phi = self.failed_phi
+        self.results.append(ok)
+        self.last_ok = ok
+        self.last_phi = phi
+        return phi
+
+    def suspicion(self):
+        return self.last_phi
+
+    def summary(self):
+        if self.latencies:
+            mean, stddev = self.latency_stats()
+        else:
+            mean, stddev = None, None
+        return { "suspicion" : round(self.last_phi, 3),
+            "last_poll_ok" : self.last_ok,
+            "polls" : len(self.results),
+            "failure_rate" : round(self.failure_probability(), 5),
+            "mean_latency" : mean,
+            "latency_stddev" : stddev }
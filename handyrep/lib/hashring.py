@@ -0,0 +1,58 @@
+# this module contains a consistent hash ring, used to share
+# out servers for polling between HandyRep nodes.  each node
+# is placed on the ring many times, so that servers are spread
+# evenly, and when a node joins or leaves only the servers
+# next to it on the ring move
+# none of these functions expect access to the dictionaries
+
+from bisect import bisect, insort
+import hashlib
+
+def hash_key(key):
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+class HashRing(object):
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.ring = []
+        self.owners = {}
+        self.nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in range(self.replicas):
+            point = hash_key("%s#%d" % (node, replica,))
+            insort(self.ring, point)
+            self.owners[point] = node
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        for replica in range(self.replicas):
+            point = hash_key("%s#%d" % (node, replica,))
+            self.ring.remove(point)
+            del self.owners[point]
+
+    def get(self, key):
+        # the node which owns key, or None if
+        # there are no nodes
+        if not self.ring:
+            return None
+        index = bisect(self.ring, hash_key(key)) % len(self.ring)
+        return self.owners[self.ring[index]]
+
+    def assign(self, keys):
+        # dictionary of node : list of its keys, including
+        # nodes with no keys
+        assigned = dict((node, []) for node in self.nodes)
+        for key in keys:
+            node = self.get(key)
+            if node is not None:
+                assigned[node].append(key)
+        return assigned
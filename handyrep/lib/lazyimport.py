@@ -0,0 +1,27 @@
+# this module contains a stand-in for modules which are slow
+# to import, or optional, such as fabric and ldap, so that they
+# are only imported when they are first used rather than when
+# hdaemon starts.  use as:
+#   fabric_api = lazy_module("fabric.api")
+#   fabric_api.env.user = "postgres"
+# none of these functions expect access to the dictionaries
+
+import importlib
+
+class lazy_module(object):
+
+    def __init__(self, modulename):
+        self.__dict__["_modulename"] = modulename
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        if self._module is None:
+            # the import lock makes this safe between threads
+            self.__dict__["_module"] = importlib.import_module(self._modulename)
+        return self._module
+
+    def __getattr__(self, attrname):
+        return getattr(self._load(), attrname)
+
+    def __setattr__(self, attrname, value):
+        setattr(self._load(), attrname, value)
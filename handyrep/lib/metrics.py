@@ -0,0 +1,254 @@
+# this module contains a small metrics registry for handyrep
+# counters, gauges and histograms with labels, which are
+# exported in the Prometheus text format by hdaemon's /metrics
+# none of these functions expect access to the dictionaries
+
+import threading
+import time
+from lib.tracing import child_span
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# the cluster which this thread is working for, when one hdaemon
+# manages several clusters.  every metric recorded in the thread
+# gets a "cluster" label; with a single cluster there is no label
+cluster_context = threading.local()
+
+def current_cluster():
+    return getattr(cluster_context, "name", None)
+
+class in_cluster(object):
+    # context manager which records metrics in this
+    # thread against the named cluster
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.previous = current_cluster()
+        cluster_context.name = self.name
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        cluster_context.name = self.previous
+        return False
+
+def with_cluster(func):
+    # wraps func to record metrics against this thread's
+    # cluster, for functions run in new threads
+    name = current_cluster()
+    def cluster_call(*args, **kwargs):
+        with in_cluster(name):
+            return func(*args, **kwargs)
+    return cluster_call
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labelnames, labelvalues, extra=None):
+    # the first label value is the cluster, if any
+    pairs = [ '%s="%s"' % (name, escape_label(value)) for name, value in zip(labelnames, labelvalues[1:]) ]
+    if labelvalues[0] is not None:
+        pairs.insert(0, 'cluster="%s"' % escape_label(labelvalues[0]))
+    if extra:
+        pairs.append('%s="%s"' % extra)
+    if pairs:
+        return "{%s}" % ",".join(pairs)
+    else:
+        return ""
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class Metric(object):
+    # base class for all metric types
+    # values are kept per tuple of label values
+    kind = "untyped"
+
+    def __init__(self, name, helptext, labelnames=()):
+        self.name = name
+        self.helptext = helptext
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def labelkey(self, labels):
+        return (current_cluster(),) + tuple([ labels.get(name, "") for name in self.labelnames ])
+
+    def clear(self):
+        # clears the values for this thread's cluster only
+        cluster = current_cluster()
+        with self.lock:
+            self.values = dict((key, value) for key, value in self.values.iteritems() if key[0] != cluster)
+
+    def samples(self):
+        with self.lock:
+            return [ (self.name, key, None, value) for key, value in sorted(self.values.items()) ]
+
+    def exposition(self):
+        lines = [ "# HELP %s %s" % (self.name, self.helptext),
+            "# TYPE %s %s" % (self.name, self.kind) ]
+        for samplename, key, extra, value in self.samples():
+            lines.append("%s%s %s" % (samplename, format_labels(self.labelnames, key, extra), format_value(value)))
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.labelkey(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.labelkey(labels)
+        with self.lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, helptext, labelnames=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, helptext, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self.labelkey(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = { "counts" : [0] * len(self.buckets), "sum" : 0.0, "count" : 0 }
+            hist = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist["counts"][i] += 1
+                    break
+            hist["sum"] += value
+            hist["count"] += 1
+
+    def time(self, **labels):
+        return histogram_timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, hist in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, hist["counts"]):
+                    cumulative += count
+                    samples.append(("%s_bucket" % self.name, key, ("le", format_value(bound)), cumulative))
+                samples.append(("%s_sum" % self.name, key, None, hist["sum"]))
+                samples.append(("%s_count" % self.name, key, None, hist["count"]))
+        return samples
+
+class histogram_timer(object):
+    # context manager which observes the elapsed time
+    # labels can be added or changed inside the block,
+    # e.g. to record the result of the timed call
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type and "result" in self.histogram.labelnames and "result" not in self.labels:
+            self.labels["result"] = "error"
+        self.histogram.observe(time.time() - self.start, **self.labels)
+        return False
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, helptext, labelnames=()):
+        return self.register(Counter(name, helptext, labelnames))
+
+    def gauge(self, name, helptext, labelnames=()):
+        return self.register(Gauge(name, helptext, labelnames))
+
+    def histogram(self, name, helptext, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, helptext, labelnames, buckets))
+
+    def exposition(self):
+        return "\n".join([ metric.exposition() for metric in self.metrics ]) + "\n"
+
+REGISTRY = Registry()
+
+# handyrep's metrics.  these are module-level so that
+# both HandyRep and the plugins record into the same registry
+
+PROBE_SECONDS = REGISTRY.histogram("handyrep_probe_seconds",
+    "Time taken to poll or verify a server", ("server", "method", "result"))
+FAILOVER_CHECK_SECONDS = REGISTRY.histogram("handyrep_failover_check_seconds",
+    "Duration of failover checks", ("verify", "result"))
+WRITE_SERVERS_SECONDS = REGISTRY.histogram("handyrep_write_servers_seconds",
+    "Time taken to save server and status data to file and database", ("result",))
+WRITE_SERVERS_TOTAL = REGISTRY.counter("handyrep_write_servers_total",
+    "Number of times server and status data has been saved", ("result",))
+PLUGIN_SECONDS = REGISTRY.histogram("handyrep_plugin_seconds",
+    "Latency of plugin method calls", ("plugin", "method", "result"))
+SSH_SECONDS = REGISTRY.histogram("handyrep_ssh_seconds",
+    "Latency of remote commands run over ssh", ("server", "user", "result"))
+DB_CONNECT_SECONDS = REGISTRY.histogram("handyrep_db_connect_seconds",
+    "Time taken to open a database connection", ("server", "result"))
+REPLICATION_LAG = REGISTRY.gauge("handyrep_replication_lag",
+    "Last measured replication lag, in the units of the replication_status_method", ("server",))
+FAILURE_SUSPICION = REGISTRY.gauge("handyrep_failure_suspicion",
+    "Failure detector suspicion (phi) after the last poll", ("server",))
+SERVER_STATUS = REGISTRY.gauge("handyrep_server_status",
+    "Current server status number, 0 unknown to 5 down", ("server", "role"))
+CLUSTER_STATUS = REGISTRY.gauge("handyrep_cluster_status",
+    "Current cluster status number, 0 unknown to 5 down")
+STARTUP_SECONDS = REGISTRY.gauge("handyrep_startup_seconds",
+    "Seconds from hdaemon starting until each stage of startup", ("stage",))
+STATUS_TRANSITIONS = REGISTRY.counter("handyrep_status_transitions_total",
+    "Number of server and cluster status changes", ("server", "from_status", "to_status"))
+
+def result_label(retdict):
+    # result label for a return dictionary
+    try:
+        return retdict["result"].lower()
+    except (TypeError, KeyError, AttributeError):
+        return "unknown"
+
+class timed_plugin(object):
+    # wrapper returned by HandyRep.get_plugin which records
+    # the latency of every method called on the plugin,
+    # and traces it if there's a trace in progress.
+    # everything else is passed through to the plugin itself
+
+    def __init__(self, plugin, pluginname):
+        self.__dict__["_plugin"] = plugin
+        self.__dict__["_pluginname"] = pluginname
+
+    def __getattr__(self, attrname):
+        attr = getattr(self._plugin, attrname)
+        if attrname.startswith("_") or not callable(attr):
+            return attr
+
+        def timed_call(*args, **kwargs):
+            with child_span("plugin %s.%s" % (self._pluginname, attrname,), plugin=self._pluginname) as sp:
+                with PLUGIN_SECONDS.time(plugin=self._pluginname, method=attrname) as timer:
+                    retval = attr(*args, **kwargs)
+                    if isinstance(retval, dict):
+                        timer.labels["result"] = result_label(retval)
+                    else:
+                        timer.labels["result"] = "none"
+                sp.set_result(retval)
+            return retval
+
+        return timed_call
+
+    def __setattr__(self, attrname, value):
+        setattr(self._plugin, attrname, value)
@@ -74,18 +74,22 @@ def notfalse(*args):
 
 # rlock function for locking fabric access
 # we need to do this because fabric is not multi-threaded
+# the lock has to be shared by all callers, since fabric's
+# env is global
+
+fabric_lock = threading.RLock()
 
 def lock_fabric(locked=True):
-    lock = threading.RLock()
     if locked:
-        lock.acquire()
+        fabric_lock.acquire()
         return True
     else:
         try:
-            lock.release()
+            fabric_lock.release()
         except RuntimeError:
             # ignore it if we didn't have the lock
             return False
+        return True
 
 def fabric_unlock_all():
     unlocked = True
@@ -0,0 +1,173 @@
+# this module contains an in-process equivalent of pg_isready,
+# which checks whether PostgreSQL servers are accepting connections
+# by sending the startup message of the PostgreSQL protocol and
+# reading the first reply, without logging in.  many servers can
+# be pinged at once over non-blocking sockets, using the event
+# loop in probeengine.py.
+# results use pg_isready's exit codes:
+#   0  accepting connections
+#   1  rejecting connections, e.g. during startup or shutdown
+#   2  no response
+#   3  no attempt made, e.g. because of invalid parameters
+# as with pg_isready, any reply other than "cannot connect now"
+# counts as accepting connections, including authentication
+# failures, since the server is up and answering.
+# SSL is not requested; servers which require it reply with an
+# authentication error, which still counts as accepting
+# none of these functions expect access to the dictionaries
+
+import errno
+import socket
+import struct
+import time
+
+from lib.probeengine import run_probes, DEFAULT_MAX_IN_FLIGHT
+
+PING_OK = 0
+PING_REJECT = 1
+PING_NO_RESPONSE = 2
+PING_NO_ATTEMPT = 3
+
+PROTOCOL_VERSION = 196608
+# SQLSTATE sent while the server is starting up or shutting down
+CANNOT_CONNECT_NOW = "57P03"
+TERMINATE = "X" + struct.pack("!i", 4)
+
+def startup_message(user, dbname):
+    params = "user\0%s\0database\0%s\0application_name\0handyrep\0\0" % (user, dbname,)
+    body = struct.pack("!i", PROTOCOL_VERSION) + params
+    return struct.pack("!i", len(body) + 4) + body
+
+def parse_reply(data):
+    # ping result from the start of the server's reply,
+    # or None if more is needed to tell
+    if not data:
+        return None
+    if data[0] != "E":
+        # authentication request or anything else:
+        # the server is accepting connections
+        return PING_OK
+    if len(data) < 5:
+        return None
+    length = struct.unpack("!i", data[1:5])[0]
+    if len(data) < length + 1:
+        return None
+    for field in data[5:length + 1].split("\0"):
+        if field.startswith("C"):
+            if field[1:] == CANNOT_CONNECT_NOW:
+                return PING_REJECT
+            break
+    return PING_OK
+
+class Ping(object):
+    # one ping, as a small state machine driven by socket
+    # readiness: connecting, sending, reading, done.
+    # the timeout runs from when the ping is started
+
+    def __init__(self, host, port, user, dbname, timeout):
+        self.host = host
+        self.port = port
+        self.message = startup_message(user, dbname)
+        self.timeout = timeout
+        self.deadline = None
+        self.sock = None
+        self.state = "new"
+        self.reply = ""
+        self.result = None
+        self.started = None
+        self.latency = None
+
+    def start(self):
+        self.started = time.time()
+        self.deadline = self.started + self.timeout
+        if not self.host or not self.port:
+            return self.finish(PING_NO_ATTEMPT)
+        try:
+            port = int(self.port)
+            if self.host.startswith("/"):
+                # unix socket directory, as for libpq
+                family, address = socket.AF_UNIX, "%s/.s.PGSQL.%d" % (self.host, port,)
+            else:
+                family, socktype, proto, canonname, address = socket.getaddrinfo(self.host, port, 0, socket.SOCK_STREAM)[0]
+            self.sock = socket.socket(family, socket.SOCK_STREAM)
+            self.sock.setblocking(0)
+            err = self.sock.connect_ex(address)
+        except (socket.error, ValueError, TypeError):
+            return self.finish(PING_NO_RESPONSE)
+        if err in (0, errno.EISCONN):
+            self.state = "sending"
+        elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            self.state = "connecting"
+        else:
+            return self.finish(PING_NO_RESPONSE)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def wants_write(self):
+        return self.state in ("connecting", "sending")
+
+    def writable(self):
+        if self.state == "connecting":
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                return self.finish(PING_NO_RESPONSE)
+            self.state = "sending"
+        try:
+            sent = self.sock.send(self.message)
+        except socket.error as ex:
+            if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            return self.finish(PING_NO_RESPONSE)
+        self.message = self.message[sent:]
+        if not self.message:
+            self.state = "reading"
+
+    def readable(self):
+        try:
+            data = self.sock.recv(4096)
+        except socket.error as ex:
+            if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            return self.finish(PING_NO_RESPONSE)
+        if not data:
+            return self.finish(PING_NO_RESPONSE)
+        self.reply += data
+        result = parse_reply(self.reply)
+        if result is not None:
+            if self.reply[0] != "E":
+                # we're not going to log in, so say goodbye
+                # rather than leaving the server to time out
+                try:
+                    self.sock.send(TERMINATE)
+                except socket.error:
+                    pass
+            self.finish(result)
+
+    def check_timeout(self, now):
+        if self.result is None and now >= self.deadline:
+            self.finish(PING_NO_RESPONSE)
+
+    def finish(self, result):
+        self.result = result
+        self.state = "done"
+        self.latency = time.time() - (self.started or time.time())
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+def ping_many(targets, timeout=3, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    # pings many servers at once.  targets is a dictionary of
+    # key : (host, port, user, dbname).  returns a dictionary of
+    # key : (result, latency in seconds)
+    pings = dict((key, Ping(host, port, user, dbname, timeout))
+        for key, (host, port, user, dbname) in targets.iteritems())
+    run_probes(pings.values(), max_in_flight)
+    return dict((key, (ping.result, ping.latency)) for key, ping in pings.iteritems())
+
+def ping(host, port, user, dbname, timeout=3):
+    # pings one server, returning the pg_isready exit code
+    return ping_many({ 0 : (host, port, user, dbname) }, timeout)[0][0]
@@ -0,0 +1,166 @@
+# this module contains an event loop for running many network
+# probes at once in a single thread, such as the pings in pgping.py.
+# it uses epoll where available, then poll, then select, so that
+# thousands of probes can be in flight at once; select alone can't
+# watch more than 1024 sockets.
+# a probe is any object with these methods:
+#   start()             opens its socket, or sets result if it can't
+#   fileno()            the socket's file descriptor
+#   wants_write()       True while it has something to send
+#   writable()          called when the socket can be written to
+#   readable()          called when the socket can be read from
+#   check_timeout(now)  sets result if its time is up
+# and a "result" attribute, which is None until it's finished,
+# and a "deadline" attribute, the epoch time it must finish by.
+# probes close their own sockets when they finish
+# none of these functions expect access to the dictionaries
+
+import errno
+import select
+import time
+
+# most probes in flight at once, to stay within
+# the process's limit on open files
+DEFAULT_MAX_IN_FLIGHT = 1000
+
+class EpollPoller(object):
+
+    def __init__(self):
+        self.epoll = select.epoll()
+
+    def mask(self, write):
+        if write:
+            return select.EPOLLOUT
+        return select.EPOLLIN
+
+    def register(self, fd, write):
+        self.epoll.register(fd, self.mask(write))
+
+    def modify(self, fd, write):
+        self.epoll.modify(fd, self.mask(write))
+
+    def unregister(self, fd):
+        self.epoll.unregister(fd)
+
+    def poll(self, timeout):
+        return [ fd for fd, event in self.epoll.poll(timeout) ]
+
+    def close(self):
+        self.epoll.close()
+
+class PollPoller(object):
+
+    def __init__(self):
+        self.pollobj = select.poll()
+
+    def mask(self, write):
+        if write:
+            return select.POLLOUT
+        return select.POLLIN
+
+    def register(self, fd, write):
+        self.pollobj.register(fd, self.mask(write))
+
+    def modify(self, fd, write):
+        self.pollobj.modify(fd, self.mask(write))
+
+    def unregister(self, fd):
+        self.pollobj.unregister(fd)
+
+    def poll(self, timeout):
+        return [ fd for fd, event in self.pollobj.poll(timeout * 1000) ]
+
+    def close(self):
+        return
+
+class SelectPoller(object):
+
+    def __init__(self):
+        self.fds = {}
+
+    def register(self, fd, write):
+        self.fds[fd] = write
+
+    def modify(self, fd, write):
+        self.fds[fd] = write
+
+    def unregister(self, fd):
+        del self.fds[fd]
+
+    def poll(self, timeout):
+        readers = [ fd for fd, write in self.fds.iteritems() if not write ]
+        writers = [ fd for fd, write in self.fds.iteritems() if write ]
+        readable, writable, broken = select.select(readers, writers, [], timeout)
+        return readable + writable
+
+    def close(self):
+        return
+
+def make_poller():
+    if hasattr(select, "epoll"):
+        return EpollPoller()
+    elif hasattr(select, "poll"):
+        return PollPoller()
+    else:
+        return SelectPoller()
+
+def run_probes(probes, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    # runs a list of probes until they have all finished.
+    # probes waiting for a free slot don't start their
+    # clocks until they start
+    poller = make_poller()
+    waiting = list(reversed(probes))
+    # fd : [probe, wants_write]
+    active = {}
+    try:
+        while waiting or active:
+            # start as many probes as there's room for
+            while waiting and len(active) < max_in_flight:
+                probe = waiting.pop()
+                probe.start()
+                if probe.result is None:
+                    fd = probe.fileno()
+                    write = probe.wants_write()
+                    poller.register(fd, write)
+                    active[fd] = [probe, write]
+            if not active:
+                continue
+
+            now = time.time()
+            wait = max(min(entry[0].deadline for entry in active.itervalues()) - now, 0)
+            try:
+                ready = poller.poll(wait)
+            except (select.error, IOError) as ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd in ready:
+                entry = active.get(fd)
+                if not entry or entry[0].result is not None:
+                    continue
+                if entry[1]:
+                    entry[0].writable()
+                else:
+                    entry[0].readable()
+
+            # finish any which have run out of time, then stop
+            # watching finished probes before any new ones start,
+            # since their sockets are closed and the file
+            # descriptors may be reused
+            now = time.time()
+            for fd, entry in active.items():
+                probe = entry[0]
+                probe.check_timeout(now)
+                if probe.result is not None:
+                    try:
+                        poller.unregister(fd)
+                    except (IOError, OSError, KeyError, ValueError):
+                        pass
+                    del active[fd]
+                elif probe.wants_write() != entry[1]:
+                    entry[1] = probe.wants_write()
+                    poller.modify(fd, entry[1])
+    finally:
+        poller.close()
+    return probes
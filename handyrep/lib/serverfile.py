@@ -0,0 +1,167 @@
+# this module contains safe storage for the servers.save file
+# the file is written to a temporary file, fsynced, and renamed
+# into place, so that a crash never leaves a truncated file.
+# earlier versions are kept as numbered generations to fall back
+# on, and each file carries a checksum of its contents.
+# writes whose contents haven't changed, apart from keys which
+# change on every write such as the state version, are skipped
+# none of these functions expect access to the dictionaries
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+# first line of the file.  files without it are read
+# as plain JSON, as written by older versions
+HEADER_KEY = "handyrep_serverfile"
+FORMAT_VERSION = 1
+
+def serialize(data):
+    # compact, and with sorted keys so that the same
+    # data always has the same checksum
+    return json.dumps(data, separators=(",", ":"), sort_keys=True)
+
+def checksum(payload):
+    return hashlib.sha256(payload).hexdigest()
+
+def fsync_dir(dirname):
+    # makes a rename in the directory durable
+    try:
+        dirfd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dirfd)
+    except OSError:
+        pass
+    finally:
+        os.close(dirfd)
+
+class ServerFile(object):
+
+    def __init__(self, path, generations=3, ignore_keys=("version",)):
+        self.path = path
+        self.generations = max(generations, 1)
+        # top-level keys left out when deciding whether
+        # the contents have changed
+        self.ignore_keys = ignore_keys
+        self.last_checksum = None
+        self.lock = threading.Lock()
+
+    def generation_path(self, generation):
+        if generation == 0:
+            return self.path
+        else:
+            return "%s.%d" % (self.path, generation,)
+
+    def contents_checksum(self, data):
+        # checksum of data without the ignored keys, for
+        # deciding whether a write can be skipped
+        if isinstance(data, dict):
+            data = dict([ (key, val) for key, val in data.iteritems() if key not in self.ignore_keys ])
+        return checksum(serialize(data))
+
+    def write(self, data):
+        # returns True if the file was written, False
+        # if it was unchanged.  raises on errors
+        with self.lock:
+            return self.write_locked(data)
+
+    def write_locked(self, data):
+        contentsum = self.contents_checksum(data)
+        if contentsum == self.last_checksum and os.path.exists(self.path):
+            return False
+
+        payload = serialize(data)
+        header = json.dumps({ HEADER_KEY : FORMAT_VERSION,
+            "checksum" : checksum(payload),
+            "length" : len(payload) })
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        tmpfd, tmppath = tempfile.mkstemp(prefix="%s.tmp." % os.path.basename(self.path), dir=dirname)
+        try:
+            with os.fdopen(tmpfd, "w") as tmpf:
+                tmpf.write(header)
+                tmpf.write("\n")
+                tmpf.write(payload)
+                tmpf.flush()
+                os.fsync(tmpf.fileno())
+            if os.path.exists(self.path):
+                shutil.copymode(self.path, tmppath)
+
+            # shift the older generations along, keeping the
+            # current file in place, then rename the new file
+            # over it, so that there is always a current file
+            for generation in range(self.generations - 1, 1, -1):
+                older = self.generation_path(generation - 1)
+                if os.path.exists(older):
+                    os.rename(older, self.generation_path(generation))
+            if self.generations > 1 and os.path.exists(self.path):
+                self.preserve_current(dirname)
+            os.rename(tmppath, self.path)
+        finally:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+        fsync_dir(dirname)
+        self.last_checksum = contentsum
+        return True
+
+    def preserve_current(self, dirname):
+        # links the current file as generation 1, or copies
+        # it if the filesystem can't link.  the link is made
+        # under a temporary name and renamed, as the rename
+        # replaces any existing generation 1
+        tmpfd, tmppath = tempfile.mkstemp(prefix="%s.tmp." % os.path.basename(self.path), dir=dirname)
+        os.close(tmpfd)
+        try:
+            os.remove(tmppath)
+            try:
+                os.link(self.path, tmppath)
+            except OSError:
+                shutil.copy2(self.path, tmppath)
+            os.rename(tmppath, self.generation_path(1))
+        finally:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+
+    def read_generation(self, generation):
+        # returns the data from one generation, or None if it's
+        # missing, truncated or fails its checksum
+        try:
+            with open(self.generation_path(generation), "r") as servfile:
+                contents = servfile.read()
+        except (IOError, OSError):
+            return None
+
+        firstline, sep, payload = contents.partition("\n")
+        try:
+            header = json.loads(firstline)
+        except ValueError:
+            header = None
+        if not (isinstance(header, dict) and HEADER_KEY in header):
+            # older plain JSON file
+            try:
+                return json.loads(contents)
+            except ValueError:
+                return None
+
+        if len(payload) != header.get("length") or checksum(payload) != header.get("checksum"):
+            return None
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            return None
+        if generation == 0:
+            self.last_checksum = self.contents_checksum(data)
+        return data
+
+    def read(self):
+        # returns the data from the newest good generation,
+        # and which generation it was, or None, None
+        for generation in range(self.generations):
+            data = self.read_generation(generation)
+            if data is not None:
+                return data, generation
+        return None, None
@@ -0,0 +1,482 @@
+# this module contains a simulated PostgreSQL cluster, used by
+# simulator.py and the *_sim plugins to run HandyRep without
+# any real servers.  it keeps the state of each simulated server,
+# adds configurable latencies to every operation, injects failures,
+# produces replication lag from curves over time, and provides a
+# fake DB-API connection which answers the queries HandyRep makes
+# none of these functions expect access to the dictionaries
+
+from decimal import Decimal
+import json
+import math
+import random
+import threading
+import time
+
+from lib.error import CustomError
+
+# default latency of each simulated operation, in seconds
+DEFAULT_LATENCIES = { "poll" : 0.002,
+    "ssh" : 0.02,
+    "connect" : 0.005,
+    "query" : 0.001,
+    "start" : 1.0,
+    "stop" : 0.5,
+    "promote" : 0.5,
+    "proxy" : 0.05,
+    "clone_per_gb" : 10.0 }
+
+# unreachable means that HandyRep can't reach the server,
+# but everything else can
+FAILURES = ("crash", "host_down", "unreachable", "ssh_down", "slow", "replication_broken", "recover")
+
+# simulated clusters, by HandyRep cluster_name, so that
+# plugins can find the cluster they belong to
+clusters = {}
+
+def register(name, cluster):
+    clusters[name] = cluster
+    return cluster
+
+def get_cluster(name):
+    try:
+        return clusters[name]
+    except KeyError:
+        raise CustomError("SIMULATOR", "no simulated cluster named %s is registered" % name)
+
+class SimDBError(Exception):
+    # looks enough like a psycopg2 error for dbfunctions
+    def __init__(self, message):
+        Exception.__init__(self, message)
+        self.pgerror = message
+
+class SimCluster(object):
+
+    def __init__(self, servernames, master, time_scale=1.0, latencies=None, jitter=0.2, seed=None):
+        self.start = time.time()
+        self.time_scale = time_scale
+        self.jitter = jitter
+        self.latencies = dict(DEFAULT_LATENCIES)
+        if latencies:
+            self.latencies.update(latencies)
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.events = []
+        self.failures = []
+        self.proxy_target = master
+        # the handyrep tables: main, status and history
+        self.handyrep_tables = {}
+        self.servers = {}
+        for servname in servernames:
+            self.servers[servname] = { "running" : True,
+                "ssh" : True,
+                "reachable" : True,
+                "in_recovery" : servname != master,
+                "upstream" : None if servname == master else master,
+                "replicating" : servname != master,
+                "slow_factor" : 1.0,
+                "lag_curve" : ("constant", { "value" : 0.0 }),
+                "connections" : self.random.randint(5, 50),
+                "blks_read" : 0,
+                "size_gb" : 1.0 }
+
+    def now(self):
+        # seconds since the simulation started
+        return time.time() - self.start
+
+    def delay(self, servername, operation, multiplier=1.0):
+        # sleeps for the configured latency of an operation,
+        # scaled and with some random jitter
+        self.apply_events()
+        latency = self.latencies.get(operation, 0) * multiplier * self.time_scale
+        if servername in self.servers:
+            latency *= self.servers[servername]["slow_factor"]
+        if self.jitter:
+            latency *= self.random.uniform(1 - self.jitter, 1 + self.jitter)
+        if latency > 0:
+            time.sleep(latency)
+
+    # failure injection
+
+    def inject(self, servername, failure, at=None):
+        # applies a failure now, or schedules it for
+        # "at" seconds after the start of the simulation
+        if failure not in FAILURES:
+            raise CustomError("SIMULATOR", "unknown failure type %s" % failure)
+        with self.lock:
+            if at is None or at <= self.now():
+                self.apply_failure(servername, failure)
+            else:
+                self.events.append((at, servername, failure))
+                self.events.sort()
+
+    def apply_events(self):
+        with self.lock:
+            now = self.now()
+            while self.events and self.events[0][0] <= now:
+                at, servername, failure = self.events.pop(0)
+                self.apply_failure(servername, failure)
+
+    def apply_failure(self, servername, failure):
+        serv = self.servers[servername]
+        if failure == "crash":
+            serv["running"] = False
+        elif failure == "host_down":
+            serv["running"] = False
+            serv["ssh"] = False
+        elif failure == "unreachable":
+            serv["reachable"] = False
+        elif failure == "ssh_down":
+            serv["ssh"] = False
+        elif failure == "slow":
+            serv["slow_factor"] = 10.0
+        elif failure == "replication_broken":
+            serv["replicating"] = False
+        elif failure == "recover":
+            serv.update({ "running" : True, "ssh" : True, "reachable" : True, "slow_factor" : 1.0,
+                "replicating" : serv["in_recovery"] })
+        self.failures.append({ "at" : time.time(), "server" : servername, "failure" : failure })
+
+    def failure_time(self, servername, failure):
+        # epoch time at which a failure was applied, or None
+        for fail in self.failures:
+            if fail["server"] == servername and fail["failure"] == failure:
+                return fail["at"]
+        return None
+
+    # replication lag
+
+    def set_lag(self, servername, curve, **params):
+        # curves: constant (value), linear (start, rate per second),
+        # sine (base, amplitude, period), spike (base, peak, at, duration)
+        self.servers[servername]["lag_curve"] = (curve, params)
+
+    def lag_mb(self, servername):
+        curve, params = self.servers[servername]["lag_curve"]
+        now = self.now()
+        if curve == "linear":
+            lag = params.get("start", 0.0) + params.get("rate", 1.0) * now
+        elif curve == "sine":
+            lag = params.get("base", 0.0) + params.get("amplitude", 10.0) * math.sin(2 * math.pi * now / params.get("period", 60.0))
+        elif curve == "spike":
+            spikeat = params.get("at", 0.0)
+            if spikeat <= now < spikeat + params.get("duration", 10.0):
+                lag = params.get("peak", 10000.0)
+            else:
+                lag = params.get("base", 0.0)
+        else:
+            lag = params.get("value", 0.0)
+        return max(lag, 0.0)
+
+    # operations used by SimHandyRep and the plugins
+
+    def is_up(self, servername):
+        self.apply_events()
+        return self.servers[servername]["running"]
+
+    def ssh(self, servername):
+        self.apply_events()
+        if not (self.servers[servername]["ssh"] and self.servers[servername]["reachable"]):
+            # unreachable hosts take a while to time out
+            self.delay(servername, "ssh", 10)
+            return False
+        self.delay(servername, "ssh")
+        return True
+
+    def poll(self, servername):
+        self.delay(servername, "poll")
+        return self.servers[servername]["running"] and self.servers[servername]["reachable"]
+
+    def connect(self, servername):
+        self.delay(servername, "connect")
+        if not (self.servers[servername]["running"] and self.servers[servername]["reachable"]):
+            raise CustomError("DBCONN", "ERROR: Unable to connect to simulated server %s" % servername)
+        return SimConnection(self, servername)
+
+    def start_server(self, servername):
+        if not self.ssh(servername):
+            return False
+        self.delay(servername, "start")
+        self.servers[servername]["running"] = True
+        return True
+
+    def stop_server(self, servername):
+        if not self.ssh(servername):
+            return False
+        if self.servers[servername]["running"]:
+            self.delay(servername, "stop")
+            self.servers[servername]["running"] = False
+        return True
+
+    def promote(self, servername):
+        serv = self.servers[servername]
+        if not self.ssh(servername) or not serv["running"] or not serv["in_recovery"]:
+            return False
+        self.delay(servername, "promote")
+        serv.update({ "in_recovery" : False, "upstream" : None, "replicating" : False })
+        return True
+
+    def set_upstream(self, servername, upstream):
+        serv = self.servers[servername]
+        if not self.ssh(servername):
+            return False
+        serv.update({ "in_recovery" : True, "upstream" : upstream, "replicating" : True })
+        return True
+
+    def clone(self, servername, clonefrom):
+        if not self.ssh(servername) or not self.servers[clonefrom]["running"]:
+            return False
+        self.delay(servername, "clone_per_gb", self.servers[clonefrom]["size_gb"])
+        self.servers[servername].update({ "running" : False,
+            "in_recovery" : True,
+            "upstream" : clonefrom,
+            "replicating" : True,
+            "size_gb" : self.servers[clonefrom]["size_gb"] })
+        return True
+
+    def replication_lag(self, replicaserver):
+        # lag as seen from the upstream's pg_stat_replication
+        # or None if the replica isn't connected
+        serv = self.servers[replicaserver]
+        upstream = serv["upstream"]
+        if not (serv["running"] and serv["replicating"] and upstream and self.servers[upstream]["running"]):
+            return None
+        return self.lag_mb(replicaserver)
+
+    def switch_proxy(self, newmaster):
+        self.delay(newmaster, "proxy")
+        self.proxy_target = newmaster
+        return True
+
+def table_kind(tablename):
+    # which of the handyrep tables a quoted or unquoted name is
+    tablename = tablename.replace('"', '')
+    if tablename.endswith("_status"):
+        return "status"
+    elif tablename.endswith("_history"):
+        return "history"
+    elif tablename.endswith("_nodes"):
+        return "nodes"
+    elif tablename.endswith("_probes"):
+        return "probes"
+    else:
+        return "main"
+
+class SimConnection(object):
+    # fake DB-API connection to one simulated server
+
+    def __init__(self, cluster, servername):
+        self.cluster = cluster
+        self.servername = servername
+        self.closed = False
+
+    def cursor(self):
+        return SimCursor(self.cluster, self.servername)
+
+    def commit(self):
+        return
+
+    def rollback(self):
+        return
+
+    def close(self):
+        self.closed = True
+
+    def set_isolation_level(self, level):
+        return
+
+class SimCursor(object):
+    # fake DB-API cursor which answers the queries that
+    # HandyRep and its plugins run
+
+    def __init__(self, cluster, servername):
+        self.cluster = cluster
+        self.servername = servername
+        self.rows = []
+        self.rowcount = -1
+
+    def execute(self, statement, params=None):
+        cluster = self.cluster
+        serv = cluster.servers[self.servername]
+        cluster.delay(self.servername, "query")
+        if not serv["running"]:
+            raise SimDBError("server closed the connection unexpectedly")
+        params = params or []
+        stmt = " ".join(statement.split())
+        self.rows = []
+
+        if "pg_is_in_recovery" in stmt:
+            self.rows = [ (serv["in_recovery"],) ]
+        elif stmt.startswith("CREATE TEMPORARY TABLE"):
+            if serv["in_recovery"]:
+                raise SimDBError("cannot execute CREATE TABLE in a read-only transaction")
+        elif "pg_stat_activity" in stmt:
+            serv["blks_read"] += cluster.random.randint(0, 1000)
+            # psycopg2 returns a sum() of bigints as a Decimal
+            # unless the query casts it
+            if "::bigint" in stmt:
+                self.rows = [ (serv["connections"], serv["blks_read"]) ]
+            else:
+                self.rows = [ (serv["connections"], Decimal(serv["blks_read"])) ]
+        elif "pg_stat_wal_receiver" in stmt:
+            if cluster.replication_lag(self.servername) is not None:
+                self.rows = [ ("streaming",) ]
+        elif "pg_stat_replication" in stmt:
+            replicas = [ rep for rep, repserv in cluster.servers.iteritems() if repserv["upstream"] == self.servername ]
+            if params:
+                replicas = [ rep for rep in replicas if rep == params[0] ]
+            for rep in replicas:
+                lag = cluster.replication_lag(rep)
+                if lag is not None:
+                    self.rows.append((lag,))
+        elif "pg_class" in stmt:
+            self.rows = [ (1 if table_kind(params[0]) in cluster.handyrep_tables else 0,) ]
+        elif "pg_namespace" in stmt or "information_schema.columns" in stmt:
+            self.rows = [ (1,) ]
+        elif "server_version_num" in stmt:
+            # behaves like a version without partitioning
+            self.rows = [ (False,) ]
+        elif stmt.startswith("CREATE TABLE"):
+            kind = table_kind(stmt.split()[2])
+            if kind in ("nodes", "probes"):
+                cluster.handyrep_tables[kind] = {}
+            else:
+                cluster.handyrep_tables[kind] = [] if kind == "history" else None
+        elif self.shard_table(stmt):
+            if self.shard_table(stmt) not in cluster.handyrep_tables:
+                raise SimDBError("relation does not exist")
+            if serv["in_recovery"] and not stmt.startswith("SELECT"):
+                raise SimDBError("cannot execute %s in a read-only transaction" % stmt.split()[0])
+            self.shard_statement(stmt, params)
+        elif stmt.startswith("INSERT INTO") or stmt.startswith("UPDATE"):
+            if serv["in_recovery"]:
+                raise SimDBError("cannot execute %s in a read-only transaction" % stmt.split()[0])
+            self.write_handyrep_table(stmt, params)
+            return
+        elif stmt.startswith("SELECT"):
+            # reads of the handyrep tables
+            table = cluster.handyrep_tables.get(table_kind(stmt.split(" FROM ")[-1].split()[0]))
+            if table and stmt.startswith("SELECT updated, config, servers, status"):
+                self.rows = [ (table["updated"], table["config"], table["servers"], table["status"]) ]
+            elif table and stmt.startswith("SELECT updated, status, server_status"):
+                self.rows = [ (table["updated"], table["status"], table["server_status"], table["version"], table["config_version"]) ]
+            elif table and stmt.startswith("SELECT version, config_version"):
+                if table["version"] > params[0]:
+                    self.rows = [ (table["version"], table["config_version"], table["status"], table["server_status"]) ]
+            elif table and stmt.startswith("SELECT version, writer"):
+                self.rows = [ (table["version"], table["writer"]) ]
+            elif table and stmt.startswith("SELECT servers, failovers"):
+                self.rows = [ (table["servers"], table["failovers"]) ]
+            elif table and stmt.startswith("SELECT failovers"):
+                self.rows = [ (table["failovers"],) ]
+
+        self.rowcount = len(self.rows)
+
+    def shard_table(self, stmt):
+        # nodes or probes, if the statement is on
+        # one of the sharded polling tables
+        words = stmt.split()
+        if words[0] == "UPDATE":
+            tablename = words[1]
+        elif words[0] in ("INSERT", "DELETE"):
+            tablename = words[2]
+        elif words[0] == "SELECT" and " FROM " in stmt:
+            tablename = stmt.split(" FROM ")[-1].split()[0]
+        else:
+            return None
+        kind = table_kind(tablename)
+        if kind in ("nodes", "probes"):
+            return kind
+        return None
+
+    def shard_statement(self, stmt, params):
+        # the statements used for sharded polling, with the
+        # simulated clock standing in for now()
+        kind = self.shard_table(stmt)
+        table = self.cluster.handyrep_tables[kind]
+        now = time.time()
+        if kind == "nodes":
+            if stmt.startswith("DELETE"):
+                maxage = float(params[0].split()[0])
+                for node in [ node for node, row in table.iteritems() if now - row["last_seen"] > maxage ]:
+                    del table[node]
+            elif stmt.startswith("SELECT"):
+                self.rows = [ (node,) for node in sorted(table.keys()) ]
+            elif stmt.startswith("INSERT"):
+                table[params[0]] = { "is_leader" : params[1], "servers" : json.loads(params[2]), "last_seen" : now }
+            elif "RETURNING" in stmt:
+                if params[1] in table:
+                    table[params[1]].update({ "is_leader" : params[0], "last_seen" : now })
+                    self.rows = [ (table[params[1]]["servers"],) ]
+            elif params[1] in table:
+                table[params[1]]["servers"] = json.loads(params[0])
+        else:
+            if stmt.startswith("DELETE"):
+                for servname in params[0]:
+                    table.pop(servname, None)
+            elif stmt.startswith("SELECT"):
+                self.rows = [ (servname, row["node_name"], row["result"], row["details"], now - row["probed"])
+                    for servname, row in table.iteritems() ]
+            elif stmt.startswith("INSERT"):
+                for i in range(0, len(params), 4):
+                    table[params[i]] = { "node_name" : params[i + 1], "result" : params[i + 2],
+                        "details" : params[i + 3], "probed" : now }
+        self.rowcount = len(self.rows)
+
+    def write_handyrep_table(self, stmt, params):
+        # JSON is decoded, as psycopg2 does for json columns
+        tables = self.cluster.handyrep_tables
+        words = stmt.split()
+        kind = table_kind(words[2] if words[0] == "INSERT" else words[1])
+        if kind == "history":
+            tables.setdefault("history", []).extend([ params[i:i + 5] for i in range(0, len(params), 5) ])
+            self.rowcount = len(params) / 5
+            return
+        if words[0] == "UPDATE" and not tables.get(kind):
+            self.rowcount = 0
+            return
+        if kind == "status":
+            row = tables.get("status")
+            if words[0] == "UPDATE":
+                # updated, config_version increment, status, server_status,
+                # writer, and optionally the expected version
+                if "WHERE version" in stmt and row["version"] != params[5]:
+                    self.rowcount = 0
+                    return
+                row.update({ "updated" : params[0],
+                    "version" : row["version"] + 1,
+                    "config_version" : row["config_version"] + params[1],
+                    "status" : json.loads(params[2]),
+                    "server_status" : json.loads(params[3]),
+                    "writer" : params[4] })
+            else:
+                # updated, status, server_status and writer
+                row = { "updated" : params[0],
+                    "version" : 1,
+                    "config_version" : 1,
+                    "status" : json.loads(params[1]),
+                    "server_status" : json.loads(params[2]),
+                    "writer" : params[3] }
+                tables["status"] = row
+            self.rows = [ (row["version"], row["config_version"]) ]
+        else:
+            # updated, config, servers, status and failovers
+            tables["main"] = { "updated" : params[0],
+                "config" : json.loads(params[1]),
+                "servers" : json.loads(params[2]),
+                "status" : json.loads(params[3]),
+                "failovers" : json.loads(params[4]) }
+        self.rowcount = 1
+
+    def fetchone(self):
+        if self.rows:
+            return self.rows.pop(0)
+        return None
+
+    def fetchall(self):
+        rows = self.rows
+        self.rows = []
+        return rows
+
+    def close(self):
+        return
@@ -0,0 +1,53 @@
+# this module contains a single-flight call group
+# concurrent callers asking for the same key share one
+# call of the function instead of each running it,
+# so that many API requests for fresh status result in
+# only one poll or verify of the servers
+# none of these functions expect access to the dictionaries
+
+import threading
+
+class flight(object):
+    # one call in progress, and its outcome
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, func, *args, **kwargs):
+        # runs func unless a call for the same key is already
+        # in progress, in which case waits for it and returns
+        # its result.  exceptions are raised to all callers
+        with self.lock:
+            inflight = self.flights.get(key)
+            leader = inflight is None
+            if leader:
+                inflight = flight()
+                self.flights[key] = inflight
+
+        if leader:
+            try:
+                inflight.result = func(*args, **kwargs)
+            except Exception as ex:
+                inflight.error = ex
+            finally:
+                with self.lock:
+                    self.flights.pop(key, None)
+                inflight.done.set()
+        else:
+            inflight.done.wait()
+
+        if inflight.error:
+            raise inflight.error
+        return inflight.result
+
+    def in_flight(self, key):
+        with self.lock:
+            return key in self.flights
@@ -0,0 +1,79 @@
+# this module runs commands on remote servers with the ssh client
+# in a subprocess.  unlike fabric, whose env and connections are
+# global and so have to be locked around every command, any number
+# of threads can run commands at once, so long archive or clone
+# commands don't hold up the ssh checks of failure detection.
+# fabric is still used for password logins and file uploads.
+# none of these functions expect access to the dictionaries
+
+from pipes import quote
+import os
+import subprocess
+
+# return code of the ssh client when it can't connect
+SSH_FAILED = 255
+
+def ssh_args(hostname, user, key_filename=None, connect_timeout=10):
+    # ssh client arguments matching the fabric settings
+    # handyrep uses: key login, no known hosts checking
+    args = [ "ssh", "-o", "BatchMode=yes",
+        "-o", "StrictHostKeyChecking=no",
+        "-o", "UserKnownHostsFile=/dev/null",
+        "-o", "LogLevel=ERROR",
+        "-o", "ConnectTimeout=%d" % connect_timeout ]
+    if key_filename:
+        args.extend([ "-i", key_filename ])
+    if user:
+        args.extend([ "-l", user ])
+    args.append(hostname)
+    return args
+
+def shell_command(command, runas=None, envnames=()):
+    # the remote command line for command, run by a login
+    # shell as fabric does, optionally with sudo as runas.
+    # the environment variables in envnames are read from
+    # stdin, one line each, since they may be passwords,
+    # which would be visible to ps in the command line
+    if envnames:
+        command = "%s && %s" % (" && ".join([ "IFS= read -r %s && export %s" % (name, name,)
+            for name in envnames ]), command,)
+    remote = "/bin/bash -l -c %s" % quote(command)
+    if runas:
+        remote = "sudo -n -u %s -H %s" % (quote(runas), remote,)
+    return remote
+
+def ssh_command(hostname, user, key_filename, command, runas=None, env=None, stream=None):
+    # runs command on hostname, returning the return code and
+    # the combined output.  if stream is supplied, output is
+    # written to it as it arrives, in whatever pieces it arrives
+    # in, since progress output such as pg_basebackup's may end
+    # lines with \r.  env is sent to the remote shell over stdin.
+    # returns SSH_FAILED if the ssh client can't connect or
+    # can't be run
+    env = env or {}
+    envnames = sorted(env.keys())
+    for name in envnames:
+        if "\n" in str(env[name]):
+            return SSH_FAILED, "environment variable %s contains a newline" % name
+    args = ssh_args(hostname, user, key_filename) + [ shell_command(command, runas, envnames), ]
+    try:
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, close_fds=True)
+    except OSError as ex:
+        return SSH_FAILED, "unable to run ssh: %s" % str(ex)
+    try:
+        proc.stdin.write("".join([ "%s\n" % env[name] for name in envnames ]))
+        proc.stdin.close()
+    except (IOError, OSError):
+        # ssh has already exited; its output says why
+        pass
+    output = []
+    while True:
+        chunk = os.read(proc.stdout.fileno(), 4096)
+        if not chunk:
+            break
+        output.append(chunk)
+        if stream:
+            stream.write(chunk)
+    proc.stdout.close()
+    return proc.wait(), "".join(output).rstrip()
@@ -0,0 +1,112 @@
+# this module contains the failover timeline recorder
+# each failover records every phase it goes through, with
+# timestamps, duration, outcome and the servers involved,
+# plus how long the cluster was unavailable for writes
+# none of these functions expect access to the dictionaries
+
+from datetime import datetime
+import time
+
+def epoch_string(epoch):
+    # timestamp string with milliseconds, so that
+    # short phases can be told apart
+    return datetime.fromtimestamp(epoch).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+def outcome_of(result):
+    # accepts a return dictionary or a boolean
+    if isinstance(result, dict):
+        return result.get("result", "UNKNOWN")
+    elif result:
+        return "SUCCESS"
+    else:
+        return "FAIL"
+
+class FailoverTimeline(object):
+
+    def __init__(self, failover_type, oldmaster, writes_down_since=None):
+        self.start = time.time()
+        self.writes_down = writes_down_since
+        self.writes_up = None
+        self.record = { "failover_type" : failover_type,
+            "old_master" : oldmaster,
+            "new_master" : None,
+            "started" : epoch_string(self.start),
+            "finished" : None,
+            "duration" : None,
+            "result" : None,
+            "details" : None,
+            "write_downtime" : None,
+            "phases" : [] }
+        # for auto-failover, the master went down before
+        # we started, so record how long it took to notice
+        if writes_down_since and writes_down_since < self.start:
+            self.add_phase("detection", writes_down_since, self.start, "SUCCESS", [oldmaster,])
+
+    def add_phase(self, phasename, start, end, outcome, servers, details=None):
+        phaserec = { "phase" : phasename,
+            "started" : epoch_string(start),
+            "duration" : round(end - start, 3),
+            "outcome" : outcome,
+            "servers" : [ serv for serv in servers if serv ] }
+        if details:
+            phaserec["details"] = details
+        self.record["phases"].append(phaserec)
+        return phaserec
+
+    def phase(self, phasename, *servers):
+        # context manager for timing one phase
+        # call done() on it with the phase's result
+        return timeline_phase(self, phasename, servers)
+
+    def writes_stopped(self):
+        # the point from which the old master can't take writes,
+        # if not already known
+        if not self.writes_down:
+            self.writes_down = time.time()
+
+    def writes_resumed(self):
+        self.writes_up = time.time()
+
+    def finish(self, result, newmaster=None):
+        # closes the timeline with the overall failover result
+        end = time.time()
+        if newmaster:
+            self.record["new_master"] = newmaster
+        self.record.update({ "finished" : epoch_string(end),
+            "duration" : round(end - self.start, 3),
+            "result" : outcome_of(result) })
+        if isinstance(result, dict):
+            self.record["details"] = result.get("details")
+        if self.writes_down and self.writes_up:
+            self.record["write_downtime"] = round(self.writes_up - self.writes_down, 3)
+        return self.record
+
+class timeline_phase(object):
+
+    def __init__(self, timeline, phasename, servers):
+        self.timeline = timeline
+        self.phasename = phasename
+        self.servers = list(servers)
+        self.outcome = None
+        self.details = None
+
+    def done(self, result, details=None):
+        self.outcome = outcome_of(result)
+        if isinstance(result, dict) and not details:
+            details = result.get("details")
+        if details and not isinstance(details, basestring):
+            details = str(details)
+        self.details = details
+        return result
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type:
+            self.outcome = "ERROR"
+            self.details = repr(exc_value)
+        self.timeline.add_phase(self.phasename, self.start, time.time(),
+            self.outcome or "UNKNOWN", self.servers, self.details)
+        return False
@@ -0,0 +1,280 @@
+# this module contains a lightweight tracing facility for handyrep
+# methods and plugin calls are timed in spans, which are nested per
+# thread.  when the outermost span of a thread finishes, the whole
+# trace is kept in a ring buffer, and optionally sent to an OTLP
+# collector as JSON over HTTP.  traces and exporters are kept
+# per cluster, for the cluster this thread is working on (see
+# lib.metrics.in_cluster), so that clusters sharing one daemon
+# each have their own history and service name.  traces of the
+# methods marked as operations, such as failover checks and
+# failovers, are kept in a ring buffer of their own, so that
+# frequent API calls can't push them out of the history
+# none of these functions expect access to the dictionaries
+
+from collections import deque
+from functools import wraps
+import binascii
+import json
+import logging
+import os
+import threading
+import time
+import Queue
+import urllib2
+
+local = threading.local()
+# ring buffers of recent traces, of operations and of everything
+# else, and otlp_exporter, by cluster
+traces = {}
+operation_traces = {}
+exporters = {}
+traces_lock = threading.Lock()
+
+def current_cluster():
+    # imported here, as lib.metrics imports this module
+    from lib.metrics import current_cluster
+    return current_cluster()
+
+def new_id(nbytes):
+    return binascii.hexlify(os.urandom(nbytes))
+
+def span_stack():
+    if not hasattr(local, "stack"):
+        local.stack = []
+    return local.stack
+
+def current_span():
+    stack = span_stack()
+    if stack:
+        return stack[-1]
+    return None
+
+class Span(object):
+
+    def __init__(self, name, attributes=None, operation=False):
+        parent = current_span()
+        self.name = name
+        # whether this span, if it's the root, is an operation
+        self.operation = operation
+        self.attributes = attributes or {}
+        self.status = None
+        self.span_id = new_id(8)
+        if parent:
+            self.trace = parent.trace
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+        else:
+            self.trace = []
+            self.trace_id = new_id(16)
+            self.parent_id = None
+        self.start = None
+        self.end = None
+
+    def __enter__(self):
+        self.start = time.time()
+        span_stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.end = time.time()
+        if exc_type:
+            self.status = "error"
+            self.attributes["exception"] = repr(exc_value)
+        stack = span_stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        self.trace.append(self)
+        if self.parent_id is None:
+            finish_trace(self)
+        return False
+
+    def set_result(self, retval):
+        # records the result of a function which returns
+        # a return dictionary
+        if isinstance(retval, dict) and "result" in retval:
+            self.status = str(retval["result"]).lower()
+
+    def as_dict(self):
+        return { "span_id" : self.span_id,
+            "parent_id" : self.parent_id,
+            "name" : self.name,
+            "start" : self.start,
+            "duration" : round(self.end - self.start, 6),
+            "status" : self.status,
+            "attributes" : self.attributes }
+
+def span(name, **attributes):
+    return Span(name, attributes)
+
+def child_span(name, **attributes):
+    # a span which is only recorded if there is already
+    # a trace in progress on this thread
+    if current_span():
+        return Span(name, attributes)
+    return null_span
+
+class NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def set_result(self, retval):
+        return
+
+null_span = NullSpan()
+
+def finish_trace(rootspan):
+    spans = sorted(rootspan.trace, key=lambda sp: sp.start)
+    trace = { "trace_id" : rootspan.trace_id,
+        "name" : rootspan.name,
+        "start" : rootspan.start,
+        "duration" : round(rootspan.end - rootspan.start, 6),
+        "status" : rootspan.status,
+        "spans" : [ sp.as_dict() for sp in spans ] }
+    cluster = current_cluster()
+    buffers = operation_traces if rootspan.operation else traces
+    with traces_lock:
+        if cluster not in buffers:
+            buffers[cluster] = deque(maxlen=100)
+        buffers[cluster].append(trace)
+        exporter = exporters.get(cluster)
+    if exporter:
+        exporter.add(trace)
+
+def get_traces(limit=20, name=None):
+    # returns this cluster's most recent traces, newest first
+    # optionally only those with a particular root span name
+    cluster = current_cluster()
+    with traces_lock:
+        found = list(traces.get(cluster, ())) + list(operation_traces.get(cluster, ()))
+    found.sort(key=lambda trace: trace["start"], reverse=True)
+    if name:
+        found = [ trace for trace in found if trace["name"] == name ]
+    return found[:limit]
+
+def simple_args(args):
+    # keeps only the arguments which are useful and safe
+    # to record, such as server names and flags
+    return [ arg for arg in args if isinstance(arg, (basestring, int, long, bool)) ]
+
+def traced(func, spanname=None, operation=False):
+    spanname = spanname or func.__name__
+
+    @wraps(func)
+    def traced_call(*args, **kwargs):
+        with Span(spanname, { "args" : simple_args(args[1:]) }, operation) as sp:
+            retval = func(*args, **kwargs)
+            sp.set_result(retval)
+        return retval
+
+    return traced_call
+
+def untraced(func):
+    # marks a method for trace_methods to leave alone,
+    # for simple helpers which would only clutter the traces
+    func.untraced = True
+    return func
+
+def operation(func):
+    # marks a method for trace_methods whose traces are kept
+    # in the operations buffer, for failover checks, failovers
+    # and other work whose history should outlast API calls
+    func.trace_operation = True
+    return func
+
+def trace_methods(cls):
+    # class decorator which wraps all public methods
+    # in spans, except those marked with untraced
+    for attrname, attr in cls.__dict__.items():
+        if attrname.startswith("_") or getattr(attr, "untraced", False):
+            continue
+        if callable(attr):
+            setattr(cls, attrname, traced(attr, "%s.%s" % (cls.__name__, attrname,),
+                getattr(attr, "trace_operation", False)))
+    return cls
+
+def configure(history=100, otlp_endpoint=None, service_name="handyrep"):
+    # resizes this cluster's ring buffers, and starts
+    # or stops its exporter
+    cluster = current_cluster()
+    with traces_lock:
+        for buffers in (traces, operation_traces):
+            if cluster not in buffers or buffers[cluster].maxlen != history:
+                buffers[cluster] = deque(buffers.get(cluster, ()), maxlen=history)
+        exporter = exporters.get(cluster)
+        if otlp_endpoint:
+            if not exporter or exporter.endpoint != otlp_endpoint or exporter.service_name != service_name:
+                if exporter:
+                    exporter.stop()
+                exporters[cluster] = otlp_exporter(otlp_endpoint, service_name)
+                exporters[cluster].start()
+        elif exporter:
+            exporter.stop()
+            del exporters[cluster]
+
+class otlp_exporter(threading.Thread):
+    # sends finished traces to an OTLP/HTTP collector
+    # in the background.  traces are dropped rather than
+    # queued indefinitely if the collector is unavailable
+
+    def __init__(self, endpoint, service_name):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.queue = Queue.Queue(maxsize=1000)
+        self.stopped = threading.Event()
+
+    def add(self, trace):
+        try:
+            self.queue.put_nowait(trace)
+        except Queue.Full:
+            pass
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                batch = [ self.queue.get(timeout=1), ]
+            except Queue.Empty:
+                continue
+            while len(batch) < 50:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            self.send(batch)
+
+    def send(self, batch):
+        try:
+            req = urllib2.Request(self.endpoint, json.dumps(self.otlp_payload(batch)),
+                { "Content-Type" : "application/json" })
+            urllib2.urlopen(req, timeout=5).close()
+        except Exception as ex:
+            logging.error("unable to export traces to %s: %s" % (self.endpoint, repr(ex),))
+
+    def otlp_payload(self, batch):
+        spans = []
+        for trace in batch:
+            for sp in trace["spans"]:
+                otspan = { "traceId" : trace["trace_id"],
+                    "spanId" : sp["span_id"],
+                    "name" : sp["name"],
+                    "kind" : 1,
+                    "startTimeUnixNano" : str(int(sp["start"] * 1000000000)),
+                    "endTimeUnixNano" : str(int((sp["start"] + sp["duration"]) * 1000000000)),
+                    "attributes" : [ { "key" : key, "value" : { "stringValue" : str(val) } }
+                        for key, val in sp["attributes"].iteritems() ],
+                    "status" : { "code" : 2 if sp["status"] in ("fail", "error") else 1 } }
+                if sp["parent_id"]:
+                    otspan["parentSpanId"] = sp["parent_id"]
+                spans.append(otspan)
+
+        return { "resourceSpans" : [ {
+            "resource" : { "attributes" : [ { "key" : "service.name", "value" : { "stringValue" : self.service_name } } ] },
+            "scopeSpans" : [ { "scope" : { "name" : "handyrep" }, "spans" : spans } ] } ] }
@@ -0,0 +1,35 @@
+# this module contains functions for working with
+# WAL locations and WAL segment file names
+# none of these functions expect access to the dictionaries
+
+import re
+
+walfile_re = re.compile(r'^([0-9A-F]{8})([0-9A-F]{8})([0-9A-F]{8})(\.partial)?(\.\w+)?$')
+
+def parse_lsn(lsn):
+    # converts a WAL location like 16/B374D848 into a byte position
+    try:
+        xlogid, xrecoff = lsn.strip().split("/")
+        return (int(xlogid, 16) << 32) + int(xrecoff, 16)
+    except (ValueError, AttributeError):
+        return None
+
+def segment_name(timeline, position, segment_size=16777216):
+    # returns the name of the WAL segment file containing
+    # the given byte position, for PostgreSQL 9.3 and later
+    segno = position // segment_size
+    segs_per_id = 0x100000000 // segment_size
+    return "%08X%08X%08X" % (int(timeline), segno // segs_per_id, segno % segs_per_id,)
+
+def is_wal_segment(filename):
+    # true for WAL segment files, including partial and
+    # compressed ones, but not for history or backup files
+    return walfile_re.match(filename) is not None
+
+def segment_timeline(filename):
+    return int(filename[0:8], 16)
+
+def segment_older(filename, cutoff):
+    # same comparison as pg_archivecleanup: ignores the timeline
+    # and compares log and segment numbers only
+    return filename[8:24] < cutoff[8:24]
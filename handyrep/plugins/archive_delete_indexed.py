@@ -0,0 +1,207 @@
+# plugin method for deleting files from an archive
+# based on WAL position instead of file age.
+# keeps an index of the segments in the archive on the
+# HandyRep server, so that each run only has to list
+# files added since the last run.  deletes segments
+# older than the oldest replica restart point, with the
+# same comparison as pg_archivecleanup, in batches.
+# also reports archive size and growth rate.
+# this only works if you have a configuration
+# with a single archive server which is
+# defined in the servers dictionary
+
+from plugins.handyrepplugin import HandyRepPlugin
+from lib.wal_utils import parse_lsn, segment_name, is_wal_segment, segment_timeline, segment_older
+import json
+import os
+import re
+import time
+
+class archive_delete_indexed(HandyRepPlugin):
+
+    def run(self):
+        archiveserver = self.get_archiveserver()
+        if not archiveserver:
+            return self.rd(False, "no archive server is defined")
+
+        index = self.read_index()
+        scanned = self.scan_archive(archiveserver, index)
+        if self.failed(scanned):
+            return scanned
+
+        # find the oldest segment any replica might still need
+        cutoff = self.cleanup_cutoff()
+        if not cutoff:
+            self.write_index(index)
+            return self.rd(False, "unable to determine replica restart points, not deleting anything", self.archive_stats(index))
+
+        # never delete segments younger than archive_keep_hours
+        keepsecs = (self.as_int(self.pluginconf("archive_keep_hours")) or 0) * 3600
+        keepafter = time.time() - keepsecs
+        todelete = sorted([ segname for segname, seginfo in index["segments"].iteritems()
+            if segment_older(segname, cutoff) and seginfo[2] < keepafter ])
+
+        batchsize = self.as_int(self.pluginconf("batch_size")) or 1000
+        deleted = 0
+        for i in range(0, len(todelete), batchsize):
+            batch = todelete[i:i + batchsize]
+            delit = self.run_as_root(archiveserver, [self.delete_command(batch),])
+            if self.failed(delit):
+                self.write_index(index)
+                stats = self.archive_stats(index)
+                stats.update({ "deleted" : deleted, "cutoff" : cutoff })
+                return self.rd(False, "archive cleaning failed due to error: %s" % delit["details"], stats)
+            for segname in batch:
+                index["segments"].pop(segname, None)
+            deleted += len(batch)
+
+        self.write_index(index)
+        stats = self.archive_stats(index)
+        stats.update({ "deleted" : deleted, "cutoff" : cutoff })
+        return self.rd(True, "deleted %d archive segments older than %s" % (deleted, cutoff,), stats)
+
+    def scan_archive(self, archiveserver, index):
+        # lists the archive directory, only looking at files changed
+        # since the last scan unless a full rescan is due
+        # adds new segments to the index with timeline, size and mtime
+        now = time.time()
+        fullhours = self.as_int(self.pluginconf("full_scan_hours")) or 24
+        if not index["last_full_scan"] or now - index["last_full_scan"] > fullhours * 3600:
+            fullscan = True
+            findcmd = "find %s -maxdepth 1 -type f -printf '%%f %%s %%T@\\n'" % self.pluginconf("archive_directory")
+        else:
+            fullscan = False
+            # add a few minutes of overlap so we don't miss files
+            # which were being written during the last scan
+            sincemin = int((now - index["last_scan"]) / 60) + 5
+            findcmd = "find %s -maxdepth 1 -type f -mmin -%d -printf '%%f %%s %%T@\\n'" % (self.pluginconf("archive_directory"), sincemin,)
+
+        listit = self.run_as_root(archiveserver, [findcmd,])
+        if self.failed(listit):
+            return self.rd(False, "unable to list archive directory: %s" % listit["details"])
+
+        found = {}
+        for line in str(listit["details"]).splitlines():
+            fileinfo = line.strip().split()
+            if len(fileinfo) != 3 or not is_wal_segment(fileinfo[0]):
+                continue
+            found[fileinfo[0]] = [ segment_timeline(fileinfo[0]), int(fileinfo[1]), float(fileinfo[2]) ]
+
+        added = sum([ seginfo[1] for segname, seginfo in found.iteritems() if segname not in index["segments"] ])
+        if fullscan:
+            index["segments"] = found
+            index["last_full_scan"] = now
+        else:
+            index["segments"].update(found)
+        index["last_scan"] = now
+
+        # keep a short history of archive size and bytes added
+        # for growth rate reporting
+        index["history"].append([ now, sum([ seginfo[1] for seginfo in index["segments"].values() ]), added ])
+        index["history"] = index["history"][-48:]
+        return self.rd(True, "scanned %d files" % len(found))
+
+    def cleanup_cutoff(self):
+        # returns the segment name of the oldest restart point
+        # among enabled replicas, or of the master's last checkpoint
+        # if there are no replicas.  returns None if any of them
+        # can't be checked, since then it's not safe to delete
+        replicas = self.get_servers(role="replica")
+        if not replicas:
+            master = self.get_master_name()
+            if not master:
+                return None
+            replicas = [master,]
+
+        cutoff = None
+        for servname in replicas:
+            restartseg = self.restart_segment(servname)
+            if not restartseg:
+                self.log("ARCHIVE", "could not read restart point for %s" % servname, True)
+                return None
+            if not cutoff or segment_older(restartseg, cutoff):
+                cutoff = restartseg
+
+        return cutoff
+
+    def restart_segment(self, servername):
+        # reads the REDO location of the latest checkpoint, or
+        # restartpoint on a replica, using pg_controldata
+        controlpath = self.pluginconf("pg_controldata_path") or "pg_controldata"
+        segsize = (self.as_int(self.pluginconf("wal_segment_size_mb")) or 16) * 1024 * 1024
+        ctrl = self.run_as_postgres(servername, ["%s %s" % (controlpath, self.servers[servername]["pgdata"],),])
+        if self.failed(ctrl):
+            return None
+
+        ctrlout = str(ctrl["details"])
+        redo = re.search(r"Latest checkpoint's REDO location:\s+(\S+)", ctrlout)
+        tli = re.search(r"Latest checkpoint's TimeLineID:\s+(\d+)", ctrlout)
+        if not redo or not tli:
+            return None
+        redopos = parse_lsn(redo.group(1))
+        if redopos is None:
+            return None
+        return segment_name(tli.group(1), redopos, segsize)
+
+    def delete_command(self, batch):
+        # deletes one batch of segments, split between
+        # several rm processes if delete_workers is set
+        workers = self.as_int(self.pluginconf("delete_workers")) or 1
+        perworker = max(len(batch) // workers, 1)
+        return "cd %s && echo %s | xargs -n %d -P %d rm -f" % (self.pluginconf("archive_directory"), " ".join(batch), perworker, workers,)
+
+    def archive_stats(self, index):
+        # archive size, segment count, and growth rate in bytes
+        # per hour over the scan history
+        stats = { "archive_bytes" : sum([ seginfo[1] for seginfo in index["segments"].values() ]),
+            "archive_segments" : len(index["segments"]),
+            "growth_bytes_per_hour" : None }
+        history = index["history"]
+        if len(history) > 1 and history[-1][0] > history[0][0]:
+            added = sum([ hist[2] for hist in history[1:] ])
+            stats["growth_bytes_per_hour"] = int(added * 3600 / (history[-1][0] - history[0][0]))
+        return stats
+
+    def index_file(self):
+        indexfile = self.pluginconf("index_file")
+        if not indexfile:
+            indexfile = os.path.join(os.path.dirname(self.conf["handyrep"]["server_file"]), "archive_index.json")
+        return indexfile
+
+    def read_index(self):
+        try:
+            with open(self.index_file(), "r") as indexf:
+                index = json.load(indexf)
+        except:
+            index = {}
+
+        for key, default in (("segments", {}), ("history", []), ("last_scan", 0), ("last_full_scan", 0),):
+            index.setdefault(key, default)
+        return index
+
+    def write_index(self, index):
+        try:
+            with open(self.index_file(), "w") as indexf:
+                json.dump(index, indexf)
+        except Exception as ex:
+            self.log("ARCHIVE", "unable to write archive index %s: %s" % (self.index_file(), self.exstr(ex),), True)
+            return False
+        return True
+
+    def test(self):
+        archserv = self.get_archiveserver()
+        if not archserv:
+            return self.rd(False, "no archive server is defined")
+
+        if self.failed(self.test_plugin_conf("archive_delete_indexed", "archive_directory")):
+            return self.rd(False, "archive_delete_indexed is not configured correctly")
+        else:
+            return self.rd(True, "archive_delete_indexed is configured")
+
+    def get_archiveserver(self):
+        # assumes that there's only one enabled archive server
+        archservs = self.get_servers(role="archive")
+        if archservs:
+            return archservs[0]
+        else:
+            return None
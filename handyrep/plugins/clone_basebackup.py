@@ -1,11 +1,18 @@
 # simple cloning plugin for cloning via basebackup
+# streams WAL during the backup, and reports progress
+# by parsing pg_basebackup --progress output as it arrives
 # does NOT deal with things like tablespaces and relocated WAL
 
 from plugins.handyrepplugin import HandyRepPlugin
+from lib.misc_utils import now_string
+import re
 
 class clone_basebackup(HandyRepPlugin):
 
-    def run(self, servername, clonefrom, reclone):
+    def run(self, servername, clonefrom=None, reclone=False):
+        if not clonefrom:
+            clonefrom = self.clone_source(servername)
+
         # clear the remote directory if recloning
         if reclone:
             delcmd = "rm -rf %s/*" % self.servers[servername]["pgdata"]
@@ -14,31 +21,160 @@ class clone_basebackup(HandyRepPlugin):
                 return self.rd(False, "Unable to clear PGDATA directory, aborting")
 
         # run pgbasebackup
-        myconf = self.get_conf("plugins","clone_basebackup")
-        if myconf:
-            bbparam = { "path" : myconf["basebackup_path"],
-                "extra" : myconf["extra_parameters"] }
-            if not bbparam["extra"]:
-                bbparam["extra"]=""
-        else:
-            bbparam = { "path" : "pg_basebackup", "extra" : "" }
+        bbparam = { "path" : self.pluginconf("basebackup_path") or "pg_basebackup",
+            "extra" : self.pluginconf("extra_parameters") or "",
+            "options" : self.basebackup_options() }
+        if bbparam["options"] is None:
+            return self.rd(False, "clone_basebackup is configured with compression but not tar format")
+        walcheck = self.check_wal_method(servername, bbparam["path"])
+        if self.failed(walcheck):
+            return walcheck
 
         bbparam.update({ "pgdata" : self.servers[servername]["pgdata"],
             "host" : self.servers[clonefrom]["hostname"],
             "port" : self.servers[clonefrom]["port"],
             "user" : self.conf["handyrep"]["replication_user"],
             "pass" : self.conf["passwords"]["replication_pass"]})
-        pgbbcmd = "%(path)s -x -D %(pgdata)s -h %(host)s -p %(port)d -U %(user)s %(extra)s" % bbparam
-        cloneit = self.run_as_replication(servername, [pgbbcmd,])
+        pgbbcmd = "%(path)s %(options)s -D %(pgdata)s -h %(host)s -p %(port)d -U %(user)s %(extra)s" % bbparam
+
+        progress = basebackup_progress(self.servers[servername], clonefrom)
+        cloneit = self.run_as_replication(servername, [pgbbcmd,], stream=progress)
+        if self.failed(cloneit):
+            progress.finish("failed")
+            return cloneit
+
+        # tar format leaves us with archives instead of a data directory
+        if self.pluginconf("format") == "tar":
+            untar = self.run_as_replication(servername, [self.untar_command(servername),])
+            if self.failed(untar):
+                progress.finish("failed")
+                return self.rd(False, "unable to extract base backup archives")
+
+        progress.finish("complete")
+        cloneit.update({ "progress" : self.servers[servername]["clone_progress"] })
         return cloneit
 
+    def basebackup_options(self):
+        # builds the pg_basebackup options from the plugin configuration
+        # returns None if the configuration is inconsistent
+        # -X is the same option in every version, whereas
+        # --xlog-method was renamed --wal-method in 10
+        walmethod = self.pluginconf("wal_method") or "stream"
+        opts = [ "-X %s" % walmethod, "--progress", "--verbose" ]
+
+        maxrate = self.pluginconf("max_rate")
+        if maxrate:
+            opts.append("--max-rate=%s" % maxrate)
+
+        compress = self.as_int(self.pluginconf("compress_level"))
+        if self.pluginconf("format") == "tar":
+            opts.append("--format=tar")
+            if compress:
+                opts.append("--gzip --compress=%d" % compress)
+        elif compress:
+            return None
+
+        return " ".join(opts)
+
+    def check_wal_method(self, servername, basebackup_path):
+        # pg_basebackup can only stream WAL with tar format
+        # from version 10, so checks the version on the replica
+        # which will run it
+        if self.pluginconf("format") != "tar" or (self.pluginconf("wal_method") or "stream") != "stream":
+            return self.rd(True, "wal_method is supported")
+        getver = self.run_as_postgres(servername, ["%s --version" % basebackup_path,])
+        if self.failed(getver):
+            return self.rd(False, "unable to check the version of pg_basebackup: %s" % getver["details"])
+        version = re.search(r'\(PostgreSQL\) (\d+)', str(getver["details"]))
+        if not version:
+            return self.rd(False, "unable to read the version of pg_basebackup from: %s" % getver["details"])
+        if int(version.group(1)) < 10:
+            return self.rd(False, "pg_basebackup before version 10 can't stream WAL with tar format; set wal_method = fetch")
+        return self.rd(True, "wal_method is supported")
+
+    def untar_command(self, servername):
+        # extracts base.tar and the streamed WAL into PGDATA
+        # then removes the archives
+        pgdata = self.servers[servername]["pgdata"]
+        if self.as_int(self.pluginconf("compress_level")):
+            suffix = ".tar.gz"
+            taropt = "xzf"
+        else:
+            suffix = ".tar"
+            taropt = "xf"
+
+        # streamed WAL is in pg_wal.tar from version 10
+        return "cd %(pgdata)s && tar %(taropt)s base%(suffix)s && rm -f base%(suffix)s && for waldir in pg_xlog pg_wal; do if [ -f $waldir%(suffix)s ]; then tar %(taropt)s $waldir%(suffix)s -C $waldir && rm -f $waldir%(suffix)s; fi; done" % { "pgdata" : pgdata, "taropt" : taropt, "suffix" : suffix }
+
     def test(self,servername):
         #check if we have a config
         if self.failed(self.test_plugin_conf("clone_basebackup","basebackup_path")):
             return self.rd(False, "clone_basebackup not properly configured")
+        if self.basebackup_options() is None:
+            return self.rd(False, "compress_level requires format = tar")
         #check if the basebackup executable
         #is available on the server
-        if self.failed(self.run_as_postgres(servername,"%s --help" % self.conf["plugins"]["clone_basebackup"]["basebackup_path"])):
+        if self.failed(self.run_as_postgres(servername,["%s --help" % self.conf["plugins"]["clone_basebackup"]["basebackup_path"],])):
             return self.rd(False, "pg_basebackup executable not found")
+        walcheck = self.check_wal_method(servername, self.conf["plugins"]["clone_basebackup"]["basebackup_path"])
+        if self.failed(walcheck):
+            return walcheck
 
         return self.rd(True, "clone_basebackup works")
+
+
+class basebackup_progress(object):
+    # file-like object which receives pg_basebackup output
+    # as it is streamed back over ssh, and keeps the
+    # server's clone_progress up to date
+
+    progress_re = re.compile(r'(\d+)/(\d+) kB \((\d+)%\), (\d+)/(\d+) tablespaces?')
+
+    def __init__(self, serverdef, clonefrom):
+        self.serverdef = serverdef
+        self.buffer = ""
+        self.serverdef["clone_progress"] = { "status" : "running",
+            "clone_from" : clonefrom,
+            "started" : now_string(),
+            "updated" : now_string(),
+            "bytes_done" : 0,
+            "bytes_total" : 0,
+            "percent" : 0,
+            "tablespaces_done" : 0,
+            "tablespaces_total" : 0,
+            "last_message" : "" }
+
+    def write(self, data):
+        # progress lines end in \r, other output in \n
+        self.buffer += data
+        lines = re.split(r'[\r\n]', self.buffer)
+        self.buffer = lines.pop()
+        for line in lines:
+            self.parse(line)
+
+    def flush(self):
+        return
+
+    def parse(self, line):
+        line = line.strip()
+        if not line:
+            return
+        progress = self.progress_re.search(line)
+        if progress:
+            self.serverdef["clone_progress"].update({
+                "bytes_done" : int(progress.group(1)) * 1024,
+                "bytes_total" : int(progress.group(2)) * 1024,
+                "percent" : int(progress.group(3)),
+                "tablespaces_done" : int(progress.group(4)),
+                "tablespaces_total" : int(progress.group(5)),
+                "updated" : now_string() })
+        else:
+            self.serverdef["clone_progress"].update({
+                "last_message" : line,
+                "updated" : now_string() })
+
+    def finish(self, status):
+        self.parse(self.buffer)
+        self.buffer = ""
+        self.serverdef["clone_progress"].update({ "status" : status,
+            "updated" : now_string() })
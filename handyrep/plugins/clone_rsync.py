@@ -1,9 +1,15 @@
 #plugin for cloning via Rsync.
-#currently deals with a linked WAL directory, but NOT with tablespaces.
+#splits PGDATA into chunks (top-level directories, each database
+#directory under base/, and each tablespace) and runs several
+#rsync workers at once on the replica.  finished chunks are
+#checkpointed in a state directory on the replica so that a failed
+#clone can be resumed, as long as the backup is still open on the master.
+#currently deals with a linked WAL directory.
 #assumes passwordless rsync
 
 from plugins.handyrepplugin import HandyRepPlugin
 import os.path
+import re
 
 class clone_rsync(HandyRepPlugin):
 
@@ -11,27 +17,77 @@ class clone_rsync(HandyRepPlugin):
         # we assume that upstream has already checked that it is safe
         # to reclone, so we don't worry about it
         if not clonefrom:
-            clonefrom = self.get_master_name()
-
-        myconf = self.get_myconf()
-        # issue pg_stop_backup() on the master
-        mconn = self.master_connection(mautocommit=True)
-        if not mconn:
-            return self.rd(False, "unable to connect to master server to start cloning")
+            clonefrom = self.clone_source(servername)
 
+        statedir = self.state_dir(servername)
         blabel = "hr_clone_%s" % servername
-        mcur = mconn.cursor()
-        bstart = self.execute_it(mcur, "SELECT pg_start_backup(%s, TRUE)", [blabel,])
-        mconn.close()
-        if not bstart:
-            return self.rd(False, "unable to start backup for cloning")
 
-        # rsync PGDATA on the replica
-        synccmd = self.rsync_command(servername, clonefrom)
-        syncit = self.run_as_postgres(servername, [synccmd,])
-        if self.failed(syncit):
+        # see if we can pick up where a failed clone left off
+        # we can only do that if the original backup is still open,
+        # otherwise the files already copied are useless
+        done = []
+        if self.is_true(self.pluginconf("resumable")):
+            done = self.read_checkpoint(servername)
+            if done and not self.backup_in_progress():
+                self.log("CLONE", "backup for previous clone of %s is no longer running, starting over" % servername)
+                done = []
+
+        if done:
+            self.log("CLONE", "resuming clone of %s, %d chunks already copied" % (servername, len(done),))
+        else:
+            clearit = self.run_as_postgres(servername, ["rm -rf %s" % statedir, "mkdir -p %s" % statedir,])
+            if self.failed(clearit):
+                return self.rd(False, "unable to create clone state directory %s" % statedir)
+
+            # issue pg_start_backup() on the master
+            try:
+                mconn = self.master_connection(mautocommit=True)
+            except Exception as ex:
+                return self.rd(False, "unable to connect to master server to start cloning")
+
+            mcur = mconn.cursor()
+            bstart = self.get_one_val(mcur, "SELECT pg_xlog_location_diff(pg_start_backup(%s, TRUE), '0/0')", [blabel,])
+            mconn.close()
+            if bstart is None:
+                return self.rd(False, "unable to start backup for cloning")
+
+            # if we're cloning from a replica, it needs to have replayed
+            # past the start of the backup before we copy anything
+            if clonefrom != self.get_master_name():
+                if not self.wait_for_replay(clonefrom, bstart):
+                    self.stop_backup(servername)
+                    return self.rd(False, "clone source %s did not catch up with the backup start location" % clonefrom)
+
+        chunks = self.chunk_list(servername, clonefrom)
+        if not chunks:
             self.stop_backup(servername)
-            return self.rd(False, "unable to rsync files")
+            return self.rd(False, "unable to list files to clone on %s" % clonefrom)
+
+        self.init_progress(servername, clonefrom, chunks, done)
+
+        # the root chunk creates the top-level directories,
+        # so it always runs first, on its own
+        todo = [ chunk for chunk in chunks if chunk["name"] not in done ]
+        batches = []
+        if todo and todo[0]["name"] == "root":
+            batches.append([todo.pop(0),])
+        # global/ holds pg_control, which needs to be copied last
+        # when we're cloning from a replica
+        lastbatch = [ chunk for chunk in todo if chunk["name"] == "global" ]
+        todo = [ chunk for chunk in todo if chunk["name"] != "global" ]
+        # biggest chunks first, so that the workers stay busy
+        todo.sort(key=lambda chunk: chunk["kb"], reverse=True)
+        workers = self.as_int(self.pluginconf("workers")) or 1
+        for i in range(0, len(todo), workers):
+            batches.append(todo[i:i + workers])
+        if lastbatch:
+            batches.append(lastbatch)
+
+        for batch in batches:
+            syncit = self.run_as_postgres(servername, [self.batch_command(servername, clonefrom, batch),])
+            self.update_progress(servername, chunks)
+            if self.failed(syncit):
+                return self.clone_failed(servername, "unable to rsync files")
 
         # wipe the replica's wal_location
         # we don't create this wal location, since there's
@@ -44,62 +100,240 @@ class clone_rsync(HandyRepPlugin):
 
         # failed?  something's wrong
         if self.failed(syncit):
-            self.stop_backup(servername)
-            return self.rd(False, "unable to rsync files; WAL directory is missing or broken")
+            return self.clone_failed(servername, "unable to rsync files; WAL directory is missing or broken")
+
+        # when cloning from a replica, the backup_label only
+        # exists on the master, so we need to fetch it from there
+        if clonefrom != self.get_master_name():
+            master = self.get_master_name()
+            labelcmd = self.rsync_command(master,
+                os.path.join(self.servers[master]["pgdata"], "backup_label"),
+                os.path.join(self.servers[servername]["pgdata"], "backup_label"))
+            syncit = self.run_as_postgres(servername, [labelcmd,])
+            if self.failed(syncit):
+                return self.clone_failed(servername, "unable to copy backup_label from master")
 
         # stop backup
         syncit = self.stop_backup(servername)
-        
+
         # yay, done!
         if self.succeeded(syncit):
-            return self.rd(True, "cloning succeeded")
+            self.run_as_postgres(servername, ["rm -rf %s" % statedir,])
+            self.set_progress(servername, status="complete")
+            return self.rd(True, "cloning succeeded", { "progress" : self.servers[servername]["clone_progress"] })
         else:
+            self.set_progress(servername, status="failed")
             return self.rd(False, "cloning failed; could not stop backup")
 
+    def clone_failed(self, servername, message):
+        # if we're resumable, leave the backup open and the checkpoint
+        # in place so that the next clone attempt can pick up from here
+        if self.is_true(self.pluginconf("resumable")):
+            self.set_progress(servername, status="failed")
+            return self.rd(False, "%s; clone can be resumed by recloning" % message, { "progress" : self.servers[servername]["clone_progress"] })
+        else:
+            self.stop_backup(servername)
+            self.set_progress(servername, status="failed")
+            return self.rd(False, message)
+
     def wal_path(self, servername):
-        myconf = self.get_myconf()
         if "wal_location" in self.servers[servername]:
             if self.servers[servername]["wal_location"]:
                 return self.servers[servername]["wal_location"]
 
         return os.path.join(self.servers[servername]["pgdata"], "pg_xlog")
 
-    def rsync_command(self, servername, clonefrom):
+    def state_dir(self, servername):
+        # directory on the replica where we keep track of finished chunks
+        # has to be outside PGDATA, or rsync --delete will remove it
+        statedir = self.pluginconf("state_directory")
+        if not statedir:
+            statedir = "%s.hr_clone" % self.servers[servername]["pgdata"].rstrip("/")
+        return statedir
+
+    def chunk_list(self, servername, clonefrom):
+        # builds the list of chunks to copy: one for the files in the
+        # root of PGDATA, one for each top-level directory, one for each
+        # database directory in base/, and one for each tablespace
+        # each chunk has a name, a source, a destination and a size in kB
+        srcdata = self.servers[clonefrom]["pgdata"].rstrip("/")
+        repdata = self.servers[servername]["pgdata"].rstrip("/")
+        listcmd = "cd %s && find . base -mindepth 1 -maxdepth 1 -type d ! -path ./base ! -path ./pg_xlog ! -path ./pg_log -print0 | xargs -0 du -sk" % srcdata
+        listit = self.run_as_postgres(clonefrom, [listcmd,])
+        if self.failed(listit):
+            return None
+
+        chunks = [{ "name" : "root", "source" : srcdata, "dest" : repdata, "kb" : 0, "recurse" : False },]
+        for line in str(listit["details"]).splitlines():
+            sizedir = line.strip().split(None, 1)
+            if len(sizedir) != 2 or not sizedir[0].isdigit():
+                continue
+            reldir = re.sub(r'^\./', '', sizedir[1])
+            chunks.append({ "name" : reldir.replace("/", "_"),
+                "source" : "%s/%s" % (srcdata, reldir,),
+                "dest" : "%s/%s" % (repdata, reldir,),
+                "kb" : int(sizedir[0]),
+                "recurse" : True })
+
+        # tablespaces are copied to the same location on the replica
+        # the pg_tblspc symlinks come along with the pg_tblspc chunk
+        try:
+            sconn = self.connection(clonefrom)
+            scur = sconn.cursor()
+            scur.execute("""SELECT oid, pg_tablespace_location(oid) FROM pg_tablespace
+                WHERE spcname NOT IN ( 'pg_default', 'pg_global' )""")
+            tablespaces = scur.fetchall()
+            sconn.close()
+        except Exception as ex:
+            self.log("CLONE", "unable to list tablespaces on %s: %s" % (clonefrom, self.exstr(ex),), True)
+            return None
+
+        for spcoid, spcloc in tablespaces:
+            chunks.append({ "name" : "tblspc_%s" % spcoid,
+                "source" : spcloc,
+                "dest" : spcloc,
+                "kb" : 0,
+                "recurse" : True })
+
+        return chunks
+
+    def batch_command(self, servername, clonefrom, batch):
+        # runs one rsync per chunk in the batch in parallel
+        # and fails if any of them did not get checkpointed
+        statedir = self.state_dir(servername)
+        jobs = []
+        for chunk in batch:
+            jobs.append("( mkdir -p %s && %s > %s/%s.stats 2>&1 && echo %s >> %s/done ) &" % (chunk["dest"], self.chunk_command(clonefrom, chunk), statedir, chunk["name"], chunk["name"], statedir,))
+
+        names = " ".join([ chunk["name"] for chunk in batch ])
+        return "%s wait; for c in %s; do grep -qxF $c %s/done || exit 1; done" % (" ".join(jobs), names, statedir,)
+
+    def chunk_command(self, clonefrom, chunk):
+        # create rsync command line for a single chunk
+        if chunk["recurse"]:
+            return self.rsync_command(clonefrom, chunk["source"] + "/", chunk["dest"] + "/", "-a --delete --stats")
+        else:
+            # just the files in the root of PGDATA, and the empty
+            # top-level directories for the other chunks to fill in
+            return self.rsync_command(clonefrom, chunk["source"] + "/", chunk["dest"] + "/", "-dlptgoD --delete --stats --exclude postmaster.pid --exclude recovery.conf --exclude recovery.done --exclude postgresql.conf --exclude pg_log --exclude pg_xlog")
+
+    def rsync_command(self, clonefrom, source, dest, rsopts="-a"):
         # create rsync command line
-        myconf = self.get_myconf()
-        if self.is_true(myconf["use_compression"]):
+        if self.is_true(self.pluginconf("use_compression")):
             compopt = " -z "
         else:
             compopt = ""
 
-        if myconf["rsync_path"]:
-            rsloc = myconf["rsync_path"]
-        else:
+        rsloc = self.pluginconf("rsync_path")
+        if not rsloc:
             rsloc = "rsync"
 
-        if self.is_true(myconf["use_ssh"]):
-            if myconf["ssh_path"]:
-                sshloc = myconf["ssh_path"]
-            else:
+        sshopt = ""
+        if self.is_true(self.pluginconf("use_ssh")):
+            sshloc = self.pluginconf("ssh_path")
+            if not sshloc:
                 sshloc = "ssh"
-                
+
             sshopt = """ -e "%s -o Compression=no -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -c arcfour" """ % sshloc
 
-        mastdata = "%s:%s" % (self.servers[clonefrom]["hostname"], self.servers[clonefrom]["pgdata"],)
-        repdata = self.servers[servername]["pgdata"]
-        rscmd = """%s -av --delete --exclude postmaster.pid --exclude recovery.conf --exclude recovery.done --exclude postgresql.conf --exclude pg_log --exclude pg_xlog %s %s %s/* %s""" % (rsloc, compopt, sshopt, mastdata, repdata,)
-        return rscmd
+        extra = self.pluginconf("extra_parameters")
+        if not extra:
+            extra = ""
+
+        return """%s %s %s %s %s %s:%s %s""" % (rsloc, rsopts, compopt, sshopt, extra, self.servers[clonefrom]["hostname"], source, dest,)
+
+    def read_checkpoint(self, servername):
+        # returns the list of chunks already copied
+        readit = self.run_as_postgres(servername, ["cat %s/done" % self.state_dir(servername),])
+        if self.failed(readit):
+            return []
+        return [ line.strip() for line in str(readit["details"]).splitlines() if line.strip() ]
+
+    def backup_in_progress(self):
+        try:
+            mconn = self.master_connection()
+        except Exception as ex:
+            return False
+        mcur = mconn.cursor()
+        inbackup = self.get_one_val(mcur, "SELECT pg_is_in_backup()")
+        mconn.close()
+        return inbackup
+
+    def wait_for_replay(self, clonefrom, startpos):
+        # waits for the replica we're cloning from to replay
+        # past the backup start position
+        for i in range(0, self.conf["failover"]["recovery_retries"]):
+            try:
+                rconn = self.connection(clonefrom)
+                rcur = rconn.cursor()
+                replayed = self.get_one_val(rcur, "SELECT pg_xlog_location_diff(pg_last_xlog_replay_location(), '0/0')")
+                rconn.close()
+            except Exception as ex:
+                replayed = None
+
+            if replayed is not None and replayed >= startpos:
+                return True
+            self.failwait()
+
+        return False
+
+    def init_progress(self, servername, clonefrom, chunks, done):
+        self.servers[servername]["clone_progress"] = { "status" : "running",
+            "clone_from" : clonefrom,
+            "started" : self.now_string(),
+            "updated" : self.now_string(),
+            "chunks_total" : len(chunks),
+            "chunks_done" : len(done),
+            "bytes_total" : sum([ chunk["kb"] for chunk in chunks ]) * 1024,
+            "bytes_done" : sum([ chunk["kb"] for chunk in chunks if chunk["name"] in done ]) * 1024,
+            "bytes_transferred" : 0,
+            "files_transferred" : 0 }
+        return
+
+    def set_progress(self, servername, **kwargs):
+        kwargs["updated"] = self.now_string()
+        self.servers[servername]["clone_progress"].update(kwargs)
+        return
+
+    def update_progress(self, servername, chunks):
+        # rereads the checkpoint and the rsync stats for
+        # each finished chunk, and updates clone_progress
+        statedir = self.state_dir(servername)
+        done = self.read_checkpoint(servername)
+        statcmd = "cd %s && grep -H -E '^(Number of (regular )?files transferred|Total transferred file size)' *.stats" % statedir
+        statit = self.run_as_postgres(servername, [statcmd,])
+        nbytes = 0
+        nfiles = 0
+        if self.succeeded(statit):
+            for line in str(statit["details"]).splitlines():
+                statmatch = re.match(r'(.+)\.stats:(.+): ([\d,]+)', line.strip())
+                if not statmatch or statmatch.group(1) not in done:
+                    continue
+                statval = int(statmatch.group(3).replace(",", ""))
+                if statmatch.group(2).startswith("Total"):
+                    nbytes += statval
+                else:
+                    nfiles += statval
+
+        self.set_progress(servername,
+            chunks_done = len(done),
+            bytes_done = sum([ chunk["kb"] for chunk in chunks if chunk["name"] in done ]) * 1024,
+            bytes_transferred = nbytes,
+            files_transferred = nfiles)
+        self.log("CLONE", "clone of %s: %d of %d chunks done" % (servername, len(done), len(chunks),))
+        return
 
     def stop_backup(self, servername):
-        
-        mconn = self.master_connection(mautocommit=True)
-        if not mconn:
+
+        try:
+            mconn = self.master_connection(mautocommit=True)
+        except Exception as ex:
             return self.rd(False, "unable to connect to master server to stop backup")
 
         mcur = mconn.cursor()
         bstart = self.execute_it(mcur, "SELECT pg_stop_backup()")
         mconn.close()
-        
+
         if not bstart:
             return self.rd(False, "unable to stop backup")
         else:
@@ -111,7 +345,7 @@ class clone_rsync(HandyRepPlugin):
             return self.rd(False, "clone_rsync not properly configured")
         #check if the basebackup executable
         #is available on the server
-        if self.failed(self.run_as_postgres(servername,"%s --help" % self.conf["plugins"]["clone_rsync"]["rsync_path"])):
+        if self.failed(self.run_as_postgres(servername,["%s --help" % self.conf["plugins"]["clone_rsync"]["rsync_path"],])):
             return self.rd(False, "rsync executable not found")
 
         return self.rd(True, "clone_rsync works")
@@ -0,0 +1,20 @@
+# cloning plugin for simulated clusters
+# takes clone_per_gb seconds per GB of the source
+# server's simulated size.  see simulator.py
+
+from plugins.handyrepplugin import HandyRepPlugin
+from lib.simcluster import get_cluster
+
+class clone_sim(HandyRepPlugin):
+
+    def run(self, servername, clonefrom=None, reclone=False):
+        if not clonefrom:
+            clonefrom = self.clone_source(servername)
+        cluster = get_cluster(self.conf["handyrep"]["cluster_name"])
+        if cluster.clone(servername, clonefrom):
+            return self.rd(True, "cloned %s from %s" % (servername, clonefrom,))
+        else:
+            return self.rd(False, "unable to clone %s from %s" % (servername, clonefrom,))
+
+    def test(self, servername):
+        return self.rd(True, "simulated cloning works")
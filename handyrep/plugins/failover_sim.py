@@ -0,0 +1,24 @@
+# connection failover plugin for simulated clusters
+# keeps track of which server a simulated connection proxy
+# points to.  see simulator.py
+
+from plugins.handyrepplugin import HandyRepPlugin
+from lib.simcluster import get_cluster
+
+class failover_sim(HandyRepPlugin):
+
+    def run(self, newmaster=None):
+        if not newmaster:
+            newmaster = self.get_master_name()
+        cluster = get_cluster(self.conf["handyrep"]["cluster_name"])
+        cluster.switch_proxy(newmaster)
+        return self.rd(True, "simulated proxy now points to %s" % newmaster)
+
+    def init(self, proxyserver=None):
+        return self.run()
+
+    def poll(self, proxyserver=None):
+        return self.rd(True, "simulated proxy is running")
+
+    def test(self):
+        return self.rd(True, "simulated connection failover works")
@@ -1,22 +1,28 @@
-from fabric.api import sudo, run, env, local, settings, shell_env
-from fabric.network import disconnect_all
-from fabric.contrib.files import upload_template, exists
+from lib.lazyimport import lazy_module
 #from fabric.context_managers import shell_env
 from lib.error import CustomError
 from lib.dbfunctions import get_one_val, get_one_row, execute_it, get_pg_conn
 from lib.misc_utils import ts_string, string_ts, now_string, succeeded, failed, return_dict, exstr, lock_fabric, fabric_unlock_all
+from lib.metrics import SSH_SECONDS, DB_CONNECT_SECONDS
+from lib.sshcommand import ssh_command, SSH_FAILED
 import json
 from datetime import datetime, timedelta
 import logging
 import time
 import psycopg2
 import psycopg2.extensions
+import importlib
 from os.path import join
 from subprocess import call
 import re
 import threading
 import traceback
 
+# imported when first used; see handyrep.py
+fabric_api = lazy_module("fabric.api")
+fabric_network = lazy_module("fabric.network")
+fabric_files = lazy_module("fabric.contrib.files")
+
 class HandyRepPlugin(object):
 
     def __init__(self, conf, servers):
@@ -24,30 +30,61 @@ class HandyRepPlugin(object):
         self.servers = servers
         return
 
-    def sudorun(self, servername, commands, runas, passwd="", sshpass=None):
+    def sudorun(self, servername, commands, runas, passwd="", sshpass=None, stream=None):
         # generic function to run one or more commands
         # as a specific remote user.  returns the results
         # of the last command run.  aborts when any
         # command fails
-        lock_fabric()
-        if sshpass:
-            env.password = sshpass
-        else:
-            env.key_filename = self.servers[servername]["ssh_key"]
-            
-        env.user = self.servers[servername]["ssh_user"]
-        env.disable_known_hosts = True
-        env.host_string = self.servers[servername]["hostname"]
-        rundict = return_dict(True, "no commands provided", {"return_code" : None })
+        # if stream is supplied, command output is written
+        # to it as it arrives, as well as being returned.
+        # commands run over the ssh client, without locking
+        # fabric, unless logging in with a password
         if passwd is None:
             pgpasswd = ""
         else:
             pgpasswd = passwd
+        if sshpass:
+            return self.fabric_sudorun(servername, commands, runas, pgpasswd, sshpass, stream)
+
+        serv = self.servers[servername]
+        rundict = return_dict(True, "no commands provided", {"return_code" : None })
+        starttime = time.time()
+        for command in commands:
+            return_code, output = ssh_command(serv["hostname"], serv["ssh_user"], serv["ssh_key"],
+                command, runas, { "PGPASSWORD" : pgpasswd }, stream)
+            rundict = self.ssh_result(return_code, output)
+            if failed(rundict):
+                break
 
+        SSH_SECONDS.observe(time.time() - starttime, server=servername, user=runas, result=rundict["result"].lower())
+        return rundict
+
+    def ssh_result(self, return_code, output):
+        # return dictionary for a command run by ssh_command
+        if return_code == SSH_FAILED:
+            return { "result" : "FAIL",
+                "details" : "connection failure: %s" % output,
+                "return_code" : None }
+        return return_dict(return_code == 0, output, { "return_code" : return_code })
+
+    def fabric_sudorun(self, servername, commands, runas, pgpasswd, sshpass, stream=None):
+        # sudorun for password logins, which the ssh client
+        # can't do unattended.  holds the fabric lock throughout
+        lock_fabric()
+        fabric_api.env.password = sshpass
+        fabric_api.env.user = self.servers[servername]["ssh_user"]
+        fabric_api.env.disable_known_hosts = True
+        fabric_api.env.host_string = self.servers[servername]["hostname"]
+        rundict = return_dict(True, "no commands provided", {"return_code" : None })
+        starttime = time.time()
         for command in commands:
             try:
-                with shell_env(PGPASSWORD=pgpasswd):
-                    runit = sudo(command, user=runas, warn_only=True,pty=False, quiet=True)
+                with fabric_api.shell_env(PGPASSWORD=pgpasswd):
+                    if stream:
+                        with fabric_api.hide('running', 'warnings'):
+                            runit = fabric_api.sudo(command, user=runas, warn_only=True, pty=False, stdout=stream, stderr=stream)
+                    else:
+                        runit = fabric_api.sudo(command, user=runas, warn_only=True,pty=False, quiet=True)
                 rundict.update({ "details" : runit ,
                     "return_code" : runit.return_code })
                 if runit.succeeded:
@@ -60,7 +97,8 @@ class HandyRepPlugin(object):
                     "details" : "connection failure: %s" % self.exstr(ex),
                     "return_code" : None }
                 break
-        
+
+        SSH_SECONDS.observe(time.time() - starttime, server=servername, user=runas, result=rundict["result"].lower())
         self.disconnect_and_unlock()
         return rundict
 
@@ -69,13 +107,13 @@ class HandyRepPlugin(object):
         pwd = self.conf["passwords"]["superuser_pass"]
         return self.sudorun(servername, commands, pguser, pwd)
 
-    def run_as_replication(self, servername, commands):
+    def run_as_replication(self, servername, commands, stream=None):
         # we actually use the command-line superuser for this
         # since the replication user doesn't generally have a shell
         # account
         pguser = self.conf["handyrep"]["postgres_superuser"]
         pwd = self.conf["passwords"]["replication_pass"]
-        return self.sudorun(servername, commands, pguser, pwd)
+        return self.sudorun(servername, commands, pguser, pwd, stream=stream)
 
     def run_as_root(self, servername, commands):
         return self.sudorun(servername, commands, "root")
@@ -85,31 +123,18 @@ class HandyRepPlugin(object):
         # exiting when the first command fails
         # returns a dic with the results of the last command
         # run
-        lock_fabric()
-        env.key_filename = self.servers[servername]["ssh_key"]
-        env.user = self.servers[servername]["ssh_user"]
-        env.disable_known_hosts = True
-        env.host_string = self.servers[servername]["hostname"]
+        serv = self.servers[servername]
         rundict = { "result": "SUCCESS",
             "details" : "no commands provided",
             "return_code" : None }
+        starttime = time.time()
         for command in commands:
-            try:
-                runit = run(command, warn_only=True, quiet=True)
-                rundict.update({ "details" : runit ,
-                    "return_code" : runit.return_code })
-                if runit.succeeded:
-                    rundict.update({"result":"SUCCESS"})
-                else:
-                    rundict.update({"result":"FAIL"})
-                    break
-            except Exception as ex:
-                rundict = { "result" : "FAIL",
-                    "details" : "connection failure: %s" % exstr(ex),
-                    "return_code" : None }
+            return_code, output = ssh_command(serv["hostname"], serv["ssh_user"], serv["ssh_key"], command)
+            rundict = self.ssh_result(return_code, output)
+            if failed(rundict):
                 break
 
-        self.disconnect_and_unlock()
+        SSH_SECONDS.observe(time.time() - starttime, server=servername, user=serv["ssh_user"], result=rundict["result"].lower())
         return rundict
 
     def run_local(self, commands):
@@ -136,30 +161,31 @@ class HandyRepPlugin(object):
         # checks whether a particular file or directory path
         # exists
         # returns only true or false rather than RD
-        env.key_filename = self.servers[servername]["ssh_key"]
-        env.user = self.servers[servername]["ssh_user"]
-        env.disable_known_hosts = True
-        env.host_string = self.servers[servername]["hostname"]
-        if exists(filepath, use_sudo=True):
-            return True
-        else:
-            return False
+        lock_fabric()
+        fabric_api.env.key_filename = self.servers[servername]["ssh_key"]
+        fabric_api.env.user = self.servers[servername]["ssh_user"]
+        fabric_api.env.disable_known_hosts = True
+        fabric_api.env.host_string = self.servers[servername]["hostname"]
+        try:
+            return fabric_files.exists(filepath, use_sudo=True)
+        finally:
+            self.disconnect_and_unlock()
 
     def push_template(self, servername, templatename, destination, template_params, new_owner=None, file_mode=700):
         # renders a template file and pushes it to the
         # target location on an external server
         # not implemented for writing to localhost at this time
         lock_fabric()
-        env.key_filename = self.servers[servername]["ssh_key"]
-        env.user = self.servers[servername]["ssh_user"]
-        env.disable_known_hosts = True
-        env.host_string = self.servers[servername]["hostname"]
+        fabric_api.env.key_filename = self.servers[servername]["ssh_key"]
+        fabric_api.env.user = self.servers[servername]["ssh_user"]
+        fabric_api.env.disable_known_hosts = True
+        fabric_api.env.host_string = self.servers[servername]["hostname"]
         try:
-            upload_template( templatename, destination, use_jinja=True, context=template_params, template_dir=self.conf["handyrep"]["templates_dir"], use_sudo=True )
+            fabric_files.upload_template( templatename, destination, use_jinja=True, context=template_params, template_dir=self.conf["handyrep"]["templates_dir"], use_sudo=True )
             if file_mode:
-                sudo("chmod %d %s" % (file_mode, destination,), quiet=True)
+                fabric_api.sudo("chmod %d %s" % (file_mode, destination,), quiet=True)
             if new_owner:
-                sudo("chown %s %s" % (new_owner, destination,), quiet=True)
+                fabric_api.sudo("chown %s %s" % (new_owner, destination,), quiet=True)
         except:
             self.log('PLUGIN','could not push template %s to server %s - %s' % (templatename,servername, traceback.format_exc()),True)
             retdict = return_dict(False, "could not push template %s to server %s" % (templatename, servername,))
@@ -224,6 +250,23 @@ class HandyRepPlugin(object):
         # handle it
         return None
 
+    def clone_source(self, replicaserver):
+        # default server to clone from, for clone plugins called
+        # without one.  uses clone_source_method, like HandyRep.clone,
+        # and falls back to the master
+        selname = self.get_conf("handyrep","clone_source_method")
+        if selname:
+            try:
+                selmodule = importlib.import_module("plugins.%s" % selname)
+                sources = getattr(selmodule, selname)(self.conf, self.servers).run(replicaserver)
+            except Exception as ex:
+                self.log("CLONE", "clone source selection %s failed: %s" % (selname, exstr(ex),), True)
+                sources = None
+            if sources:
+                return sources[0]
+
+        return self.get_master_name()
+
     def connection(self, servername, autocommit=False):
         # connects as the handyrep user to a remote database
         connect_string = "dbname=%s host=%s port=%s user=%s application_name=handyrep " % (self.conf["handyrep"]["handyrep_db"], self.servers[servername]["hostname"], self.servers[servername]["port"], self.conf["handyrep"]["handyrep_user"],)
@@ -232,7 +275,9 @@ class HandyRepPlugin(object):
                 connect_string += " password=%s " % self.conf["passwords"]["handyrep_db_pass"]
 
         try:
-            conn = psycopg2.connect( connect_string )
+            with DB_CONNECT_SECONDS.time(server=servername) as timer:
+                conn = psycopg2.connect( connect_string )
+                timer.labels["result"] = "success"
         except:
             raise CustomError("DBCONN","ERROR: Unable to connect to Postgres using the connections string %s" % connect_string)
 
@@ -335,7 +380,7 @@ class HandyRepPlugin(object):
             return None
 
     def disconnect_and_unlock(self):
-        disconnect_all()
+        fabric_network.disconnect_all()
         lock_fabric(False)
         return True
 
@@ -23,9 +23,12 @@
         debug_auth = False
 '''
 
-import ldap
-
 from plugins.handyrepplugin import HandyRepPlugin
+from lib.lazyimport import lazy_module
+
+# imported on the first login, so that hdaemon
+# starts without loading it
+ldap = lazy_module("ldap")
 
 class ldap_auth(HandyRepPlugin):
 
@@ -0,0 +1,257 @@
+# handyrep master selector for running two or more handyrep
+# servers against the same cluster.  the handyrep servers elect
+# a leader by holding a lease, and only the leader is the HR master.
+# three backends are available:
+#   lease      a row in the handyrep schema on the master,
+#              holding the name of the leader and an expiry time
+#              taken from the database clock
+#   advisory   a PostgreSQL advisory lock on the master, held by a
+#              connection kept open between checks
+#   file       a lease file on the local machine, for testing
+#              several handyrep servers on one machine
+# the result is cached, and the lease is only renewed once a third
+# of lease_seconds has passed, so most checks cost nothing.
+# if the lease can't be renewed because of an error, the leader
+# stays HR master only until its lease runs out, less lease_margin
+# seconds for clock drift, timed from when it last renewed by the
+# local clock; after that another server may hold the lease.
+# but if it can't be renewed because the master can't be reached,
+# the leader stays HR master: the lease is kept on the master, so
+# otherwise no server would be HR master to fail it over
+
+from plugins.handyrepplugin import HandyRepPlugin
+from lib.error import CustomError
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+import zlib
+import psycopg2
+
+# leader state for each cluster, kept between checks,
+# since the plugin object is created anew for each check
+leader_state = {}
+state_lock = threading.Lock()
+
+class lease_hr_master(HandyRepPlugin):
+
+    def run(self, params=None):
+        backend = self.backend()
+        if backend not in ("lease", "advisory", "file"):
+            return self.rd(False, "unknown lease backend %s" % backend)
+
+        with state_lock:
+            state = leader_state.setdefault(self.conf["handyrep"]["cluster_name"],
+                { "backend" : backend, "is_master" : False, "holder" : None,
+                "checked" : 0, "renewed" : 0, "conn" : None, "table_ready" : False,
+                "unreachable" : False })
+            if state["backend"] != backend:
+                self.release(state)
+                state.update({ "backend" : backend, "is_master" : False, "holder" : None, "checked" : 0, "renewed" : 0 })
+
+            now = time.time()
+            if now - state["checked"] < self.renew_interval():
+                return self.result(state, "cached")
+
+            try:
+                if backend == "lease":
+                    state["is_master"], state["holder"] = self.lease_row(state)
+                elif backend == "advisory":
+                    state["is_master"] = self.advisory_lock(state)
+                    state["holder"] = self.holder_name() if state["is_master"] else None
+                else:
+                    state["is_master"], state["holder"] = self.lease_file()
+            except Exception as ex:
+                # a lease we already hold stays good until it
+                # runs out, or while the master is unreachable;
+                # result() checks that
+                state["unreachable"] = self.store_unreachable(ex)
+                self.log("HRMASTER", "could not renew %s lease: %s" % (backend, self.exstr(ex),), True)
+                return self.result(state, "lease unavailable")
+
+            state["unreachable"] = False
+            if state["is_master"]:
+                # timed from before the renewal was asked for,
+                # so that we never think it lasts longer than it does
+                state["renewed"] = now
+            state["checked"] = now
+            return self.result(state, "renewed" if state["is_master"] else "checked")
+
+    def test(self, params=None):
+        backend = self.backend()
+        if backend not in ("lease", "advisory", "file"):
+            return self.rd(False, "unknown lease backend %s" % backend)
+        if backend == "file" and not self.pluginconf("lease_file"):
+            return self.rd(False, "lease_file must be set for the file backend")
+        if not self.lease_seconds():
+            return self.rd(False, "lease_seconds must be a positive integer")
+        return self.rd(True, "lease configuration passed", {"is_master" : False})
+
+    def result(self, state, how):
+        if state["is_master"] and time.time() >= self.valid_until(state):
+            if state["unreachable"]:
+                # no other server can take the lease while the master
+                # is down, and we must stay HR master to fail it over.
+                # a server cut off from a healthy master is kept from
+                # failing over by failure_quorum, not by this plugin
+                how = "kept while the master is unreachable"
+            else:
+                self.log("HRMASTER", "HR master lease ran out without being renewed", True)
+                state["is_master"] = False
+                state["holder"] = None
+        if state["is_master"]:
+            details = "this server holds the %s lease (%s)" % (state["backend"], how,)
+        else:
+            details = "lease held by %s (%s)" % (state["holder"] or "another server", how,)
+        return self.rd(True, details, { "is_master" : state["is_master"], "leader" : state["holder"] })
+
+    # configuration
+
+    def backend(self):
+        return self.pluginconf("backend") or "lease"
+
+    def lease_seconds(self):
+        return self.as_int(self.pluginconf("lease_seconds")) or 60
+
+    def renew_interval(self):
+        return self.lease_seconds() / 3.0
+
+    def lease_margin(self):
+        margin = self.as_int(self.pluginconf("lease_margin"))
+        if margin is None:
+            margin = self.lease_seconds() / 4.0
+        return margin
+
+    def valid_until(self, state):
+        # local time after which we must assume the lease is lost
+        return state["renewed"] + self.lease_seconds() - self.lease_margin()
+
+    def store_unreachable(self, ex):
+        # whether a renewal failed because the master, where the
+        # lease is kept, couldn't be reached, rather than an error
+        if isinstance(ex, CustomError):
+            return ex.errortype == "DBCONN"
+        return isinstance(ex, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+    def holder_name(self):
+        return self.pluginconf("holder_name") or "%s:%d" % (socket.gethostname(), os.getpid(),)
+
+    def lease_tabname(self):
+        return '"%s"."%s_lease"' % (self.conf["handyrep"]["handyrep_schema"], self.conf["handyrep"]["handyrep_table"],)
+
+    # backends
+
+    def lease_row(self, state):
+        # takes or renews the lease row for the cluster, using the
+        # database clock so that the handyrep servers' clocks don't
+        # need to agree.  returns whether we hold it, and who does
+        holder = self.holder_name()
+        cluster = self.conf["handyrep"]["cluster_name"]
+        conn = self.master_connection()
+        try:
+            cur = conn.cursor()
+            if not state["table_ready"]:
+                cur.execute("""CREATE TABLE IF NOT EXISTS %s ( cluster_name text primary key,
+                    holder text not null, acquired timestamptz not null, expires timestamptz not null )""" % self.lease_tabname())
+                conn.commit()
+                state["table_ready"] = True
+
+            lease = "%d seconds" % self.lease_seconds()
+            cur.execute("""UPDATE """ + self.lease_tabname() + """ SET
+                acquired = CASE WHEN holder = %s THEN acquired ELSE now() END,
+                holder = %s, expires = now() + %s::interval
+                WHERE cluster_name = %s AND ( holder = %s OR expires < now() )
+                RETURNING holder""", [holder, holder, lease, cluster, holder,])
+            if not cur.fetchone():
+                # no row yet, or someone else holds it
+                cur.execute("""INSERT INTO """ + self.lease_tabname() + """
+                    SELECT %s, %s, now(), now() + %s::interval
+                    WHERE NOT EXISTS ( SELECT 1 FROM """ + self.lease_tabname() + """ WHERE cluster_name = %s )""",
+                    [cluster, holder, lease, cluster,])
+            current = self.get_one_val(cur, "SELECT holder FROM " + self.lease_tabname() + " WHERE cluster_name = %s", [cluster,])
+            conn.commit()
+        except psycopg2.IntegrityError:
+            # another server inserted the row first
+            conn.rollback()
+            return False, None
+        finally:
+            conn.close()
+
+        if current == holder and not state["is_master"]:
+            self.log("HRMASTER", "this server is now the HR master")
+        elif current != holder and state["is_master"]:
+            self.log("HRMASTER", "lost HR master lease to %s" % current, True)
+        return current == holder, current
+
+    def advisory_lock(self, state):
+        # holds a session advisory lock on a connection which is kept
+        # open between checks.  renewing just checks that the
+        # connection is still alive; if it isn't, the lock is gone
+        # and we try to take it again.  if the master can't be
+        # reached to do so, run() keeps us HR master as for the
+        # lease backend, since nobody else can hold the lock either
+        conn = state["conn"]
+        if conn is not None:
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT 1")
+                cur.close()
+                return True
+            except psycopg2.Error:
+                self.log("HRMASTER", "lost advisory lock connection, reconnecting", state["is_master"])
+                self.release(state)
+
+        conn = self.master_connection(True)
+        cur = conn.cursor()
+        cur.execute("SELECT pg_try_advisory_lock(%s)", [self.lock_key(),])
+        locked = cur.fetchone()[0]
+        cur.close()
+        if locked:
+            state["conn"] = conn
+            if not state["is_master"]:
+                self.log("HRMASTER", "this server is now the HR master")
+        else:
+            conn.close()
+            if state["is_master"]:
+                self.log("HRMASTER", "advisory lock taken by another server", True)
+        return locked
+
+    def lock_key(self):
+        key = self.as_int(self.pluginconf("lock_key"))
+        if key is None:
+            key = zlib.crc32(self.conf["handyrep"]["cluster_name"]) & 0x7fffffff
+        return key
+
+    def release(self, state):
+        if state["conn"] is not None:
+            try:
+                state["conn"].close()
+            except psycopg2.Error:
+                pass
+            state["conn"] = None
+
+    def lease_file(self):
+        # same as lease_row, but in a local file locked with flock
+        holder = self.holder_name()
+        leasepath = self.pluginconf("lease_file")
+        with open(leasepath, "a+") as leasef:
+            fcntl.flock(leasef, fcntl.LOCK_EX)
+            try:
+                leasef.seek(0)
+                try:
+                    lease = json.loads(leasef.read())
+                except ValueError:
+                    lease = {}
+                now = time.time()
+                if lease.get("holder") == holder or lease.get("expires", 0) < now:
+                    lease = { "holder" : holder, "expires" : now + self.lease_seconds() }
+                    leasef.seek(0)
+                    leasef.truncate()
+                    leasef.write(json.dumps(lease))
+                    leasef.flush()
+                    os.fsync(leasef.fileno())
+            finally:
+                fcntl.flock(leasef, fcntl.LOCK_UN)
+        return lease["holder"] == holder, lease["holder"]
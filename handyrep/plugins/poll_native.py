@@ -0,0 +1,72 @@
+# plugin method for polling servers for uptime
+# works like poll_isready, with the same return codes, but
+# speaks the PostgreSQL protocol itself instead of running
+# pg_isready, so doesn't need PostgreSQL installed on the
+# Handyrep server, or a new process for each poll.
+# run_many polls a list of servers all at once.
+
+# does do repeated polling per fail_retries, since we need to do different
+# kinds of polling in different plugins
+
+from plugins.handyrepplugin import HandyRepPlugin
+from lib.pgping import ping_many
+from lib.probeengine import DEFAULT_MAX_IN_FLIGHT
+import time
+
+class poll_native(HandyRepPlugin):
+
+    def get_target(self, servername):
+        serv = self.servers[servername]
+        return ( serv["hostname"], serv["port"], self.conf["handyrep"]["handyrep_user"], self.conf["handyrep"]["handyrep_db"], )
+
+    def get_timeout(self):
+        # pg_isready's default timeout
+        return self.as_int(self.pluginconf("connect_timeout")) or 3
+
+    def get_max_in_flight(self):
+        return self.as_int(self.pluginconf("max_in_flight")) or DEFAULT_MAX_IN_FLIGHT
+
+    def run(self, servername):
+        return self.run_many([servername,])[servername]
+
+    def run_many(self, servernames):
+        # polls all of the servers at once, then repolls the
+        # ones which didn't respond, for fail_retries tries.
+        # returns a dictionary of servername : result, with the
+        # time taken to get a response, including any retries
+        results = {}
+        starttime = time.time()
+        pending = list(servernames)
+        retries = self.conf["failover"]["fail_retries"]
+        for i in range(0, max(retries, 1)):
+            if i > 0:
+                self.failwait()
+            waited = time.time() - starttime
+            pings = ping_many(dict((servname, self.get_target(servname)) for servname in pending),
+                self.get_timeout(), self.get_max_in_flight())
+            pending = []
+            for servname, (return_code, latency) in pings.iteritems():
+                if return_code in [0,1,]:
+                    results[servname] = self.rd(True, "poll succeeded", {"return_code" : return_code, "latency" : waited + latency})
+                elif return_code == 3:
+                    results[servname] = self.rd(False, "invalid configuration for poll_native", {"return_code" : return_code})
+                else:
+                    pending.append(servname)
+            if not pending:
+                break
+
+        # if we've gotten here, then all polls of these have failed
+        for servname in pending:
+            results[servname] = self.rd(False, "polling failed after %d tries" % retries, {"return_code" : 2})
+        return results
+
+    def test(self):
+        # checks that we can poll the master
+        master = self.get_master_name()
+        if not master:
+            return self.rd(False, "master not configured, aborting")
+        pollres = self.run_many([master,])[master]
+        if pollres["return_code"] in [0,1,2]:
+            return self.rd(True, "polling works")
+        else:
+            return self.rd(False, "invalid configuration for poll_native")
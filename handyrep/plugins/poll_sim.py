@@ -0,0 +1,24 @@
+# plugin method for polling servers in a simulated cluster
+# see simulator.py.  behaves like poll_isready, including
+# retrying fail_retries times before reporting failure
+
+from plugins.handyrepplugin import HandyRepPlugin
+from lib.simcluster import get_cluster
+
+class poll_sim(HandyRepPlugin):
+
+    def run(self, servername):
+        cluster = get_cluster(self.conf["handyrep"]["cluster_name"])
+        if cluster.poll(servername):
+            return self.rd(True, "poll succeeded", {"return_code" : 0})
+
+        retries = self.conf["failover"]["fail_retries"]
+        for i in range(1,retries):
+            self.failwait()
+            if cluster.poll(servername):
+                return self.rd(True, "poll succeeded", {"return_code" : 0})
+
+        return self.rd(False, "polling failed after %d tries" % retries, {"return_code" : 2})
+
+    def test(self):
+        return self.rd(True, "simulated polling works")
@@ -0,0 +1,17 @@
+# plugin method for promoting a replica in a simulated
+# cluster.  see simulator.py
+
+from plugins.handyrepplugin import HandyRepPlugin
+from lib.simcluster import get_cluster
+
+class promote_sim(HandyRepPlugin):
+
+    def run(self, servername):
+        cluster = get_cluster(self.conf["handyrep"]["cluster_name"])
+        if cluster.promote(servername):
+            return self.rd(True, "promoted %s" % servername, {"return_code" : 0})
+        else:
+            return self.rd(False, "promotion of %s failed" % servername, {"return_code" : 1})
+
+    def test(self, servername):
+        return self.rd(True, "simulated promotion works")
@@ -0,0 +1,32 @@
+# plugin which checks replication status and lag
+# in a simulated cluster.  lag follows the curve set
+# for each replica in the simulator.  see simulator.py
+
+# returns: success == ran successfully
+# replication : am I replcating or not?
+# lag : how much lag do I have, in MB?
+
+from plugins.handyrepplugin import HandyRepPlugin
+from lib.simcluster import get_cluster
+
+class replication_sim(HandyRepPlugin):
+
+    def run(self, replicaserver):
+        cluster = get_cluster(self.conf["handyrep"]["cluster_name"])
+        master = self.get_master_name()
+        if not master:
+            return self.rd(False, "master not configured")
+        try:
+            cluster.connect(master).close()
+        except:
+            return self.rd(False, "could not connect to master")
+
+        replag = cluster.replication_lag(replicaserver)
+        if replag is not None:
+            self.servers[replicaserver]["lag"] = replag
+            return self.rd(True, "server is replicating", { "replicating" : True, "lag" : replag, "lag_unit" : "MB" })
+        else:
+            return self.rd(True, "server %s is not currently in replication" % replicaserver, { "replicating" : False, "lag" : 0, "lag_unit" : "MB" })
+
+    def test(self, replicaserver):
+        return self.run(replicaserver)
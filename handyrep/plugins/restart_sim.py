@@ -0,0 +1,30 @@
+# plugin method for start/stop/restart/reload of
+# servers in a simulated cluster.  see simulator.py
+
+from plugins.handyrepplugin import HandyRepPlugin
+from lib.simcluster import get_cluster
+
+class restart_sim(HandyRepPlugin):
+
+    def run(self, servername, runmode):
+        cluster = get_cluster(self.conf["handyrep"]["cluster_name"])
+        if runmode == "start":
+            done = cluster.start_server(servername)
+        elif runmode in ("stop", "faststop",):
+            done = cluster.stop_server(servername)
+        elif runmode == "restart":
+            done = cluster.stop_server(servername) and cluster.start_server(servername)
+        elif runmode == "reload":
+            done = cluster.ssh(servername) and cluster.is_up(servername)
+        elif runmode == "status":
+            done = cluster.ssh(servername) and cluster.is_up(servername)
+        else:
+            return self.rd( False, "unsupported restart mode %s" % runmode )
+
+        if done:
+            return self.rd( True, "%s of %s succeeded" % (runmode, servername,), {"return_code" : 0} )
+        else:
+            return self.rd( False, "%s of %s failed" % (runmode, servername,), {"return_code" : 1} )
+
+    def test(self, servername):
+        return self.rd( True, "simulated restart works" )
@@ -0,0 +1,63 @@
+# plugin to select the server to clone a new replica from
+# scores healthy replicas by replication lag, number of
+# connections and recent read I/O, using the stats
+# cached on each server by verify_replica.
+# as with replica selection, it returns a LIST of servers,
+# best candidate first.  the master is not included;
+# HandyRep falls back to it if the list is empty
+
+from plugins.handyrepplugin import HandyRepPlugin
+from datetime import datetime
+
+class select_clone_source_least_loaded(HandyRepPlugin):
+
+    def run(self, replicaserver=None):
+        # assemble a list of healthy replicas with fresh stats
+        maxage = self.as_int(self.pluginconf("max_stats_age"))
+        candidates = {}
+        for serv, servdeets in self.servers.iteritems():
+            if serv == replicaserver:
+                continue
+            if not (servdeets["enabled"] and servdeets["status_no"] == 1 and servdeets["role"] == "replica"):
+                continue
+            stats = servdeets.get("load_stats")
+            if not stats:
+                continue
+            if maxage:
+                statsts = self.string_ts(stats["stats_ts"])
+                if not statsts or (datetime.now() - statsts).total_seconds() > maxage:
+                    continue
+            candidates[serv] = { "lag" : float(servdeets.get("lag") or 0),
+                "connections" : float(stats["connections"] or 0),
+                "io" : float(stats["blks_read_rate"] or 0),
+                "priority" : servdeets["failover_priority"] }
+
+        if not candidates:
+            return []
+
+        # normalize each measure against the busiest candidate
+        # so that the weights are comparable
+        weights = { "lag" : self.weight("lag_weight"),
+            "connections" : self.weight("connection_weight"),
+            "io" : self.weight("io_weight") }
+        maxvals = {}
+        for measure in weights.keys():
+            maxvals[measure] = max([ cand[measure] for cand in candidates.values() ]) or 1.0
+
+        self.scores = {}
+        for serv, cand in candidates.iteritems():
+            score = 0.0
+            for measure, weight in weights.iteritems():
+                score += weight * cand[measure] / maxvals[measure]
+            self.scores[serv] = ( score, cand["priority"], )
+
+        return sorted(self.scores, key=self.scores.get)
+
+    def weight(self, confkey):
+        weight = self.pluginconf(confkey)
+        if weight is None or weight == "":
+            return 1.0
+        return float(weight)
+
+    def test(self, replicaserver=None):
+        return self.rd( True, "least loaded selection always succeeds" )
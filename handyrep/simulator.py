@@ -0,0 +1,281 @@
+# HandyRep cluster simulator
+# runs the real HandyRep object against a simulated cluster of
+# N servers, using the *_sim plugins and lib/simcluster.py,
+# so that polling and failover can be benchmarked without
+# any PostgreSQL servers or VMs.
+#
+# example:
+#   python simulator.py --servers 3,30,300 --scenario master_crash
+#
+# prints one JSON result per scenario and cluster size,
+# with detection time, failover duration, write downtime
+# and the CPU time used by HandyRep
+
+from handyrep import HandyRep
+from lib.simcluster import SimCluster, register, FAILURES
+from lib.misc_utils import return_dict
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+class SimHandyRep(HandyRep):
+    # HandyRep with its direct database and ssh access
+    # replaced by the simulated cluster.  everything else,
+    # including all plugin calls, goes through the real code
+
+    def __init__(self, config_file, cluster):
+        self.cluster = cluster
+        self.failover_started = None
+        HandyRep.__init__(self, config_file)
+
+    def connection(self, servername, autocommit=False):
+        return self.cluster.connect(servername)
+
+    def test_ssh(self, servername):
+        return self.cluster.ssh(servername)
+
+    def test_ssh_newhost(self, hostname, ssh_key, ssh_user):
+        return True
+
+    def push_replica_conf(self, replicaserver, newmaster=None):
+        if not newmaster:
+            newmaster = self.get_master_name()
+        if self.cluster.set_upstream(replicaserver, newmaster):
+            return return_dict(True, "pushed new replica configuration")
+        else:
+            return return_dict(False, "could not push new replication configuration")
+
+    def auto_failover(self):
+        self.failover_started = time.time()
+        return HandyRep.auto_failover(self)
+
+def server_names(numservers):
+    return [ "sim%03d" % servno for servno in range(numservers) ]
+
+def write_config(workdir, clustername, servernames, options):
+    # writes a handyrep.conf for the simulated cluster
+    # the first server is the master
+    templates = os.path.join(os.path.dirname(os.path.realpath(__file__)), "templates")
+    conf = """[handyrep]
+cluster_name = %(clustername)s
+override_server_file = True
+server_file = %(workdir)s/servers.save
+authentication_method = zero_auth
+master_check_method = one_hr_master
+log_verbose = False
+log_file = %(workdir)s/handyrep.log
+templates_dir = %(templates)s
+trace_history = 20
+
+[passwords]
+
+[failover]
+auto_failover = True
+poll_method = poll_sim
+poll_interval = 1
+verify_frequency = %(verify_frequency)d
+fail_retries = %(fail_retries)d
+fail_retry_interval = %(fail_retry_interval)d
+recovery_retries = 3
+selection_method = select_replica_priority
+remaster = %(remaster)s
+restart_master = False
+failure_quorum = %(failure_quorum)d
+quorum_sources = replicas,
+connection_failover = True
+connection_failover_method = failover_sim
+replication_status_method = replication_sim
+
+[extra_failover_commands]
+
+[archive]
+archiving = False
+
+[server_defaults]
+restart_method = restart_sim
+promotion_method = promote_sim
+clone_method = clone_sim
+lag_limit = %(lag_limit)d
+
+[servers]
+""" % { "clustername" : clustername, "workdir" : workdir, "templates" : templates,
+        "verify_frequency" : options.verify_frequency,
+        "fail_retries" : options.fail_retries,
+        "fail_retry_interval" : options.fail_retry_interval,
+        "remaster" : options.remaster,
+        "failure_quorum" : options.failure_quorum,
+        "lag_limit" : options.lag_limit }
+
+    for servno, servname in enumerate(servernames):
+        conf += """    [[%s]]
+        hostname = %s
+        role = %s
+        failover_priority = %d
+        enabled = True
+""" % (servname, servname, "master" if servno == 0 else "replica", servno + 1,)
+
+    conffile = os.path.join(workdir, "handyrep.conf")
+    with open(conffile, "w") as conff:
+        conff.write(conf)
+    return conffile
+
+def build_cluster(numservers, options, workdir):
+    # creates and registers the simulated cluster,
+    # then starts a SimHandyRep against it
+    names = server_names(numservers)
+    clustername = "sim%d_%d" % (numservers, int(time.time() * 1000),)
+    cluster = SimCluster(names, names[0], options.time_scale, jitter=options.jitter, seed=options.seed)
+    for servname in names[1:]:
+        if options.lag_curve == "linear":
+            cluster.set_lag(servname, "linear", start=0.0, rate=options.lag_rate)
+        elif options.lag_curve == "sine":
+            cluster.set_lag(servname, "sine", base=options.lag_limit / 2.0, amplitude=options.lag_limit, period=30.0)
+        else:
+            cluster.set_lag(servname, "constant", value=0.0)
+    register(clustername, cluster)
+    conffile = write_config(workdir, clustername, names, options)
+    hr = SimHandyRep(conffile, cluster)
+    return hr, cluster
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def run_cycle(hr, pollno):
+    # one failover check, as run by hdaemon's periodic
+    # returns the next poll number and the cycle duration
+    cyclestart = time.time()
+    sleep, pollno = hr.failover_check_cycle(pollno)
+    return pollno, time.time() - cyclestart
+
+def scenario_steady(hr, cluster, options):
+    # no failures: measures the cost of each failover check
+    pollno = 1
+    durations = []
+    cpustart = cpu_seconds()
+    for cycle in range(options.cycles):
+        pollno, duration = run_cycle(hr, pollno)
+        durations.append(duration)
+        time.sleep(options.poll_interval)
+    durations.sort()
+    return { "cycles" : len(durations),
+        "cycle_seconds_avg" : round(sum(durations) / len(durations), 4),
+        "cycle_seconds_p99" : round(durations[min(len(durations) - 1, int(len(durations) * 0.99))], 4),
+        "cycle_seconds_max" : round(durations[-1], 4),
+        "cpu_seconds" : round(cpu_seconds() - cpustart, 4),
+        "cluster_status" : hr.status["status"] }
+
+def scenario_master_crash(hr, cluster, options):
+    # fails the master after crash_after seconds and runs
+    # failover checks until HandyRep has failed over
+    master = hr.get_master_name()
+    cluster.inject(master, options.failure, at=cluster.now() + options.crash_after)
+    pollno = 1
+    cycles = 0
+    cpustart = cpu_seconds()
+    deadline = time.time() + options.timeout
+    while not hr.failover_history and time.time() < deadline:
+        pollno, duration = run_cycle(hr, pollno)
+        cycles += 1
+        if not hr.failover_history:
+            time.sleep(options.poll_interval)
+
+    failtime = cluster.failure_time(master, options.failure)
+    result = { "cycles" : cycles,
+        "cpu_seconds" : round(cpu_seconds() - cpustart, 4),
+        "failure" : options.failure,
+        "failed_over" : bool(hr.failover_history) }
+    if hr.failover_history:
+        failover = hr.failover_history[-1]
+        result.update({ "detection_seconds" : round(hr.failover_started - failtime, 3),
+            "failover_seconds" : failover["duration"],
+            "write_downtime_seconds" : failover["write_downtime"],
+            "failover_result" : failover["result"],
+            "new_master" : failover["new_master"],
+            "phases" : [ (phase["phase"], phase["duration"], phase["outcome"]) for phase in failover["phases"] ] })
+    return result
+
+SCENARIOS = { "steady" : scenario_steady,
+    "master_crash" : scenario_master_crash }
+
+def run_scenario(scenario, numservers, options):
+    workdir = tempfile.mkdtemp(prefix="handyrep-sim-")
+    try:
+        setupstart = time.time()
+        hr, cluster = build_cluster(numservers, options, workdir)
+        hr.verify_all()
+        result = { "scenario" : scenario,
+            "servers" : numservers,
+            "time_scale" : options.time_scale,
+            "poll_interval" : options.poll_interval,
+            "setup_seconds" : round(time.time() - setupstart, 3) }
+        result.update(SCENARIOS[scenario](hr, cluster, options))
+        return result
+    finally:
+        if options.keep:
+            sys.stderr.write("simulation files kept in %s\n" % workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Run HandyRep against a simulated cluster")
+    parser.add_argument("--servers", default="3,30,300",
+        help="comma-separated list of cluster sizes to simulate")
+    parser.add_argument("--scenario", default="all", choices=sorted(SCENARIOS.keys()) + ["all",])
+    parser.add_argument("--failure", default="crash", choices=FAILURES[:3],
+        help="how the master fails in the master_crash scenario")
+    parser.add_argument("--crash-after", type=float, default=2.0,
+        help="seconds before the master fails")
+    parser.add_argument("--cycles", type=int, default=10,
+        help="failover checks to run in the steady scenario")
+    parser.add_argument("--poll-interval", type=float, default=0.5,
+        help="seconds between failover checks")
+    parser.add_argument("--verify-frequency", type=int, default=5)
+    parser.add_argument("--fail-retries", type=int, default=2)
+    parser.add_argument("--fail-retry-interval", type=int, default=0)
+    parser.add_argument("--failure-quorum", type=int, default=0,
+        help="replicas which must also lose the master before failover")
+    parser.add_argument("--remaster", action="store_true",
+        help="remaster the other replicas after failover")
+    parser.add_argument("--time-scale", type=float, default=0.1,
+        help="multiplier for all simulated latencies")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--lag-curve", default="constant", choices=("constant", "linear", "sine",))
+    parser.add_argument("--lag-rate", type=float, default=1.0,
+        help="MB per second for the linear lag curve")
+    parser.add_argument("--lag-limit", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--timeout", type=float, default=300.0,
+        help="maximum seconds to wait for a failover")
+    parser.add_argument("--keep", action="store_true",
+        help="keep the generated configuration and logs")
+    parser.add_argument("--output", default=None,
+        help="also write the results to this file")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    if options.scenario == "all":
+        scenarios = sorted(SCENARIOS.keys())
+    else:
+        scenarios = [options.scenario,]
+
+    results = []
+    for numservers in [ int(num) for num in options.servers.split(",") ]:
+        for scenario in scenarios:
+            result = run_scenario(scenario, numservers, options)
+            results.append(result)
+            print json.dumps(result)
+
+    if options.output:
+        with open(options.output, "w") as outf:
+            json.dump(results, outf, indent=2)
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# client for the handyrep daemon, used by the views.
+# keeps one pooled HTTP session for all calls, caches the
+# results of read-only calls for a few seconds, and makes
+# sure that each page render asks for the same thing only once
+
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from flask import g, has_request_context
+
+# calls which don't change anything, and so can be cached
+READ_ONLY = ("get_status", "get_server_info", "get_cluster_status", "get_master_name",
+    "get_servers_by_role", "get_dashboard", "read_log", "get_setting", "get_archive_status",
+    "get_failover_history")
+
+class HandyRepClient(object):
+
+    def __init__(self, address, username, password, cache_ttl=2.0, pool_size=10):
+        self.address = address.rstrip("/")
+        self.cache_ttl = cache_ttl
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def request(self, function, params=None):
+        # uncached call, returns the requests response
+        url_to_send = "{address}/{function}".format(address=self.address, function=function)
+        return self.session.get(url_to_send, params=params)
+
+    def call(self, function, params=None):
+        # returns the decoded result of a call.  read-only calls are
+        # shared within a page render and cached for cache_ttl seconds;
+        # any other call clears the cache, since it may change things
+        if function not in READ_ONLY:
+            self.clear_cache()
+            return self.request(function, params).json()
+
+        key = (function, tuple(sorted((params or {}).items())))
+        if has_request_context():
+            if not hasattr(g, "handyrep_calls"):
+                g.handyrep_calls = {}
+            if key in g.handyrep_calls:
+                return g.handyrep_calls[key]
+
+        now = time.time()
+        with self.lock:
+            cached = self.cache.get(key)
+        if cached and now - cached[0] < self.cache_ttl:
+            result = cached[1]
+        else:
+            result = self.request(function, params).json()
+            with self.lock:
+                self.cache[key] = (now, result)
+
+        if has_request_context():
+            g.handyrep_calls[key] = result
+        return result
+
+    def clear_cache(self):
+        with self.lock:
+            self.cache = {}
+        if has_request_context():
+            g.handyrep_calls = {}
+
+    def close(self):
+        self.session.close()
+
+    def get_status(self):
+        return self.call("get_status")
+
+    def get_server_info(self, server_name):
+        return self.call("get_server_info", {"servername": str(server_name)})
+
+    def get_master_name(self):
+        return self.call("get_master_name")
+
+    def dashboard(self, server_name=None):
+        # status and server information for a page in one
+        # round trip.  returns status, server_info
+        params = {}
+        if server_name:
+            params["servername"] = str(server_name)
+        dash = self.call("get_dashboard", params)
+        if "status" not in dash:
+            # older daemons don't have get_dashboard
+            if server_name:
+                return self.get_status(), self.get_server_info(server_name)
+            return self.get_status(), None
+        if server_name:
+            return dash["status"], dash["servers"]
+        return dash["status"], None
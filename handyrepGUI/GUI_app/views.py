@@ -6,6 +6,7 @@ import requests, json
 from GUI_app import app
 import Dictionary
 from forms import AddressForm, FunctionForm, ClusterForm
+from client import HandyRepClient
 
 
 global handyrep_address
@@ -16,17 +17,14 @@ global password
 password = None
 global function_parameters
 function_parameters = {}
+global client
+client = None
 
 def get_status():
-    url_to_send = "{address}/get_status".format(address=handyrep_address)
-    status = requests.get(url_to_send, auth=(username, password)).json()
-    return status
+    return client.get_status()
 
 def get_server_info(server_name):
-    params = {"servername": str(server_name)}
-    url_to_send = "{address}/get_server_info".format(address=handyrep_address)
-    request= requests.get(url_to_send,params=params, auth=(username,password))
-    return request.json()
+    return client.get_server_info(server_name)
 
 @app.route('/logout/')
 def logout():
@@ -36,6 +34,10 @@ def logout():
     username = None
     global password
     password = None
+    global client
+    if client:
+        client.close()
+    client = None
     return redirect('index')
 
 
@@ -49,14 +51,16 @@ def login():
         username = form.username.data
         global password
         password = form.password.data
-        url_to_send = "{address}/get_master_name".format(address=handyrep_address)
+        global client
+        client = HandyRepClient(handyrep_address, username, password, app.config.get("CLIENT_CACHE_TTL", 2.0))
         try:
-            r = requests.get(url_to_send, auth=(username, password))
+            r = client.request("get_master_name")
         except:
             message = "There is something wrong with the address, please try again."
             handyrep_address = None
             username = None
             password = None
+            client = None
 
             return render_template('login.html', form=form, message=message)
         if r.status_code in range(400, 500):
@@ -82,10 +86,8 @@ def index():
 def server_actions(server_name):
     if handyrep_address is None or username is None or password is None:
         return redirect(url_for("login"))
-    #status information
-    status = get_status()
-    #server information
-    server_info = get_server_info(server_name)
+    #status and server information
+    status, server_info = client.dashboard(server_name)
     if server_info.get(server_name)["role"] == "master" or server_info.get(server_name)["role"] == "replica":
         functions = getattr(Dictionary, server_info.get(server_name)["role"])
     else:
@@ -108,10 +110,8 @@ def cluster_actions():
 def function_detail(server_name, function):
     if handyrep_address is None or username is None or password is None:
         return redirect(url_for("login"))
-    #status information
-    status = get_status()
-    #function parameters
-    server_info = get_server_info(server_name)
+    #status information and function parameters
+    status, server_info = client.dashboard(server_name)
     function_info = Dictionary.Functions.get(function)
     if len(function_info["params"]) > 1:
         form = FunctionForm()
@@ -140,9 +140,7 @@ def function_detail(server_name, function):
                 if params["param_default"]:
                     if params["param_type"] == "text":
                         if params["param_default"] == "current master":
-                            url_to_send = "{address}/get_master_name".format(address=handyrep_address)
-                            r = requests.get(url_to_send, auth=(username, password))
-                            getattr(form, 'textdata').data = r.json()
+                            getattr(form, 'textdata').data = client.get_master_name()
                         else:
                             getattr(form, 'textdata').data = params["param_default"]
                     if params["param_type"] == "bool":
@@ -208,11 +206,10 @@ def results(server_name, function):
         server_info = get_server_info(server_name)
 
     function_info = Dictionary.Functions.get(function)
-    url_to_send = "{address}/{function}".format(address=handyrep_address, function = function)
-    if function_parameters is None:
-        x = requests.get(url_to_send, auth=(username, password))
-    else:
-        x = requests.get(url_to_send, params=function_parameters, auth=(username, password))
+    x = client.request(function, function_parameters)
+    # the function may have changed the cluster, so
+    # don't show cached status afterwards
+    client.clear_cache()
     if not x.status_code == requests.codes.OK:
         if x.status_code == 500:
             function_parameters = {}
@@ -7,3 +7,6 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 CSRF_ENABLED = True
 SECRET_KEY = 'GUI-secret-key-597621139'
 DEFAULT_HANDYREP = 'http://localhost:8080'
+# seconds for which status from handyrep is reused
+# between page views
+CLIENT_CACHE_TTL = 2.0
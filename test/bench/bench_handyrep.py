@@ -0,0 +1,367 @@
+# HandyRep benchmark suite
+# measures the performance of handyrep.py and hdaemon against
+# the simulated cluster in handyrep/lib/simcluster.py:
+#
+#   api        requests/second and latency of get_status,
+#              get_server_info, read_log and get_cluster_status,
+#              through hdaemon's Flask app
+#   polling    poll_all and verify_all duration by cluster size
+#   write      write_servers duration by cluster size
+#   failover   wall time of a complete auto-failover by cluster size
+#   probes     pings/second and latency of the probe engine, with
+#              1000 servers polled at once by default, against a
+#              local fake PostgreSQL server
+#
+# results are saved as JSON.  if a baseline results file is given,
+# each metric is compared against it, and the script exits with
+# status 1 if any metric is worse than the baseline by more than
+# the tolerance.
+#
+# example:
+#   python test/bench/bench_handyrep.py --output current.json --baseline baseline.json
+#
+# simulated latencies are off by default (--time-scale 0), so that
+# only the time spent in HandyRep itself is measured
+
+import argparse
+import base64
+import json
+import os
+import platform
+import resource
+import select
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+HANDYREP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))), "handyrep")
+sys.path.insert(0, HANDYREP_DIR)
+
+# hdaemon redirects stdout to stderr, so keep a reference
+# to the real one for the results
+stdout = sys.stdout
+
+import simulator
+import hdaemon
+import daemon.daemonfunctions as hrdf
+from lib.simcluster import clusters
+from lib.pgping import ping_many, PING_OK
+
+API_FUNCTIONS = ("get_status", "get_server_info", "read_log", "get_cluster_status")
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+def ms(seconds):
+    return round(seconds * 1000, 3)
+
+def timings(values):
+    # summary of a list of durations in seconds
+    return { "runs" : len(values),
+        "avg_ms" : ms(sum(values) / len(values)),
+        "p50_ms" : ms(percentile(values, 50)),
+        "p99_ms" : ms(percentile(values, 99)),
+        "max_ms" : ms(max(values)) }
+
+def time_call(func, repeat, setup=None):
+    # setup, if given, is called untimed before each run
+    durations = []
+    for run in range(repeat):
+        if setup:
+            setup(run)
+        start = time.time()
+        func()
+        durations.append(time.time() - start)
+    return durations
+
+class bench_cluster(object):
+    # context manager which creates a SimHandyRep against
+    # a fresh simulated cluster, and cleans up after it
+
+    def __init__(self, numservers, options):
+        self.numservers = numservers
+        self.simopts = simulator.parse_args(["--time-scale", str(options.time_scale),
+            "--jitter", "0", "--seed", "1", "--poll-interval", "0",
+            "--crash-after", "0", "--fail-retries", "1", "--fail-retry-interval", "0"])
+
+    def __enter__(self):
+        self.workdir = tempfile.mkdtemp(prefix="handyrep-bench-")
+        self.hr, self.cluster = simulator.build_cluster(self.numservers, self.simopts, self.workdir)
+        self.hr.verify_all()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        clusters.pop(self.hr.conf["handyrep"]["cluster_name"], None)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+        return False
+
+def bench_api(options):
+    # requests through the Flask app, as a client would make them
+    results = {}
+    with bench_cluster(options.api_servers, options) as bc:
+        hrdf.default_cluster = hrdf.add_cluster(bc.hr)
+        client = hdaemon.app.test_client()
+        # hdaemon always wants credentials, although
+        # the simulator's zero_auth accepts any
+        headers = { "Authorization" : "Basic %s" % base64.b64encode("bench:bench") }
+        for funcname in API_FUNCTIONS:
+            url = "/%s" % funcname
+            # warm up
+            for run in range(min(10, options.requests)):
+                client.get(url, headers=headers)
+            durations = []
+            benchstart = time.time()
+            for run in range(options.requests):
+                start = time.time()
+                resp = client.get(url, headers=headers)
+                durations.append(time.time() - start)
+                if resp.status_code != 200:
+                    raise Exception("%s returned HTTP status %d" % (url, resp.status_code,))
+            result = timings(durations)
+            result["requests_per_second"] = round(options.requests / (time.time() - benchstart), 1)
+            results[funcname] = result
+    return results
+
+def bench_polling(options):
+    results = {}
+    for numservers in options.sizes:
+        with bench_cluster(numservers, options) as bc:
+            results[str(numservers)] = { "poll_all" : timings(time_call(bc.hr.poll_all, options.repeat)),
+                "verify_all" : timings(time_call(bc.hr.verify_all, options.repeat)) }
+    return results
+
+def bench_write(options):
+    # each write follows a status change, as in a failover
+    # check, since unchanged state isn't rewritten
+    results = {}
+    for numservers in options.sizes:
+        with bench_cluster(numservers, options) as bc:
+            master = bc.hr.get_master_name()
+            def change_status(run):
+                bc.hr.servers[master]["status_message"] = "bench write %d" % run
+            results[str(numservers)] = timings(time_call(bc.hr.write_servers, options.repeat, change_status))
+    return results
+
+def bench_failover(options):
+    # full auto-failover, from the master crash to the
+    # end of the failover, on a new cluster each run
+    results = {}
+    for numservers in options.sizes:
+        walltimes = []
+        for run in range(options.failover_runs):
+            with bench_cluster(numservers, options) as bc:
+                start = time.time()
+                result = simulator.scenario_master_crash(bc.hr, bc.cluster, bc.simopts)
+                if not result["failed_over"] or result["failover_result"] != "SUCCESS":
+                    raise Exception("failover of %d servers did not succeed: %s" % (numservers, json.dumps(result),))
+                walltimes.append(time.time() - start)
+        results[str(numservers)] = timings(walltimes)
+    return results
+
+class fake_postgres(object):
+    # context manager running a server in a thread, which answers
+    # every startup message with a password request, as PostgreSQL
+    # does, for the probes benchmark.  returns the port
+
+    def __enter__(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(4096)
+        self.listener.setblocking(0)
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.listener.getsockname()[1]
+
+    def serve(self):
+        reply = "R" + struct.pack("!ii", 12, 5) + "salt"
+        epoll = select.epoll()
+        epoll.register(self.listener.fileno(), select.EPOLLIN)
+        conns = {}
+        while self.running:
+            for fd, event in epoll.poll(0.1):
+                if fd == self.listener.fileno():
+                    while True:
+                        try:
+                            conn, addr = self.listener.accept()
+                        except socket.error:
+                            break
+                        conn.setblocking(0)
+                        conns[conn.fileno()] = conn
+                        epoll.register(conn.fileno(), select.EPOLLIN)
+                    continue
+                conn = conns[fd]
+                try:
+                    data = conn.recv(4096)
+                except socket.error:
+                    data = ""
+                if data and data[0] != "X":
+                    conn.send(reply)
+                else:
+                    epoll.unregister(fd)
+                    del conns[fd]
+                    conn.close()
+        epoll.close()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.running = False
+        self.thread.join()
+        self.listener.close()
+        return False
+
+def open_files_for(needed):
+    # raises the limit on open files if we can, and
+    # returns how many probes can be in flight at once
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        if hard == resource.RLIM_INFINITY or hard >= needed:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+            soft = needed
+        else:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+    # each probe needs a socket at each end
+    return max((soft - 100) // 2, 1)
+
+def bench_probes(options):
+    # rounds of pings of many servers at once, with the
+    # latency of each ping from when it was started
+    results = {}
+    with fake_postgres() as port:
+        for numtargets in options.probe_targets:
+            in_flight = min(numtargets, open_files_for(numtargets * 2 + 100))
+            targets = dict((target, ("127.0.0.1", port, "bench", "bench")) for target in range(numtargets))
+            latencies = []
+            benchstart = time.time()
+            for run in range(options.probe_rounds):
+                pings = ping_many(targets, 5, in_flight)
+                failed = [ target for target, (result, latency) in pings.iteritems() if result != PING_OK ]
+                if failed:
+                    raise Exception("%d of %d pings failed" % (len(failed), numtargets,))
+                latencies.extend([ latency for result, latency in pings.itervalues() ])
+            result = timings(latencies)
+            result["probes_per_second"] = round(len(latencies) / (time.time() - benchstart), 1)
+            result["in_flight"] = in_flight
+            results[str(numtargets)] = result
+    return results
+
+BENCHMARKS = { "api" : bench_api,
+    "polling" : bench_polling,
+    "write" : bench_write,
+    "failover" : bench_failover,
+    "probes" : bench_probes }
+
+def flatten(results):
+    # metric name, value and direction for each compared metric
+    # throughput is better higher, everything else lower
+    metrics = {}
+    def walk(prefix, node):
+        for key, val in node.iteritems():
+            name = "%s.%s" % (prefix, key) if prefix else key
+            if isinstance(val, dict):
+                walk(name, val)
+            elif key in ("requests_per_second", "probes_per_second"):
+                metrics[name] = (val, "higher")
+            elif key in ("avg_ms", "p99_ms"):
+                metrics[name] = (val, "lower")
+    walk("", results)
+    return metrics
+
+def compare(current, baseline, tolerance, min_ms):
+    # returns a list of regressions.  latencies below min_ms
+    # are too small to compare reliably and are skipped
+    regressions = []
+    basemetrics = flatten(baseline)
+    for name, (value, better) in sorted(flatten(current).iteritems()):
+        if name not in basemetrics:
+            continue
+        basevalue = basemetrics[name][0]
+        if not basevalue:
+            continue
+        if better == "lower":
+            if max(value, basevalue) < min_ms:
+                continue
+            change = (value - basevalue) / float(basevalue)
+        else:
+            change = (basevalue - value) / float(basevalue)
+        if change > tolerance:
+            regressions.append({ "metric" : name,
+                "baseline" : basevalue,
+                "current" : value,
+                "change_pct" : round(change * 100, 1) })
+    return regressions
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark HandyRep against a simulated cluster")
+    parser.add_argument("--bench", default="all", choices=sorted(BENCHMARKS.keys()) + ["all",])
+    parser.add_argument("--sizes", default="3,30,300",
+        help="comma-separated cluster sizes for the polling, write and failover benchmarks")
+    parser.add_argument("--api-servers", type=int, default=30,
+        help="cluster size for the api benchmark")
+    parser.add_argument("--requests", type=int, default=500,
+        help="requests per function for the api benchmark")
+    parser.add_argument("--repeat", type=int, default=20,
+        help="runs of each polling and write benchmark")
+    parser.add_argument("--failover-runs", type=int, default=3)
+    parser.add_argument("--probe-targets", default="1000",
+        help="comma-separated numbers of servers to ping at once for the probes benchmark")
+    parser.add_argument("--probe-rounds", type=int, default=10,
+        help="rounds of pings for the probes benchmark")
+    parser.add_argument("--time-scale", type=float, default=0.0,
+        help="multiplier for simulated latencies; 0 measures HandyRep alone")
+    parser.add_argument("--output", default=None,
+        help="file to save the results to")
+    parser.add_argument("--baseline", default=None,
+        help="results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+        help="fraction by which a metric may be worse than the baseline")
+    parser.add_argument("--min-ms", type=float, default=1.0,
+        help="ignore latencies below this in comparisons")
+    options = parser.parse_args(argv)
+    options.sizes = [ int(size) for size in options.sizes.split(",") ]
+    options.probe_targets = [ int(targets) for targets in options.probe_targets.split(",") ]
+    return options
+
+def main(argv=None):
+    options = parse_args(argv)
+    if options.bench == "all":
+        benches = sorted(BENCHMARKS.keys())
+    else:
+        benches = [options.bench,]
+
+    results = { "started" : time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python" : platform.python_version(),
+        "host" : platform.node(),
+        "time_scale" : options.time_scale,
+        "results" : {} }
+    for bench in benches:
+        results["results"][bench] = BENCHMARKS[bench](options)
+
+    exitcode = 0
+    if options.baseline:
+        with open(options.baseline, "r") as basef:
+            baseline = json.load(basef)
+        regressions = compare(results["results"], baseline["results"], options.tolerance, options.min_ms)
+        results["baseline"] = { "file" : options.baseline,
+            "started" : baseline.get("started"),
+            "regressions" : regressions }
+        if regressions:
+            exitcode = 1
+
+    if options.output:
+        with open(options.output, "w") as outf:
+            json.dump(results, outf, indent=2, sort_keys=True)
+    stdout.write(json.dumps(results, indent=2, sort_keys=True) + "\n")
+    return exitcode
+
+if __name__ == "__main__":
+    sys.exit(main())
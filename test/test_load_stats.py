@@ -0,0 +1,61 @@
+# tests that the load statistics cached by update_load_stats can
+# be saved, against the simulated cluster in handyrep/lib/simcluster.py
+#
+#   python test/test_load_stats.py
+
+from decimal import Decimal
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+HANDYREP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "handyrep")
+sys.path.insert(0, HANDYREP_DIR)
+
+import simulator
+from lib.simcluster import clusters
+
+class numeric_cursor(object):
+    # cursor answering the load statistics query as psycopg2
+    # does for a numeric result, with Decimals
+
+    def execute(self, statement, params=None):
+        return
+
+    def fetchone(self):
+        return (Decimal(12), Decimal(34567))
+
+    def fetchall(self):
+        return [ self.fetchone(), ]
+
+class TestLoadStats(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="handyrep-test-")
+        options = simulator.parse_args(["--time-scale", "0", "--jitter", "0", "--seed", "1"])
+        self.hr, self.cluster = simulator.build_cluster(3, options, self.workdir)
+        self.hr.verify_all()
+
+    def tearDown(self):
+        clusters.pop(self.hr.conf["handyrep"]["cluster_name"], None)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_decimal_stats_are_saved(self):
+        replica = self.hr.get_replicas_by_status("healthy")[0]
+        self.hr.update_load_stats(replica, numeric_cursor())
+        stats = self.hr.servers[replica]["load_stats"]
+        self.assertEqual(stats["blks_read"], 34567)
+        self.assertEqual(stats["connections"], 12)
+
+        # changes status so that the write isn't skipped
+        self.hr.servers[replica]["status_message"] = "load stats test"
+        self.hr.write_servers()
+        saved, generation = self.hr.get_serverfile().read()
+        self.assertEqual(generation, 0)
+        self.assertEqual(saved["servers"][replica]["load_stats"]["blks_read"], 34567)
+        json.dumps(self.hr.get_server_info(replica))
+
+if __name__ == "__main__":
+    unittest.main()